@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+
+@dataclass
+class _Request:
+    items: list[Any]
+    future: Future
+    deadline: Optional[float] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class MicroBatcher:
+    """
+    Склейка конкурентных запросов к модели в один вызов.
+
+    Фоновый поток берёт первый запрос из очереди, затем добирает следующие в течение `window_s`
+    (или пока не наберётся `max_batch` элементов), вызывает `run_batch(items)` один раз и раздаёт
+    результаты по Future вызывающих. `window_s=0` — не ждать, но забрать всё, что уже в очереди.
+    `run_batch` обязан вернуть список той же длины и в том же порядке, что `items`.
+    Запрос с истёкшим `deadline` (time.monotonic) в батч не попадает: его Future получает TimeoutError.
+    """
+
+    def __init__(self, name: str, run_batch: Callable[[list[Any]], list[Any]], max_batch: int, window_s: float):
+        self.name = name
+        self._run_batch = run_batch
+        self._max_batch = max(1, int(max_batch))
+        self._window_s = max(0.0, float(window_s))
+        self._q: "queue.Queue[_Request]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._stats = {"requests": 0, "batches": 0, "items": 0, "max_batch_seen": 0, "errors": 0, "expired": 0, "wait_s_total": 0.0, "run_s_total": 0.0}
+
+    def submit(self, items: list[Any], deadline: Optional[float] = None) -> Future:
+        fut: Future = Future()
+        if not items:
+            fut.set_result([])
+            return fut
+        self._ensure_thread()
+        self._q.put(_Request(items=list(items), future=fut, deadline=deadline))
+        return fut
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                t = threading.Thread(target=self._loop, name=f"kb_ring_batch_{self.name}", daemon=True)
+                t.start()
+                self._thread = t
+
+    def _collect(self) -> list[_Request]:
+        first = self._q.get()
+        batch = [first]
+        n = len(first.items)
+        deadline = time.monotonic() + self._window_s
+        while n < self._max_batch:
+            try:
+                left = deadline - time.monotonic()
+                r = self._q.get(timeout=left) if left > 0 else self._q.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(r)
+            n += len(r.items)
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            collected = self._collect()
+            # Часы — после _collect: он мог долго ждать в q.get(), и дедлайны сверяются с моментом запуска.
+            now = time.monotonic()
+            batch = []
+            for r in collected:
+                if not r.future.set_running_or_notify_cancel():
+                    continue
+                if r.deadline is not None and r.deadline <= now:
+                    r.future.set_exception(TimeoutError(f"{self.name}: deadline expired in queue"))
+                    with self._lock:
+                        self._stats["expired"] += 1
+                    continue
+                batch.append(r)
+            if batch:
+                self._run(batch)
+
+    def _run(self, batch: list[_Request]) -> None:
+        started = time.monotonic()
+        items: list[Any] = []
+        for r in batch:
+            items.extend(r.items)
+        try:
+            results = self._run_batch(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"{self.name}: run_batch returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            for r in batch:
+                r.future.set_exception(e)
+            return
+
+        pos = 0
+        for r in batch:
+            r.future.set_result(results[pos : pos + len(r.items)])
+            pos += len(r.items)
+
+        with self._lock:
+            st = self._stats
+            st["requests"] += len(batch)
+            st["batches"] += 1
+            st["items"] += len(items)
+            st["max_batch_seen"] = max(st["max_batch_seen"], len(items))
+            st["wait_s_total"] += sum(started - r.enqueued_at for r in batch)
+            st["run_s_total"] += time.monotonic() - started
+
+    def stats(self) -> dict:
+        with self._lock:
+            st = dict(self._stats)
+        batches = max(1, st["batches"])
+        requests = max(1, st["requests"])
+        return {
+            "queue_depth": self._q.qsize(),
+            "max_batch": self._max_batch,
+            "window_ms": round(1000.0 * self._window_s, 2),
+            "requests": st["requests"],
+            "batches": st["batches"],
+            "items": st["items"],
+            "errors": st["errors"],
+            "expired": st["expired"],
+            "avg_batch": round(st["items"] / batches, 2),
+            "max_batch_seen": st["max_batch_seen"],
+            "wait_ms_avg": round(1000.0 * st["wait_s_total"] / requests, 2),
+            "run_ms_avg": round(1000.0 * st["run_s_total"] / batches, 2),
+            "items_per_s": round(st["items"] / st["run_s_total"], 1) if st["run_s_total"] > 0 else 0.0,
+        }
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LruCache:
+    """Потокобезопасный in-process LRU с ограничением по числу элементов и счётчиками попаданий."""
+
+    def __init__(self, max_items: int):
+        self.max_items = max(0, int(max_items))
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_items > 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            v = self._data.get(key)
+            if v is None:
+                self._misses += 1
+                return None
+            self._data.move_to_end(key)
+            self._hits += 1
+            return v
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if not self.enabled or value is None:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "size": len(self._data),
+                "max_items": self.max_items,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_rate": round(self._hits / total, 4) if total else 0.0,
+            }
+
+
+class SqliteBlobCache:
+    """
+    Разделяемый дисковый уровень кэша (key -> bytes) на SQLite в WAL-режиме:
+    общий для нескольких процессов uvicorn на одном хосте и переживает рестарт.
+    Ошибки диска не пробрасываются: кэш — оптимизация, а не источник данных.
+    """
+
+    def __init__(self, path: str, table: str):
+        self.path = path
+        self._table = table
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+        self._disabled = False
+
+    def _conn(self) -> Optional[sqlite3.Connection]:
+        """Соединение потока; None — уровень выключен (каталог/файл недоступен при открытии)."""
+        if self._disabled:
+            return None
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {self._table} (k TEXT PRIMARY KEY, v BLOB NOT NULL)")
+            except (OSError, sqlite3.Error):
+                with self._lock:
+                    self._errors += 1
+                    self._disabled = True
+                return None
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys: list[str]) -> dict[str, bytes]:
+        if not keys:
+            return {}
+        conn = self._conn()
+        if conn is None:
+            return {}
+        try:
+            qs = ",".join("?" for _ in keys)
+            rows = conn.execute(f"SELECT k, v FROM {self._table} WHERE k IN ({qs})", keys).fetchall()
+        except sqlite3.Error:
+            with self._lock:
+                self._errors += 1
+            return {}
+        out = {str(k): bytes(v) for k, v in rows}
+        with self._lock:
+            self._hits += len(out)
+            self._misses += len(keys) - len(out)
+        return out
+
+    def put_many(self, items: dict[str, bytes]) -> None:
+        if not items:
+            return
+        conn = self._conn()
+        if conn is None:
+            return
+        try:
+            conn.executemany(f"INSERT OR REPLACE INTO {self._table} (k, v) VALUES (?, ?)", list(items.items()))
+        except sqlite3.Error:
+            with self._lock:
+                self._errors += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "path": self.path,
+                "hits": self._hits,
+                "misses": self._misses,
+                "errors": self._errors,
+                "disabled": self._disabled,
+                "hit_rate": round(self._hits / total, 4) if total else 0.0,
+            }
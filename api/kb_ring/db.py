@@ -1,19 +1,134 @@
-from contextlib import contextmanager
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
 
-import psycopg
+from pgvector.psycopg import register_vector, register_vector_async
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 
-from .config import DATABASE_URL
+from .config import (
+    DATABASE_URL,
+    DB_POOL_MAX_IDLE_S,
+    DB_POOL_MAX_LIFETIME_S,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_TIMEOUT_S,
+)
+
+
+_POOL: Optional[ConnectionPool] = None
+_APOOL: Optional[AsyncConnectionPool] = None
+# Одновременные первые обращения иначе создают по пулу, и лишние утекают.
+_POOL_LOCK = threading.Lock()
+_APOOL_LOCK = asyncio.Lock()
+
+
+def _pool_kwargs(name: str) -> dict:
+    return {
+        "min_size": DB_POOL_MIN_SIZE,
+        "max_size": max(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
+        "max_idle": DB_POOL_MAX_IDLE_S,
+        "max_lifetime": DB_POOL_MAX_LIFETIME_S,
+        "timeout": DB_POOL_TIMEOUT_S,
+        "kwargs": {"autocommit": False},
+        "name": name,
+    }
+
+
+def _configure(conn) -> None:
+    # Бинарная адаптация pgvector: numpy float32 <-> vector без текстового '[0.1,...]' в Python.
+    register_vector(conn)
+    conn.commit()
+
+
+async def _aconfigure(conn) -> None:
+    await register_vector_async(conn)
+    await conn.commit()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Общий пул соединений API (создаётся лениво при первом обращении).
+    Соединение проверяется перед выдачей (`check_connection`), поэтому после рестарта Postgres
+    обработчики не получают "мёртвые" соединения.
+    """
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ConnectionPool(
+                    DATABASE_URL,
+                    check=ConnectionPool.check_connection,
+                    configure=_configure,
+                    open=True,
+                    **_pool_kwargs("kb_ring_api"),
+                )
+    return _POOL
+
+
+async def get_apool() -> AsyncConnectionPool:
+    """
+    Async-пул для `async def` обработчиков (чат): запросы к Postgres не блокируют event loop.
+    Открывается в lifespan приложения; ленивое открытие оставлено для скриптов/тестов.
+    """
+    global _APOOL
+    if _APOOL is None:
+        async with _APOOL_LOCK:
+            if _APOOL is None:
+                pool = AsyncConnectionPool(
+                    DATABASE_URL,
+                    check=AsyncConnectionPool.check_connection,
+                    configure=_aconfigure,
+                    open=False,
+                    **_pool_kwargs("kb_ring_api_async"),
+                )
+                await pool.open()
+                _APOOL = pool
+    return _APOOL
+
+
+def close_pool() -> None:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.close()
+            _POOL = None
+
+
+async def aclose_pool() -> None:
+    global _APOOL
+    if _APOOL is not None:
+        await _APOOL.close()
+        _APOOL = None
+
+
+def _stats(pool) -> dict:
+    if pool is None:
+        return {"open": False}
+    stats = dict(pool.get_stats())
+    stats["open"] = True
+    stats["min_size"] = pool.min_size
+    stats["max_size"] = pool.max_size
+    return stats
+
+
+def pool_stats() -> dict:
+    """
+    Заполненность пулов для /api/v1/metrics: размер, свободные соединения, очередь ожидающих
+    и накопительные счётчики psycopg_pool (requests_num, requests_waiting, usage_ms, ...).
+    """
+    return {"sync": _stats(_POOL), "async": _stats(_APOOL)}
 
 
 @contextmanager
 def db_conn():
-    # Держим максимально просто/синхронно на этапе 1. Позже можно добавить пул соединений.
-    conn = psycopg.connect(DATABASE_URL, autocommit=False)
-    try:
+    # Соединение берётся из пула; commit/rollback выполняет пул по выходу из блока.
+    with get_pool().connection() as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def adb_conn():
+    pool = await get_apool()
+    async with pool.connection() as conn:
         yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
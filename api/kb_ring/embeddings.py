@@ -1,9 +1,28 @@
 from __future__ import annotations
 
+import hashlib
+import os
+import threading
+import unicodedata
+from concurrent.futures import Future
 from dataclasses import dataclass
-from typing import Optional
-
-from .config import EMBEDDINGS_BATCH_SIZE, EMBEDDINGS_DIMS, EMBEDDINGS_ENABLED, EMBEDDINGS_MODEL
+from typing import Any, Optional
+
+from .batching import MicroBatcher
+from .cache import LruCache, SqliteBlobCache
+from .config import (
+    EMBED_CACHE_DIR,
+    EMBED_CACHE_SIZE,
+    EMBED_QUERY_BATCH_MAX,
+    EMBED_QUERY_BATCH_WINDOW_MS,
+    EMBEDDINGS_BACKEND,
+    EMBEDDINGS_BATCH_SIZE,
+    EMBEDDINGS_DIMS,
+    EMBEDDINGS_ENABLED,
+    EMBEDDINGS_MODEL,
+)
+from .inference import call_inference
+from .model_backend import load_model
 
 
 @dataclass(frozen=True)
@@ -11,28 +30,65 @@ class Embedder:
     model_name: str
     dims: int
 
-    def embed_query(self, text: str) -> list[float]:
+    def embed_query(self, text: str) -> Any:
         raise NotImplementedError
 
-    def embed_passage(self, text: str) -> list[float]:
+    def submit_query(self, text: str) -> Future:
+        """Асинхронный вариант embed_query: Future с вектором (для async обработчиков)."""
+        fut: Future = Future()
+        try:
+            fut.set_result(self.embed_query(text))
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+
+    def submit_queries(self, texts: list[str]) -> Future:
+        """Пакет запросов: Future со списком векторов в порядке `texts`."""
+        fut: Future = Future()
+        try:
+            fut.set_result([self.embed_query(t) for t in texts])
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+
+    def embed_passage(self, text: str) -> Any:
         raise NotImplementedError
 
 
 _EMBEDDER: Optional[Embedder] = None
 _EMBEDDER_ERR: Optional[str] = None
+_EMBEDDER_LOCK = threading.Lock()
+_QUERY_BATCHER: Optional[MicroBatcher] = None
+
+# Кэш эмбеддингов запросов: ключ = (модель, нормализованный текст), значение = float32 ndarray.
+_QUERY_CACHE = LruCache(EMBED_CACHE_SIZE)
+_QUERY_DISK_CACHE: Optional[SqliteBlobCache] = (
+    SqliteBlobCache(os.path.join(EMBED_CACHE_DIR, "query_embeddings.sqlite3"), "query_embeddings") if EMBED_CACHE_DIR else None
+)
+
+
+def normalize_query(text: str) -> str:
+    # Одинаковые по смыслу строки из UI/чата отличаются пробелами и формой юникода — сводим их к одной.
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
 
+def _cache_key(norm: str) -> str:
+    return hashlib.sha1(f"{EMBEDDINGS_MODEL}\x00{norm}".encode("utf-8")).hexdigest()
 
-def _l2_normalize(v: list[float]) -> list[float]:
-    # Normalize for cosine similarity in pgvector.
-    import math
 
-    s = 0.0
-    for x in v:
-        s += float(x) * float(x)
-    n = math.sqrt(s) if s > 0.0 else 0.0
-    if n <= 0.0:
-        return [0.0 for _ in v]
-    return [float(x) / n for x in v]
+def _l2_normalize(vecs):
+    # Normalize for cosine similarity in pgvector (rows of a float32 matrix).
+    import numpy as np  # type: ignore
+
+    m = np.asarray(vecs, dtype=np.float32)
+    n = np.linalg.norm(m, axis=1, keepdims=True)
+    n[n <= 0.0] = 1.0
+    return m / n
+
+
+def embedder_loaded() -> bool:
+    """True, если get_embedder() уже отработал (модель загружена или известно, что её нет)."""
+    return (not EMBEDDINGS_ENABLED) or _EMBEDDER is not None or _EMBEDDER_ERR is not None
 
 
 def get_embedder() -> Optional[Embedder]:
@@ -40,49 +96,142 @@ def get_embedder() -> Optional[Embedder]:
     Возвращает локальный эмбеддер (sentence-transformers), если зависимости установлены.
     Если нет — возвращает None и retrieval работает в FTS-only режиме.
     """
-    global _EMBEDDER, _EMBEDDER_ERR
+    global _EMBEDDER, _EMBEDDER_ERR, _QUERY_BATCHER
     if not EMBEDDINGS_ENABLED:
         return None
     if _EMBEDDER is not None or _EMBEDDER_ERR is not None:
         return _EMBEDDER
 
-    try:
-        from sentence_transformers import SentenceTransformer  # type: ignore
-    except Exception as e:  # pragma: no cover
-        _EMBEDDER_ERR = f"sentence-transformers import failed: {e}"
-        return None
-
-    st = SentenceTransformer(EMBEDDINGS_MODEL)
-
-    class _StEmbedder(Embedder):
-        def __init__(self):
-            super().__init__(model_name=EMBEDDINGS_MODEL, dims=EMBEDDINGS_DIMS)
-
-        def _encode_one(self, text: str) -> list[float]:
-            vec = st.encode([text], normalize_embeddings=True, batch_size=EMBEDDINGS_BATCH_SIZE)
-            v = [float(x) for x in vec[0].tolist()]
-            return _l2_normalize(v)
-
-        def embed_query(self, text: str) -> list[float]:
-            # E5 query embeddings: prefix "query: ".
-            return self._encode_one("query: " + (text or ""))
-
-        def embed_passage(self, text: str) -> list[float]:
-            # E5 passage embeddings: prefix "passage: ".
-            return self._encode_one("passage: " + (text or ""))
-
-    emb = _StEmbedder()
-    if emb.dims and len(emb.embed_query("ping")) != emb.dims:
-        # If the env config is wrong, prefer disabling embeddings rather than crashing API.
-        _EMBEDDER_ERR = f"embedding dims mismatch: expected {emb.dims}"
-        return None
-
-    _EMBEDDER = emb
-    return _EMBEDDER
+    with _EMBEDDER_LOCK:
+        if _EMBEDDER is not None or _EMBEDDER_ERR is not None:
+            return _EMBEDDER
+
+        try:
+            import numpy as np  # type: ignore
+            from sentence_transformers import SentenceTransformer  # type: ignore
+        except Exception as e:  # pragma: no cover
+            _EMBEDDER_ERR = f"sentence-transformers import failed: {e}"
+            return None
+
+        try:
+            st = load_model(SentenceTransformer, EMBEDDINGS_MODEL, EMBEDDINGS_BACKEND)
+        except Exception as e:  # pragma: no cover
+            _EMBEDDER_ERR = f"sentence-transformers init failed ({EMBEDDINGS_BACKEND}): {e}"
+            return None
+
+        def _encode(texts: list[str]) -> list:
+            vecs = st.encode(texts, normalize_embeddings=True, batch_size=EMBEDDINGS_BATCH_SIZE)
+            # Копии строк, а не view: иначе закэшированный вектор держит в памяти всю матрицу батча.
+            return [row.copy() for row in _l2_normalize(vecs)]
+
+        def _encode_queries(norms: list[str]) -> list:
+            # Выполняется в потоке батчера: дисковый уровень кэша не блокирует event loop.
+            out: list = [None] * len(norms)
+            keys = [_cache_key(n) for n in norms]
+            if _QUERY_DISK_CACHE is not None:
+                found = _QUERY_DISK_CACHE.get_many(list(set(keys)))
+                for i, k in enumerate(keys):
+                    if k in found:
+                        out[i] = np.frombuffer(found[k], dtype=np.float32)
+            todo = [i for i, v in enumerate(out) if v is None]
+            if todo:
+                # E5 query embeddings: prefix "query: ".
+                vecs = _encode(["query: " + norms[i] for i in todo])
+                for i, v in zip(todo, vecs):
+                    # Вектор разделяется между запросами через кэш — защищаем от случайной мутации.
+                    v.setflags(write=False)
+                    out[i] = v
+                if _QUERY_DISK_CACHE is not None:
+                    _QUERY_DISK_CACHE.put_many({keys[i]: out[i].tobytes() for i in todo})
+            return out
+
+        # Запросы от конкурентных обработчиков склеиваются в один st.encode (см. batching.MicroBatcher);
+        # сам encode идёт через пул инференса, чтобы INFERENCE_WORKERS ограничивал и батчи.
+        batcher = MicroBatcher(
+            "embed_query",
+            lambda norms: call_inference(_encode_queries, norms),
+            max_batch=EMBED_QUERY_BATCH_MAX,
+            window_s=EMBED_QUERY_BATCH_WINDOW_MS / 1000.0,
+        )
+
+        class _StEmbedder(Embedder):
+            def __init__(self):
+                super().__init__(model_name=EMBEDDINGS_MODEL, dims=EMBEDDINGS_DIMS)
+
+            def submit_query(self, text: str) -> Future:
+                norm = normalize_query(text)
+                fut: Future = Future()
+                cached = _QUERY_CACHE.get((self.model_name, norm))
+                if cached is not None:
+                    fut.set_result(cached)
+                    return fut
+
+                inner = batcher.submit([norm])
+
+                def _unwrap(f: Future):
+                    if fut.cancelled():
+                        return
+                    if f.cancelled() or f.exception() is not None:
+                        fut.set_exception(f.exception() if not f.cancelled() else RuntimeError("cancelled"))
+                    else:
+                        v = f.result()[0]
+                        _QUERY_CACHE.put((self.model_name, norm), v)
+                        fut.set_result(v)
+
+                # Вызывающий отменил ожидание (таймаут) -> не тратим на этот запрос место в батче.
+                fut.add_done_callback(lambda f: inner.cancel() if f.cancelled() else None)
+                inner.add_done_callback(_unwrap)
+                return fut
+
+            def submit_queries(self, texts: list[str]) -> Future:
+                # Промахи кэша уходят в батчер одним запросом -> один st.encode на весь пакет.
+                norms = [normalize_query(t) for t in texts]
+                found = [_QUERY_CACHE.get((self.model_name, n)) for n in norms]
+                todo = sorted({n for n, v in zip(norms, found) if v is None})
+                fut: Future = Future()
+                if not todo:
+                    fut.set_result(found)
+                    return fut
+
+                inner = batcher.submit(todo)
+
+                def _unwrap(f: Future):
+                    if fut.cancelled():
+                        return
+                    if f.cancelled() or f.exception() is not None:
+                        fut.set_exception(f.exception() if not f.cancelled() else RuntimeError("cancelled"))
+                        return
+                    got = dict(zip(todo, f.result()))
+                    for n, v in got.items():
+                        _QUERY_CACHE.put((self.model_name, n), v)
+                    fut.set_result([v if v is not None else got[n] for n, v in zip(norms, found)])
+
+                fut.add_done_callback(lambda f: inner.cancel() if f.cancelled() else None)
+                inner.add_done_callback(_unwrap)
+                return fut
+
+            def embed_query(self, text: str):
+                return self.submit_query(text).result()
+
+            def embed_passage(self, text: str):
+                # E5 passage embeddings: prefix "passage: ".
+                return _encode(["passage: " + (text or "")])[0]
+
+        emb = _StEmbedder()
+        if emb.dims and len(_encode(["query: ping"])[0]) != emb.dims:
+            # If the env config is wrong, prefer disabling embeddings rather than crashing API.
+            _EMBEDDER_ERR = f"embedding dims mismatch: expected {emb.dims}"
+            return None
+
+        _QUERY_BATCHER = batcher
+        _EMBEDDER = emb
+        return _EMBEDDER
 
 
-def pgvector_text(v: list[float]) -> str:
-    """
-    Формат ввода pgvector: '[0.1,0.2,...]'. Удобно передавать как TEXT параметр.
-    """
-    return "[" + ",".join(f"{float(x):.8f}" for x in v) + "]"
+def embedder_stats() -> dict:
+    out: dict = {"loaded": _EMBEDDER is not None, "backend": EMBEDDINGS_BACKEND, "error": _EMBEDDER_ERR, "query_cache": _QUERY_CACHE.stats()}
+    if _QUERY_DISK_CACHE is not None:
+        out["query_disk_cache"] = _QUERY_DISK_CACHE.stats()
+    if _QUERY_BATCHER is not None:
+        out["query_batcher"] = _QUERY_BATCHER.stats()
+    return out
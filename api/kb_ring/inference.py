@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from .config import INFERENCE_TORCH_THREADS, INFERENCE_WORKERS
+
+
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_LOCK = threading.Lock()
+_STATS = {
+    "submitted": 0,
+    "completed": 0,
+    "failed": 0,
+    "timeouts": 0,
+    "queued": 0,
+    "running": 0,
+    "wait_s_total": 0.0,
+    "wait_s_max": 0.0,
+    "run_s_total": 0.0,
+}
+
+
+_TORCH_CONFIGURED = False
+
+
+def configure_torch_threads() -> None:
+    """torch.set_num_threads(INFERENCE_TORCH_THREADS) один раз на процесс (вызывается при старте API)."""
+    global _TORCH_CONFIGURED
+    with _LOCK:
+        if _TORCH_CONFIGURED:
+            return
+        _TORCH_CONFIGURED = True
+    if INFERENCE_TORCH_THREADS > 0:
+        # Иначе каждый поток пула берёт все ядра под intra-op и они дерутся друг с другом.
+        try:
+            import torch  # type: ignore
+
+            torch.set_num_threads(INFERENCE_TORCH_THREADS)
+        except Exception:  # pragma: no cover
+            pass
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        configure_torch_threads()
+    with _LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=max(1, INFERENCE_WORKERS), thread_name_prefix="kb_ring_infer")
+        return _EXECUTOR
+
+
+def shutdown_executor() -> None:
+    global _EXECUTOR
+    with _LOCK:
+        ex, _EXECUTOR = _EXECUTOR, None
+    if ex is not None:
+        ex.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(fn: Callable[..., Any], args: tuple, kwargs: dict) -> Future:
+    submitted_at = time.monotonic()
+
+    def _call():
+        started_at = time.monotonic()
+        waited = started_at - submitted_at
+        with _LOCK:
+            _STATS["queued"] -= 1
+            _STATS["running"] += 1
+            _STATS["wait_s_total"] += waited
+            _STATS["wait_s_max"] = max(_STATS["wait_s_max"], waited)
+        ok = False
+        try:
+            res = fn(*args, **kwargs)
+            ok = True
+            return res
+        finally:
+            with _LOCK:
+                _STATS["running"] -= 1
+                _STATS["run_s_total"] += time.monotonic() - started_at
+                _STATS["completed" if ok else "failed"] += 1
+
+    with _LOCK:
+        _STATS["submitted"] += 1
+        _STATS["queued"] += 1
+    return _get_executor().submit(_call)
+
+
+def call_inference(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    Синхронный вариант `run_inference` для фоновых потоков (батчеры embedder/reranker):
+    вызов идёт через тот же ограниченный пул, так что INFERENCE_WORKERS ограничивает весь инференс.
+    """
+    return _submit(fn, args, kwargs).result()
+
+
+async def run_inference(fn: Callable[..., Any], *args: Any, timeout: Optional[float] = None, **kwargs: Any) -> Any:
+    """
+    Выполнить CPU-тяжёлый вызов (embedder/cross-encoder) в отдельном ограниченном пуле потоков,
+    чтобы не блокировать event loop. При превышении `timeout` бросает asyncio.TimeoutError;
+    уже начатый вызов при этом дорабатывает в фоне (torch не прерывается), но его результат не ждём.
+    """
+    cf = _submit(fn, args, kwargs)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(cf), timeout)
+    except asyncio.TimeoutError:
+        with _LOCK:
+            _STATS["timeouts"] += 1
+            # Задача так и не стартовала: отмена прошла, `_call` не уменьшит счётчик очереди сам.
+            if cf.cancelled():
+                _STATS["queued"] -= 1
+        raise
+
+
+def inference_stats() -> dict:
+    """Глубина очереди и время ожидания/выполнения (для подбора INFERENCE_WORKERS под хост)."""
+    with _LOCK:
+        s = dict(_STATS)
+    started = max(1, s["completed"] + s["failed"] + s["running"])
+    finished = max(1, s["completed"] + s["failed"])
+    return {
+        "workers": max(1, INFERENCE_WORKERS),
+        "queue_depth": s["queued"],
+        "running": s["running"],
+        "submitted": s["submitted"],
+        "completed": s["completed"],
+        "failed": s["failed"],
+        "timeouts": s["timeouts"],
+        "wait_ms_avg": round(1000.0 * s["wait_s_total"] / started, 2),
+        "wait_ms_max": round(1000.0 * s["wait_s_max"], 2),
+        "run_ms_avg": round(1000.0 * s["run_s_total"] / finished, 2),
+    }
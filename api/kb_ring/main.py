@@ -1,25 +1,49 @@
 import hashlib
+from contextlib import asynccontextmanager
 from typing import Literal, Optional
 
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, Form, Header, HTTPException, Request
+from fastapi import Depends, FastAPI, Form, Header, HTTPException, Query, Request
 from fastapi.responses import HTMLResponse, JSONResponse
 from psycopg.types.json import Jsonb
+from pydantic import BaseModel, Field
 
 from .auth import AuthUser, create_access_token, token_from_header, verify_access_token
 from .config import AUTH_COOKIE_DOMAIN, AUTH_COOKIE_NAME, AUTH_COOKIE_SECURE
-from .db import db_conn
-from .embeddings import get_embedder, pgvector_text
-from .config import RERANK_TOP_M, RERANK_TOP_N
+from .db import aclose_pool, adb_conn, close_pool, db_conn, get_apool, get_pool, pool_stats
+from .embeddings import embedder_stats
+from .config import RERANK_ENABLED, RERANK_MAX_PASSAGE_CHARS, RERANK_TOP_M, RERANK_TOP_N
+from .inference import configure_torch_threads, inference_stats, shutdown_executor
 from .llm import llm_chat_completion
-from .rerank_bge import Candidate, rerank
-from .retrieval import hybrid_retrieve
+from .rerank_bge import Candidate, arerank, reranker_stats
+from .retrieval import aload_chunk_contents, get_engine, retrieval_stats
 
 
 # Загружаем .env при запуске вне Docker (удобство для локальной разработки)
 load_dotenv(override=False)
 
-app = FastAPI(title="KB-RING API", version="0.0.1")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # Прогреваем пулы при старте, чтобы первый запрос не платил за handshake; закрываем при остановке.
+    get_pool()
+    await get_apool()
+    configure_torch_threads()
+    try:
+        yield
+    finally:
+        await aclose_pool()
+        close_pool()
+        shutdown_executor()
+
+
+app = FastAPI(title="KB-RING API", version="0.0.1", lifespan=lifespan)
+
+# Длина excerpt в citations/search (символы).
+_EXCERPT_CHARS = 500
+# Верхняя граница excerpt_chars в search (иначе огромное значение уходит в SQL как numeric -> 500).
+_EXCERPT_CHARS_MAX = 100_000
+# Максимум запросов в /api/v1/search/batch.
+_SEARCH_BATCH_MAX = 64
 
 
 def _set_auth_cookie(resp: JSONResponse, token: str):
@@ -37,6 +61,15 @@ def _set_auth_cookie(resp: JSONResponse, token: str):
     resp.set_cookie(**kwargs)
 
 
+async def _check_session_owner(cur, session_id: int, user_id: int) -> None:
+    await cur.execute("SELECT user_id FROM chat.sessions WHERE id=%s", (session_id,))
+    row = await cur.fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="сессия не найдена")
+    if int(row[0]) != int(user_id):
+        raise HTTPException(status_code=403, detail="нет доступа")
+
+
 def get_current_user(request: Request, authorization: Optional[str] = Header(None)) -> AuthUser:
     token = token_from_header(authorization) or request.cookies.get(AUTH_COOKIE_NAME)
     user = verify_access_token(token or "")
@@ -50,6 +83,18 @@ def health():
     return {"ok": True}
 
 
+@app.get("/api/v1/metrics", response_class=JSONResponse)
+def metrics(current_user: AuthUser = Depends(get_current_user)):
+    # Внутренние детали (пулы, ошибки загрузки моделей, пути кэшей) — только авторизованным.
+    return {
+        "db_pool": pool_stats(),
+        "inference": inference_stats(),
+        "embeddings": embedder_stats(),
+        "rerank": reranker_stats(),
+        "retrieval": retrieval_stats(),
+    }
+
+
 @app.get("/", response_class=HTMLResponse)
 def index():
     return HTMLResponse(
@@ -58,6 +103,7 @@ def index():
         "<ul>"
         "<li>POST /api/v1/ingest/transcript</li>"
         "<li>GET /api/v1/search?q=...</li>"
+        "<li>POST /api/v1/search/batch</li>"
         "</ul>"
     )
 
@@ -124,118 +170,82 @@ def ingest_transcript(
 
 
 @app.get("/api/v1/search", response_class=JSONResponse)
-def search(
+async def search(
     q: str,
     limit: int = 10,
+    excerpt_chars: int = Query(0, ge=0, le=_EXCERPT_CHARS_MAX),
     current_user: AuthUser = Depends(get_current_user),
 ):
     """
-    Hybrid search:
+    Hybrid search (общий RetrievalEngine с чатом):
     - FTS по `tac.chunks.tsv`
     - vector similarity по `tac.embeddings` (локальные sentence-transformers), если доступно
+    `excerpt_chars` > 0 — отдать только начало чанка (0 = полный текст).
     """
     q = (q or "").strip()
     if not q:
         return {"items": []}
     limit = max(1, min(50, int(limit)))
 
-    embedder = get_embedder()
-    qvec_txt: Optional[str] = None
-    model: Optional[str] = None
-    if embedder is not None and int(getattr(embedder, "dims", 0) or 0) == 768:
-        try:
-            qvec_txt = pgvector_text(embedder.embed_query(q))
-            model = embedder.model_name
-        except Exception:
-            qvec_txt = None
-            model = None
+    async with adb_conn() as conn:
+        res = await get_engine().aretrieve(
+            conn, current_user.user_id, q, top_k=limit, content_chars=excerpt_chars or None
+        )
+    return {"items": [_search_item(r, res.channels) for r in res.chunks], "channels": res.channels, "timings_ms": res.timings_ms}
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            if qvec_txt and model:
-                cur.execute(
-                    """
-                    WITH
-                      fts AS (
-                        SELECT
-                          c.id AS chunk_id,
-                          ts_rank(c.tsv, plainto_tsquery('simple', %(q)s)) AS s_fts
-                        FROM tac.chunks c
-                        JOIN tac.documents d ON d.id = c.document_id
-                        WHERE d.user_id = %(user_id)s
-                          AND c.tsv @@ plainto_tsquery('simple', %(q)s)
-                        ORDER BY s_fts DESC
-                        LIMIT 200
-                      ),
-                      vec AS (
-                        SELECT
-                          e.chunk_id AS chunk_id,
-                          (1.0 - (e.embedding <=> (%(qvec)s)::vector(768))) AS s_vec
-                        FROM tac.embeddings e
-                        JOIN tac.chunks c ON c.id = e.chunk_id
-                        JOIN tac.documents d ON d.id = c.document_id
-                        WHERE d.user_id = %(user_id)s
-                          AND e.model = %(model)s
-                        ORDER BY e.embedding <=> (%(qvec)s)::vector(768)
-                        LIMIT 200
-                      ),
-                      comb AS (
-                        SELECT
-                          COALESCE(fts.chunk_id, vec.chunk_id) AS chunk_id,
-                          COALESCE(fts.s_fts, 0.0) AS s_fts,
-                          COALESCE(vec.s_vec, 0.0) AS s_vec,
-                          (0.55 * COALESCE(fts.s_fts, 0.0) + 0.45 * COALESCE(vec.s_vec, 0.0)) AS rank
-                        FROM fts
-                        FULL OUTER JOIN vec ON vec.chunk_id = fts.chunk_id
-                      )
-                    SELECT
-                      d.id, d.title, d.source, d.doc_type, d.source_ref, d.uri,
-                      c.chunk_text,
-                      comb.rank,
-                      comb.s_fts,
-                      comb.s_vec
-                    FROM comb
-                    JOIN tac.chunks c ON c.id = comb.chunk_id
-                    JOIN tac.documents d ON d.id = c.document_id
-                    WHERE d.user_id = %(user_id)s
-                    ORDER BY comb.rank DESC
-                    LIMIT %(limit)s
-                    """,
-                    {"q": q, "user_id": current_user.user_id, "limit": limit, "qvec": qvec_txt, "model": model},
-                )
-            else:
-                cur.execute(
-                    """
-                    SELECT d.id, d.title, d.source, d.doc_type, d.source_ref, d.uri,
-                           c.chunk_text,
-                           ts_rank(c.tsv, plainto_tsquery('simple', %s)) AS rank
-                    FROM tac.chunks c
-                    JOIN tac.documents d ON d.id = c.document_id
-                    WHERE d.user_id = %s
-                      AND c.tsv @@ plainto_tsquery('simple', %s)
-                    ORDER BY rank DESC
-                    LIMIT %s
-                    """,
-                    (q, current_user.user_id, q, limit),
-                )
-            rows = cur.fetchall()
-    items = []
-    for r in rows:
-        items.append(
-            {
-                "document_id": r[0],
-                "title": r[1],
-                "source": r[2],
-                "doc_type": r[3],
-                "source_ref": r[4],
-                "uri": r[5],
-                "chunk_text": r[6],
-                "rank": float(r[7]),
-                "fts_rank": float(r[8]) if len(r) > 8 and r[8] is not None else None,
-                "vec_score": float(r[9]) if len(r) > 9 and r[9] is not None else None,
-            }
+
+def _search_item(r, channels: list[str]) -> dict:
+    # Контракт ответа как до RetrievalEngine: при гибридном поиске канал, не нашедший чанк, даёт 0.0;
+    # без векторного канала (FTS-only) fts_rank / vec_score — null.
+    hybrid = "vec" in channels
+    fts = r.channel_scores.get("fts", r.channel_scores.get("bm25"))
+    vec = r.channel_scores.get("vec")
+    return {
+        "document_id": r.doc_id,
+        "title": r.title,
+        "source": r.source,
+        "doc_type": r.doc_type,
+        "source_ref": r.source_ref,
+        "uri": r.uri,
+        "chunk_text": r.content,
+        "rank": r.score,
+        "fts_rank": (fts if fts is not None else 0.0) if hybrid else None,
+        "vec_score": (vec if vec is not None else 0.0) if hybrid else None,
+    }
+
+
+class SearchBatchRequest(BaseModel):
+    queries: list[str]
+    limit: int = 10
+    excerpt_chars: int = Field(0, ge=0, le=_EXCERPT_CHARS_MAX)
+
+
+@app.post("/api/v1/search/batch", response_class=JSONResponse)
+async def search_batch(
+    req: SearchBatchRequest,
+    current_user: AuthUser = Depends(get_current_user),
+):
+    """
+    Пакетный hybrid search: все запросы эмбеддятся одним вызовом модели и ищутся одним SQL
+    (LATERAL по unnest запросов). Ответ: results[i] соответствует queries[i].
+    """
+    if not req.queries:
+        raise HTTPException(status_code=400, detail="queries is empty")
+    if len(req.queries) > _SEARCH_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"too many queries (max {_SEARCH_BATCH_MAX})")
+    limit = max(1, min(50, int(req.limit)))
+    excerpt_chars = int(req.excerpt_chars)
+
+    async with adb_conn() as conn:
+        results = await get_engine().aretrieve_batch(
+            conn, current_user.user_id, req.queries, top_k=limit, content_chars=excerpt_chars or None
         )
-    return {"items": items}
+    return {
+        "results": [
+            {"q": q, "items": [_search_item(r, res.channels) for r in res.chunks], "channels": res.channels, "timings_ms": res.timings_ms}
+            for q, res in zip(req.queries, results)
+        ]
+    }
 
 
 @app.get("/ui", response_class=HTMLResponse)
@@ -308,7 +318,7 @@ def ui(current_user: AuthUser = Depends(get_current_user)):
       const out = document.getElementById('results');
       out.innerHTML = '';
       if (!q) return;
-      const r = await fetch('/api/v1/search?q=' + encodeURIComponent(q) + '&limit=20', { headers: { 'accept': 'application/json' }});
+      const r = await fetch('/api/v1/search?q=' + encodeURIComponent(q) + '&limit=20&excerpt_chars=500', { headers: { 'accept': 'application/json' }});
       if (!r.ok) {
         out.innerHTML = '<div class="hit"><div class="title">Ошибка поиска</div><pre>' + (await r.text()) + '</pre></div>';
         return;
@@ -529,38 +539,33 @@ def ui(current_user: AuthUser = Depends(get_current_user)):
 
 
 @app.post("/api/v1/chat/sessions", response_class=JSONResponse)
-def chat_create_session(
+async def chat_create_session(
     title: Optional[str] = Form(default=None),
     current_user: AuthUser = Depends(get_current_user),
 ):
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
+    async with adb_conn() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
                 "INSERT INTO chat.sessions (user_id, title) VALUES (%s, %s) RETURNING id",
                 (current_user.user_id, title),
             )
-            session_id = int(cur.fetchone()[0])
+            session_id = int((await cur.fetchone())[0])
     return {"session_id": session_id}
 
 
 @app.get("/api/v1/chat/sessions/{session_id}", response_class=JSONResponse)
-def chat_get_session(
+async def chat_get_session(
     session_id: int,
     current_user: AuthUser = Depends(get_current_user),
 ):
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT user_id FROM chat.sessions WHERE id=%s", (session_id,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail="сессия не найдена")
-            if int(row[0]) != int(current_user.user_id):
-                raise HTTPException(status_code=403, detail="нет доступа")
-            cur.execute(
+    async with adb_conn() as conn:
+        async with conn.cursor() as cur:
+            await _check_session_owner(cur, session_id, current_user.user_id)
+            await cur.execute(
                 "SELECT id, role, content, created_at FROM chat.messages WHERE session_id=%s ORDER BY created_at, id",
                 (session_id,),
             )
-            rows = cur.fetchall()
+            rows = await cur.fetchall()
     return {
         "session_id": session_id,
         "messages": [
@@ -587,23 +592,25 @@ async def chat_post_message(
         raise HTTPException(status_code=400, detail="пустой текст")
 
     # Validate session ownership + save user message.
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT user_id FROM chat.sessions WHERE id=%s", (session_id,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail="сессия не найдена")
-            if int(row[0]) != int(current_user.user_id):
-                raise HTTPException(status_code=403, detail="нет доступа")
-            cur.execute(
+    async with adb_conn() as conn:
+        async with conn.cursor() as cur:
+            await _check_session_owner(cur, session_id, current_user.user_id)
+            await cur.execute(
                 "INSERT INTO chat.messages (session_id, role, content) VALUES (%s, 'user', %s) RETURNING id",
                 (session_id, q),
             )
-            user_message_id = int(cur.fetchone()[0])
-
-    # Retrieval (local): top-N chunks (hybrid). Later: reranker.
-    with db_conn() as conn:
-        retrieved = hybrid_retrieve(conn, current_user.user_id, q, top_k=RERANK_TOP_N)
+            user_message_id = int((await cur.fetchone())[0])
+
+    # Retrieval (local): top-N chunks (hybrid). Полный текст на этом шаге не читаем:
+    # reranker видит только RERANK_MAX_PASSAGE_CHARS, остальное догружается для top-M.
+    async with adb_conn() as conn:
+        retrieved = (await get_engine().aretrieve(
+            conn,
+            current_user.user_id,
+            q,
+            top_k=RERANK_TOP_N,
+            content_chars=RERANK_MAX_PASSAGE_CHARS if RERANK_ENABLED else 0,
+        )).chunks
 
     def _display_uri(r) -> str:
         # Prefer canonical document URI; otherwise fall back to a stable pseudo-uri.
@@ -622,18 +629,28 @@ async def chat_post_message(
             uri=r.uri,
             content=r.content or "",
             base_score=float(r.score or 0.0),
+            chunk_sha256=r.chunk_sha256,
         )
         for r in retrieved
     ]
-    reranked = rerank(q, cand, top_m=RERANK_TOP_M if mode != "search" else min(20, RERANK_TOP_M))
+    top_m = RERANK_TOP_M if mode != "search" else min(20, RERANK_TOP_M)
+    reranked = await arerank(q, cand, top_m=top_m)
     # Preserve at least some results for search mode even if reranker is disabled.
     retrieved_used = reranked if reranked else cand[: (RERANK_TOP_M if mode != "search" else 20)]
 
+    # Phase 2: текст только для выживших кандидатов. search -> хватает excerpt,
+    # rag-режимы -> полный текст для контекста LLM.
+    if retrieved_used and (mode != "search" or not RERANK_ENABLED):
+        async with adb_conn() as conn:
+            await aload_chunk_contents(
+                conn, retrieved_used, content_chars=None if mode != "search" else _EXCERPT_CHARS + 1
+            )
+
     citations = []
     for i, r in enumerate(retrieved_used, start=1):
         excerpt = (r.content or "").strip()
-        if len(excerpt) > 500:
-            excerpt = excerpt[:500] + "..."
+        if len(excerpt) > _EXCERPT_CHARS:
+            excerpt = excerpt[:_EXCERPT_CHARS] + "..."
         final_score = float(r.rerank_score) if r.rerank_score is not None else float(r.base_score)
         citations.append(
             {
@@ -657,13 +674,13 @@ async def chat_post_message(
         answer_text = "данные не найдены"
         confidence = "low"
 
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
+        async with adb_conn() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
                     "INSERT INTO chat.messages (session_id, role, content) VALUES (%s, 'assistant', %s) RETURNING id",
                     (session_id, answer_text),
                 )
-                assistant_message_id = int(cur.fetchone()[0])
+                assistant_message_id = int((await cur.fetchone())[0])
 
         return {
             "mode": mode,
@@ -749,17 +766,17 @@ async def chat_post_message(
     confidence = "high" if best_score >= 0.25 else ("medium" if best_score >= 0.12 else "low")
 
     # Save assistant + citations.
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
+    async with adb_conn() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
                 "INSERT INTO chat.messages (session_id, role, content) VALUES (%s, 'assistant', %s) RETURNING id",
                 (session_id, answer_text),
             )
-            assistant_message_id = int(cur.fetchone()[0])
-            for c in citations:
-                cur.execute(
+            assistant_message_id = int((await cur.fetchone())[0])
+            if citations:
+                await cur.executemany(
                     "INSERT INTO chat.message_citations (message_id, chunk_id, score) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
-                    (assistant_message_id, int(c["chunk_id"]), float(c["score"] or 0.0)),
+                    [(assistant_message_id, int(c["chunk_id"]), float(c["score"] or 0.0)) for c in citations],
                 )
 
     return {
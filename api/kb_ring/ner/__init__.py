@@ -0,0 +1 @@
+from .extract_entities import extract_entities_regex, extract_entity_spans, is_identifier_query
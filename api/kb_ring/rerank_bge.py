@@ -1,9 +1,28 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import asyncio
+import hashlib
+import threading
+import time
+from dataclasses import dataclass, replace
 from typing import Optional
 
-from .config import RERANK_ENABLED, RERANK_MAX_PASSAGE_CHARS, RERANK_MODEL
+from .batching import MicroBatcher
+from .cache import LruCache
+from .config import (
+    RERANK_BATCH_MAX_PAIRS,
+    RERANK_BACKEND,
+    RERANK_BATCH_WINDOW_MS,
+    RERANK_CACHE_SIZE,
+    RERANK_ENABLED,
+    RERANK_MAX_PASSAGE_CHARS,
+    RERANK_MODEL,
+    RERANK_PREDICT_BATCH_SIZE,
+    RERANK_TIMEOUT_S,
+)
+from .embeddings import normalize_query
+from .inference import call_inference, run_inference
+from .model_backend import load_model
 
 
 @dataclass
@@ -15,10 +34,20 @@ class Candidate:
     content: str
     base_score: float
     rerank_score: Optional[float] = None
+    chunk_sha256: Optional[str] = None
 
 
 _RERANKER = None
 _RERANKER_ERR: Optional[str] = None
+_RERANKER_LOCK = threading.Lock()
+_SCHEDULER: Optional[MicroBatcher] = None
+# Скор зависит только от текста запроса и содержимого чанка: при изменении чанка меняется chunk_sha256,
+# и старые записи просто перестают запрашиваться (вытесняются LRU).
+_SCORE_CACHE = LruCache(RERANK_CACHE_SIZE)
+
+
+def reranker_loaded() -> bool:
+    return (not RERANK_ENABLED) or _RERANKER is not None or _RERANKER_ERR is not None
 
 
 def _get_reranker():
@@ -28,55 +57,151 @@ def _get_reranker():
     if _RERANKER is not None or _RERANKER_ERR is not None:
         return _RERANKER
 
-    try:
-        from sentence_transformers import CrossEncoder  # type: ignore
-    except Exception as e:  # pragma: no cover
-        _RERANKER_ERR = f"cross-encoder import failed: {e}"
-        return None
+    with _RERANKER_LOCK:
+        if _RERANKER is not None or _RERANKER_ERR is not None:
+            return _RERANKER
 
-    try:
-        _RERANKER = CrossEncoder(RERANK_MODEL)
-        return _RERANKER
-    except Exception as e:  # pragma: no cover
-        _RERANKER_ERR = f"cross-encoder init failed: {e}"
-        return None
+        try:
+            from sentence_transformers import CrossEncoder  # type: ignore
+        except Exception as e:  # pragma: no cover
+            _RERANKER_ERR = f"cross-encoder import failed: {e}"
+            return None
 
+        try:
+            _RERANKER = load_model(CrossEncoder, RERANK_MODEL, RERANK_BACKEND)
+            return _RERANKER
+        except Exception as e:  # pragma: no cover
+            _RERANKER_ERR = f"cross-encoder init failed ({RERANK_BACKEND}): {e}"
+            return None
 
-def rerank(query: str, candidates: list[Candidate], top_m: int) -> list[Candidate]:
+
+def _predict_bucketed(pairs: list[tuple[str, str]]) -> list[float]:
     """
-    CPU rerank top-N candidates using BGE cross-encoder.
-    Returns candidates sorted by rerank_score desc (keeps only top_m).
+    Один predict на пары из нескольких запросов. Пары сортируются по длине, чтобы внутренние батчи
+    predict (RERANK_PREDICT_BATCH_SIZE) состояли из близких по длине текстов и меньше паддились.
     """
-    q = (query or "").strip()
-    if not q or not candidates or top_m <= 0:
-        return candidates[: max(0, top_m)]
-
     r = _get_reranker()
     if r is None:
-        # fallback: keep base_score ordering
-        out = sorted(candidates, key=lambda c: float(c.base_score), reverse=True)
-        return out[:top_m]
-
+        raise RuntimeError(_RERANKER_ERR or "reranker disabled")
+    order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+    scores = r.predict([pairs[i] for i in order], batch_size=RERANK_PREDICT_BATCH_SIZE)
+    out = [0.0] * len(pairs)
+    for pos, i in enumerate(order):
+        out[i] = float(scores[pos])
+    return out
+
+
+def _get_scheduler() -> MicroBatcher:
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        with _RERANKER_LOCK:
+            if _SCHEDULER is None:
+                # predict идёт через пул инференса: INFERENCE_WORKERS ограничивает и rerank.
+                _SCHEDULER = MicroBatcher(
+                    "rerank",
+                    lambda pairs: call_inference(_predict_bucketed, pairs),
+                    max_batch=RERANK_BATCH_MAX_PAIRS,
+                    window_s=RERANK_BATCH_WINDOW_MS / 1000.0,
+                )
+    return _SCHEDULER
+
+
+def reranker_stats() -> dict:
+    out = {"loaded": _RERANKER is not None, "backend": RERANK_BACKEND, "error": _RERANKER_ERR, "score_cache": _SCORE_CACHE.stats()}
+    if _SCHEDULER is not None:
+        out["scheduler"] = _SCHEDULER.stats()
+    return out
+
+
+def rerank_fallback(candidates: list[Candidate], top_m: int) -> list[Candidate]:
+    """Порядок по base_score (reranker выключен/недоступен/не уложился в таймаут)."""
+    out = sorted(candidates, key=lambda c: float(c.base_score), reverse=True)
+    return out[: max(0, top_m)]
+
+
+def _pairs(q: str, candidates: list[Candidate]) -> list[tuple[str, str]]:
     pairs = []
-    trimmed: list[Candidate] = []
     for c in candidates:
         passage = (c.content or "").strip()
         if len(passage) > RERANK_MAX_PASSAGE_CHARS:
             passage = passage[:RERANK_MAX_PASSAGE_CHARS]
-        trimmed.append(c)
         pairs.append((q, passage))
+    return pairs
+
+
+def _score_keys(q: str, candidates: list[Candidate]) -> list[Optional[tuple]]:
+    qfp = hashlib.sha1(normalize_query(q).encode("utf-8")).hexdigest()
+    return [(qfp, c.chunk_sha256, RERANK_MODEL, RERANK_MAX_PASSAGE_CHARS) if c.chunk_sha256 else None for c in candidates]
+
+
+def _cached_scores(keys: list[Optional[tuple]]) -> tuple[list[Optional[float]], list[int]]:
+    """Скоры из кэша (None там, где промах) и индексы кандидатов, которые нужно отправить в predict."""
+    scores: list[Optional[float]] = [(_SCORE_CACHE.get(k) if k is not None else None) for k in keys]
+    return scores, [i for i, v in enumerate(scores) if v is None]
+
 
-    try:
-        scores = r.predict(pairs)
-    except Exception:
-        out = sorted(candidates, key=lambda c: float(c.base_score), reverse=True)
-        return out[:top_m]
+def _merge_scores(keys: list[Optional[tuple]], scores: list[Optional[float]], todo: list[int], predicted: list[float]) -> list[float]:
+    for i, v in zip(todo, predicted):
+        scores[i] = float(v)
+        if keys[i] is not None:
+            _SCORE_CACHE.put(keys[i], float(v))
+    return [float(v or 0.0) for v in scores]
 
-    out = []
-    for c, s in zip(trimmed, scores):
-        c.rerank_score = float(s)
-        out.append(c)
 
+def _apply_scores(candidates: list[Candidate], scores: list[float], top_m: int) -> list[Candidate]:
+    # Новые объекты, а не мутация входных: вызов мог истечь по таймауту, и вызывающий уже работает с candidates.
+    out = [replace(c, rerank_score=float(s)) for c, s in zip(candidates, scores)]
     out.sort(key=lambda c: float(c.rerank_score or 0.0), reverse=True)
     return out[:top_m]
 
+
+def rerank(query: str, candidates: list[Candidate], top_m: int) -> list[Candidate]:
+    """
+    CPU rerank top-N candidates using BGE cross-encoder.
+    Returns candidates sorted by rerank_score desc (keeps only top_m).
+    Пары проходят через общий планировщик (склейка с конкурентными запросами).
+    """
+    q = (query or "").strip()
+    if not q or not candidates or top_m <= 0:
+        return candidates[: max(0, top_m)]
+
+    if _get_reranker() is None:
+        # fallback: keep base_score ordering
+        return rerank_fallback(candidates, top_m)
+
+    keys = _score_keys(q, candidates)
+    scores, todo = _cached_scores(keys)
+    predicted: list[float] = []
+    if todo:
+        try:
+            fut = _get_scheduler().submit(_pairs(q, [candidates[i] for i in todo]), deadline=time.monotonic() + RERANK_TIMEOUT_S)
+            predicted = fut.result(timeout=RERANK_TIMEOUT_S)
+        except Exception:
+            return rerank_fallback(candidates, top_m)
+    return _apply_scores(candidates, _merge_scores(keys, scores, todo, predicted), top_m)
+
+
+async def arerank(query: str, candidates: list[Candidate], top_m: int, timeout: float = RERANK_TIMEOUT_S) -> list[Candidate]:
+    """
+    Async-вариант `rerank` для обработчиков: пары уходят в планировщик, event loop только ждёт Future.
+    Дедлайн запроса = `timeout`: не успели начать/закончить -> порядок по base_score.
+    """
+    q = (query or "").strip()
+    if not q or not candidates or top_m <= 0:
+        return candidates[: max(0, top_m)]
+
+    keys = _score_keys(q, candidates)
+    scores, todo = _cached_scores(keys)
+    predicted: list[float] = []
+    if todo:
+        try:
+            if not reranker_loaded():
+                # Первая загрузка cross-encoder — в пуле инференса, не в event loop.
+                await run_inference(_get_reranker, timeout=timeout)
+            if _get_reranker() is None:
+                return rerank_fallback(candidates, top_m)
+            fut = _get_scheduler().submit(_pairs(q, [candidates[i] for i in todo]), deadline=time.monotonic() + timeout)
+            predicted = await asyncio.wait_for(asyncio.wrap_future(fut), timeout)
+        except Exception:
+            return rerank_fallback(candidates, top_m)
+    return _apply_scores(candidates, _merge_scores(keys, scores, todo, predicted), top_m)
@@ -1,7 +1,33 @@
-from dataclasses import dataclass
-from typing import Optional
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable, Optional, Sequence
 
-from .embeddings import get_embedder, pgvector_text
+from .config import (
+    EMBED_QUERY_TIMEOUT_S,
+    EMBEDDINGS_MODEL,
+    LEXICAL_BM25_TERM_DEPTH,
+    RETRIEVAL_CACHE_SIZE,
+    RETRIEVAL_CHANNEL_FACTOR,
+    RETRIEVAL_CHANNEL_MAX,
+    RETRIEVAL_CHANNEL_MIN,
+    RETRIEVAL_DOC_SHORTLIST,
+    RETRIEVAL_FUSION,
+    RETRIEVAL_LEXICAL,
+    RETRIEVAL_RRF_K,
+    RETRIEVAL_VECTOR,
+    VECTOR_BINARY_RESCORE,
+    VECTOR_EF_SEARCH,
+    VECTOR_ITERATIVE_SCAN,
+    VECTOR_STORAGE,
+)
+from psycopg.types.json import Jsonb
+
+from .cache import LruCache
+from .embeddings import embedder_loaded, get_embedder, normalize_query
+from .inference import run_inference
+from .ner import extract_entity_spans, is_identifier_query
 
 @dataclass
 class RetrievedChunk:
@@ -11,125 +37,1088 @@ class RetrievedChunk:
     uri: Optional[str]
     content: str
     score: float
+    chunk_sha256: Optional[str] = None
+    source: Optional[str] = None
+    doc_type: Optional[str] = None
+    source_ref: Optional[str] = None
+    # Скор каждого канала, нашедшего чанк ({"fts"|"bm25": ..., "vec": ..., "ent": ...}); канала нет -> ключа нет.
+    channel_scores: dict[str, float] = field(default_factory=dict)
+
+
+# Настройки векторного канала на транзакцию запроса:
+# - hnsw.ef_search ограничивает число результатов index scan: не меньше LIMIT векторного канала;
+# - hnsw.iterative_scan (pgvector >= 0.8): общий индекс продолжает обход, пока фильтр по user_id
+#   не наберёт LIMIT соседей, вместо пустого результата после post-filter;
+# - plan_cache_mode: custom plan с конкретным user_id, чтобы планировщик мог выбрать частичный
+#   per-tenant HNSW индекс (scripts/rebuild_vector_index.py --user-id) и для prepared statements.
+def vector_settings(limit: int, ef_search: Optional[int] = None) -> tuple[str, dict[str, Any]]:
+    sql = "SELECT set_config('hnsw.ef_search', %(ef)s, true), set_config('plan_cache_mode', 'force_custom_plan', true)"
+    params: dict[str, Any] = {"ef": str(min(HNSW_EF_SEARCH_MAX, ef_search or _ef_search(limit)))}
+    if VECTOR_ITERATIVE_SCAN:
+        sql += ", set_config('hnsw.iterative_scan', %(iter)s, true)"
+        params["iter"] = VECTOR_ITERATIVE_SCAN
+    return sql, params
+
+
+# pgvector принимает hnsw.ef_search только в 1..1000 (иначе set_config падает вместе с запросом).
+HNSW_EF_SEARCH_MAX = 1000
+
+
+def _ef_search(limit: int) -> int:
+    # binary: HNSW по bit-колонке отдаёт limit * VECTOR_BINARY_RESCORE кандидатов на пересчёт.
+    if VECTOR_STORAGE == "binary":
+        limit = int(limit) * max(1, VECTOR_BINARY_RESCORE)
+    return min(HNSW_EF_SEARCH_MAX, max(VECTOR_EF_SEARCH, int(limit)))
+
+
+# Без ограничения: chunk_text целиком (worker режет чанки по 1500 символов).
+FULL_CONTENT = 2147483647
+
+
+@dataclass(frozen=True)
+class Channel:
+    """
+    Канал кандидатов для гибридного поиска.
+    `sql` — тело CTE с колонками (chunk_id, s): лучшие первыми, не больше %(lim)s строк.
+    Доступные параметры: %(q)s, %(user_id)s, %(qvec)b, %(model)s и всё, что вернул `params(q)`.
+    `params` (опционально): свои параметры канала по тексту запроса; None -> канал для запроса не нужен.
+    Скалярные значения `params` должны совпадать у всех запросов (в пакете они общие).
+    """
+
+    name: str
+    sql: str
+    weight: float
+    needs_qvec: bool = False
+    params: Optional[Callable[[str], Optional[dict[str, Any]]]] = None
+    # Параметры из `params`, разные у каждого запроса (списки): в пакетном режиме идут через jsonb.
+    batch_params: tuple[str, ...] = ()
+
+    def cte(self) -> str:
+        return f"  {self.name} AS ({self.sql.replace('%(lim)s', f'%(lim_{self.name})s')})"
+
+
+FTS_CHANNEL = Channel(
+    name="fts",
+    weight=0.55,
+    sql="""
+    SELECT
+      c.id AS chunk_id,
+      ts_rank(c.tsv, plainto_tsquery('simple', %(q)s)) AS s
+    FROM tac.chunks c
+    WHERE c.user_id = %(user_id)s
+      AND c.tsv @@ plainto_tsquery('simple', %(q)s)
+    ORDER BY s DESC
+    LIMIT %(lim)s
+  """,
+)
+
+# BM25 по предрасчитанной статистике (tac.lex_*, миграция 009, ведёт воркер). Термы запроса — те же
+# лексемы 'simple', что в tsv; на терм читается не больше LEXICAL_BM25_TERM_DEPTH постингов с
+# наибольшим impact (индекс idx_tac_lex_postings_impact), поэтому стоимость не растёт с корпусом.
+# В отличие от plainto_tsquery (AND всех термов) — OR: чанк без части термов тоже кандидат.
+BM25_CHANNEL = Channel(
+    name="bm25",
+    weight=0.55,
+    params=lambda q: {"lex_depth": LEXICAL_BM25_TERM_DEPTH},
+    sql="""
+    SELECT p.chunk_id AS chunk_id, sum(t.idf * p.impact) AS s
+    FROM (
+      SELECT lt.term, ln(1.0 + (st.n_docs - lt.df + 0.5) / (lt.df + 0.5)) AS idf
+      FROM tac.lex_terms lt
+      JOIN tac.lex_stats st ON st.user_id = lt.user_id
+      WHERE lt.user_id = %(user_id)s
+        AND lt.term = ANY(tsvector_to_array(to_tsvector('simple', %(q)s)))
+        AND lt.df > 0
+    ) t
+    CROSS JOIN LATERAL (
+      SELECT lp.chunk_id, lp.impact
+      FROM tac.lex_postings lp
+      WHERE lp.user_id = %(user_id)s
+        AND lp.term = t.term
+      ORDER BY lp.impact DESC
+      LIMIT %(lex_depth)s
+    ) p
+    GROUP BY p.chunk_id
+    ORDER BY s DESC
+    LIMIT %(lim)s
+  """,
+)
+
+LEXICAL_CHANNELS = {"fts": FTS_CHANNEL, "bm25": BM25_CHANNEL}
+
+
+def lexical_channel(name: str) -> Channel:
+    try:
+        return LEXICAL_CHANNELS[(name or "fts").strip().lower()]
+    except KeyError:
+        raise ValueError(f"unknown lexical channel {name!r}; expected one of: {', '.join(LEXICAL_CHANNELS)}")
+
+# Cosine similarity = 1 - cosine_distance (pgvector <=>).
+VEC_CHANNEL = Channel(
+    name="vec",
+    weight=0.45,
+    needs_qvec=True,
+    sql="""
+    SELECT
+      e.chunk_id AS chunk_id,
+      (1.0 - (e.embedding <=> (%(qvec)b)::vector(768))) AS s
+    FROM tac.embeddings e
+    WHERE e.user_id = %(user_id)s
+      AND e.model = %(model)s
+    ORDER BY e.embedding <=> (%(qvec)b)::vector(768)
+    LIMIT %(lim)s
+  """,
+)
+
+
+# Компактное хранение (миграция 012): halfvec — тот же HNSW по вдвое меньшим векторам;
+# bit(768) — HNSW по Hamming (в 32 раза меньше float), затем точный cosine по float-вектору
+# только для VECTOR_BINARY_RESCORE * lim кандидатов (не больше HNSW_EF_SEARCH_MAX — столько отдаст индекс).
+VEC_HALF_CHANNEL = Channel(
+    name="vec",
+    weight=VEC_CHANNEL.weight,
+    needs_qvec=True,
+    sql="""
+    SELECT
+      e.chunk_id AS chunk_id,
+      (1.0 - (e.embedding_half <=> (%(qvec)b)::vector(768)::halfvec(768))) AS s
+    FROM tac.embeddings e
+    WHERE e.user_id = %(user_id)s
+      AND e.model = %(model)s
+    ORDER BY e.embedding_half <=> (%(qvec)b)::vector(768)::halfvec(768)
+    LIMIT %(lim)s
+  """,
+)
+
+VEC_BINARY_CHANNEL = Channel(
+    name="vec",
+    weight=VEC_CHANNEL.weight,
+    needs_qvec=True,
+    params=lambda q: {"vec_rescore": max(1, VECTOR_BINARY_RESCORE), "vec_rescore_max": HNSW_EF_SEARCH_MAX},
+    sql="""
+    SELECT
+      b.chunk_id AS chunk_id,
+      (1.0 - (b.embedding <=> (%(qvec)b)::vector(768))) AS s
+    FROM (
+      SELECT e.chunk_id, e.embedding
+      FROM tac.embeddings e
+      WHERE e.user_id = %(user_id)s
+        AND e.model = %(model)s
+      ORDER BY e.embedding_bin <~> binary_quantize((%(qvec)b)::vector(768))::bit(768)
+      LIMIT LEAST(%(lim)s * %(vec_rescore)s, %(vec_rescore_max)s)
+    ) b
+    ORDER BY s DESC
+    LIMIT %(lim)s
+  """,
+)
+
+VEC_STORAGE_CHANNELS = {"float": VEC_CHANNEL, "half": VEC_HALF_CHANNEL, "binary": VEC_BINARY_CHANNEL}
+
+
+def hierarchical_vec_channel(shortlist: int = RETRIEVAL_DOC_SHORTLIST) -> Channel:
+    """
+    Векторный канал в две ступени: ANN по эмбеддингам документов (tac.document_embeddings, миграция 011),
+    затем точный перебор чанков только внутри `shortlist` лучших документов. ORDER BY по `s`, а не по
+    `<=>`, чтобы планировщик не ушёл в HNSW по всем чанкам с фильтром. Имя канала то же — "vec".
+    """
+    n = max(1, int(shortlist))
+    return Channel(
+        name="vec",
+        weight=VEC_CHANNEL.weight,
+        needs_qvec=True,
+        params=lambda q: {"vec_docs": n},
+        sql="""
+    SELECT
+      e.chunk_id AS chunk_id,
+      (1.0 - (e.embedding <=> (%(qvec)b)::vector(768))) AS s
+    FROM (
+      SELECT d.document_id
+      FROM tac.document_embeddings d
+      WHERE d.user_id = %(user_id)s
+        AND d.model = %(model)s
+      ORDER BY d.embedding <=> (%(qvec)b)::vector(768)
+      LIMIT %(vec_docs)s
+    ) d
+    JOIN tac.chunks c ON c.document_id = d.document_id
+    JOIN tac.embeddings e ON e.chunk_id = c.id AND e.model = %(model)s
+    ORDER BY s DESC
+    LIMIT %(lim)s
+  """,
+    )
+
+
+def vector_channel(name: str, shortlist: int = RETRIEVAL_DOC_SHORTLIST, storage: str = VECTOR_STORAGE) -> Channel:
+    """
+    Векторный канал по режиму (RETRIEVAL_VECTOR) и хранению (VECTOR_STORAGE). `storage` относится к flat:
+    во второй ступени hierarchical чанки перебираются точно по float-вектору, индекс чанков не нужен.
+    """
+    mode = (name or "flat").strip().lower()
+    if mode == "hierarchical":
+        return hierarchical_vec_channel(shortlist)
+    if mode != "flat":
+        raise ValueError(f"unknown vector mode {name!r}; expected one of: flat, hierarchical")
+    try:
+        return VEC_STORAGE_CHANNELS[(storage or "float").strip().lower()]
+    except KeyError:
+        raise ValueError(f"unknown vector storage {storage!r}; expected one of: {', '.join(VEC_STORAGE_CHANNELS)}")
+
+
+# Fusion: выражение итогового скора над колонками `comb` для каждого канала:
+# s_<ch> — сырой скор, r_<ch> — ранг внутри канала (1 = лучший), n_<ch> — min-max нормированный скор.
+# Канал не нашёл чанк -> NULL. Веса нормируются по активным каналам (без qvec остаётся только FTS).
+def _norm_weights(channels: Sequence[Channel]) -> list[tuple[Channel, float]]:
+    total = sum(ch.weight for ch in channels) or 1.0
+    return [(ch, ch.weight / total) for ch in channels]
+
+
+# Сущности запроса (те же regex, что у воркера, см. ner/). Порты/версии/crc шумные: любое число
+# в тексте — «порт», поэтому их вес ниже, и сами по себе они канал не включают: «что изменилось
+# в 2024» — обычный вопрос. Канал нужен, когда в запросе есть сильная сущность (IP, MAC, IMEI, hex)
+# или запрос целиком из идентификаторов (is_identifier_query).
+# Сущность, найденная внутри совпадения более длинной (октеты IP, «версия» 192.168.1 внутри IP),
+# отбрасываем: это тот же фрагмент текста. Отдельный «port 8080» рядом с IP остаётся.
+ENTITY_TYPE_WEIGHTS = {"port": 0.3, "crc": 0.3, "version": 0.6}
+_ENTITY_STRONG = ("ip", "mac", "imei", "hex")
+_ENTITY_CONTAINERS = ("ip", "mac", "imei", "hex", "version")
 
 
-def hybrid_retrieve(conn, user_id: int, query: str, top_k: int = 15) -> list[RetrievedChunk]:
+def _entity_params(q: str) -> Optional[dict[str, Any]]:
+    spans = extract_entity_spans(q)
+    containers = [(s, e) for et, _n, s, e in spans if et in _ENTITY_CONTAINERS]
+    kept: dict[tuple[str, str], float] = {}
+    for et, name, start, end in spans:
+        if any(cs <= start and end <= ce and (ce - cs) > (end - start) for cs, ce in containers):
+            continue
+        kept.setdefault((et, name), ENTITY_TYPE_WEIGHTS.get(et, 1.0))
+    if not kept:
+        return None
+    if not any(et in _ENTITY_STRONG for et, _ in kept) and not is_identifier_query(q):
+        return None
+    # Веса нормированы на сумму: скор канала (сумма весов совпавших сущностей) в [0, 1], как cosine.
+    total = sum(kept.values())
+    return {
+        "ent_types": [et for et, _ in kept],
+        "ent_names": [name for _, name in kept],
+        "ent_weights": [w / total for w in kept.values()],
+    }
+
+
+# Точное совпадение по tac.entities -> tac.chunk_entities (idx_tac_chunk_entities_entity, миграция 008).
+# На сущность берём не больше %(lim)s последних чанков пользователя, скор = сумма весов совпавших
+# сущностей (веса нормированы в _entity_params: 1.0 — чанк содержит все сущности запроса).
+ENTITY_CHANNEL = Channel(
+    name="ent",
+    weight=0.5,
+    params=_entity_params,
+    batch_params=("ent_types", "ent_names", "ent_weights"),
+    sql="""
+    SELECT hit.chunk_id AS chunk_id, sum(qe.w) AS s
+    FROM unnest(%(ent_types)s::text[], %(ent_names)s::text[], %(ent_weights)s::float8[]) AS qe(entity_type, name, w)
+    JOIN tac.entities en ON en.entity_type = qe.entity_type AND en.name = qe.name
+    CROSS JOIN LATERAL (
+      SELECT ce.chunk_id
+      FROM tac.chunk_entities ce
+      JOIN tac.chunks c ON c.id = ce.chunk_id
+      WHERE ce.entity_id = en.id
+        AND c.user_id = %(user_id)s
+      ORDER BY ce.chunk_id DESC
+      LIMIT %(lim)s
+    ) hit
+    GROUP BY hit.chunk_id
+    ORDER BY s DESC, hit.chunk_id DESC
+    LIMIT %(lim)s
+  """,
+)
+
+
+class WeightedSumFusion:
+    """
+    Взвешенная сумма сырых скоров каналов (как было в MVP: 0.55 * ts_rank + 0.45 * cosine).
+    ts_rank не ограничен и обычно много меньше cosine, поэтому FTS фактически недовзвешен.
+    """
+
+    name = "weighted"
+
+    def score_sql(self, channels: Sequence[Channel]) -> str:
+        return " + ".join(f"{w!r} * COALESCE(s_{ch.name}, 0.0)" for ch, w in _norm_weights(channels))
+
+
+class RrfFusion:
+    """Reciprocal rank fusion: sum(w / (k + rank)); не зависит от шкал скоров каналов."""
+
+    name = "rrf"
+
+    def __init__(self, k: int = RETRIEVAL_RRF_K):
+        self.k = max(1, int(k))
+
+    def score_sql(self, channels: Sequence[Channel]) -> str:
+        return " + ".join(f"COALESCE({w!r} / ({self.k} + r_{ch.name}), 0.0)" for ch, w in _norm_weights(channels))
+
+
+class MinMaxFusion:
+    """Взвешенная сумма скоров, нормированных min-max в [0, 1] внутри кандидатов каждого канала."""
+
+    name = "minmax"
+
+    def score_sql(self, channels: Sequence[Channel]) -> str:
+        return " + ".join(f"{w!r} * COALESCE(n_{ch.name}, 0.0)" for ch, w in _norm_weights(channels))
+
+
+FUSIONS = {"weighted": WeightedSumFusion, "rrf": RrfFusion, "minmax": MinMaxFusion}
+
+
+def make_fusion(name: str):
+    try:
+        return FUSIONS[(name or "weighted").strip().lower()]()
+    except KeyError:
+        raise ValueError(f"unknown fusion {name!r}; expected one of: {', '.join(FUSIONS)}")
+
+
+_CONTENTS_SQL = """
+SELECT id, CASE WHEN %(content_chars)s > 0 THEN left(chunk_text, %(content_chars)s) ELSE '' END
+FROM tac.chunks
+WHERE id = ANY(%(ids)s)
+"""
+
+
+@dataclass
+class RetrievalResult:
+    chunks: list[RetrievedChunk]
+    channels: list[str]
+    # Миллисекунды по стадиям: version (версия корпуса для кэша), embed (эмбеддинг запроса),
+    # db (скоринг + выборка текста), total.
+    timings_ms: dict[str, float]
+    # Кандидатов, запрошенных у каждого канала.
+    channel_limit: int = 0
+    # Результат из кэша retrieval (см. RetrievalEngine, op.corpus_versions).
+    cached: bool = False
+
+
+def _copy_result(res: RetrievalResult, **changes: Any) -> RetrievalResult:
+    # Кэш хранит результат без текста чанков (id, скоры, метаданные документа): размер записи не
+    # зависит от content_chars, а текст при попадании дочитывается второй фазой (load_chunk_contents).
+    chunks = [replace(c, content="", channel_scores=dict(c.channel_scores)) for c in res.chunks]
+    return replace(res, chunks=chunks, channels=list(res.channels), **changes)
+
+
+# Версия корпуса пользователя: воркер увеличивает её при завершении задачи индексации (миграция 010).
+_CORPUS_VERSION_SQL = "SELECT COALESCE((SELECT version FROM op.corpus_versions WHERE user_id = %s), 0)"
+
+
+class RetrievalEngine:
+    """
+    Единый гибридный retrieval для /api/v1/search, чата и бенчмарков.
+
+    SQL собирается из каналов: каждый канал — CTE (chunk_id, s), затем `comb` сводит скоры/ранги по
+    chunk_id, `top` ранжирует через fusion и режет до top_k, и только для top_k читается текст
+    (двухфазная выборка, см. `content_chars`). Кандидатов на канал: clamp(top_k * factor, min, max) —
+    маленькие запросы (search limit=10) не тянут по 200 строк из каждого канала.
+    Запросы идут server-side prepared (`prepare=True`): набор SQL-текстов конечен (по одному на
+    комбинацию активных каналов), повторный вызов на том же соединении пропускает parse/analyze.
+
+    Кэш результатов (cache_size > 0): ключ (user_id, нормализованный запрос, модель эмбеддингов, top_k,
+    версия корпуса пользователя). Версию поднимает воркер в той же транзакции, что и
+    новые чанки, поэтому после индексации старые записи просто перестают совпадать по ключу.
+    В записи только id и скоры (без текста), текст при попадании дочитывается по PK.
+    Повтор стоит PK-lookup версии и текста вместо эмбеддинга и всех каналов.
+    """
+
+    def __init__(
+        self,
+        channels: Sequence[Channel],
+        fusion: Any,
+        channel_factor: float = RETRIEVAL_CHANNEL_FACTOR,
+        channel_min: int = RETRIEVAL_CHANNEL_MIN,
+        channel_max: int = RETRIEVAL_CHANNEL_MAX,
+        skip_vec: Optional[Callable[[str], bool]] = None,
+        cache_size: int = RETRIEVAL_CACHE_SIZE,
+    ):
+        self.channels = list(channels)
+        self.fusion = fusion
+        self.channel_factor = float(channel_factor)
+        self.channel_min = max(1, int(channel_min))
+        self.channel_max = max(self.channel_min, int(channel_max))
+        # Предикат «эмбеддинг запроса не нужен» (например, запрос — голый IP/MAC).
+        self.skip_vec = skip_vec
+        self._sql_cache: dict[tuple[str, ...], str] = {}
+        self._cache = LruCache(cache_size)
+        self._lock = threading.Lock()
+        self._stats: dict[str, float] = {"queries": 0, "fallback_no_vec": 0, "skipped_vec": 0, "cache_hits": 0}
+        self._batch_stats: dict[str, float] = {"batches": 0, "queries": 0}
+
+    # --- SQL ---
+
+    def channel_limit(self, top_k: int) -> int:
+        return min(self.channel_max, max(self.channel_min, top_k, int(top_k * self.channel_factor)))
+
+    def _plan(self, q: str) -> tuple[dict[str, dict[str, Any]], bool]:
+        """Параметры каналов с `params` (нет ключа -> канал выключен) и нужен ли эмбеддинг запроса."""
+        ch_params: dict[str, dict[str, Any]] = {}
+        for ch in self.channels:
+            if ch.params is not None:
+                p = ch.params(q)
+                if p is not None:
+                    ch_params[ch.name] = p
+        want_vec = any(ch.needs_qvec for ch in self.channels) and not (self.skip_vec is not None and self.skip_vec(q))
+        return ch_params, want_vec
+
+    def _active(self, has_qvec: bool, ch_params: dict[str, dict[str, Any]]) -> list[Channel]:
+        return [
+            ch
+            for ch in self.channels
+            if (has_qvec or not ch.needs_qvec) and (ch.params is None or ch.name in ch_params)
+        ]
+
+    def _ranked_sql(self, channels: Sequence[Channel], sources: dict[str, str]) -> str:
+        """
+        Слияние каналов -> top_k: (chunk_id, score, s_<ch>...). `sources[ch.name]` — FROM-выражение
+        канала (имя CTE для одиночного запроса, подзапрос внутри LATERAL для пакета).
+        """
+        union = "\n        UNION ALL\n".join(
+            f"        SELECT chunk_id, '{ch.name}' AS ch, s::float8 AS s,"
+            f" row_number() OVER (ORDER BY s DESC) AS r,"
+            f" COALESCE((s - min(s) OVER ()) / NULLIF(max(s) OVER () - min(s) OVER (), 0), 1.0) AS n"
+            f" FROM {sources[ch.name]}"
+            for ch in channels
+        )
+        per_channel = ",\n".join(
+            f"        max(s) FILTER (WHERE ch = '{ch.name}') AS s_{ch.name},"
+            f" min(r) FILTER (WHERE ch = '{ch.name}') AS r_{ch.name},"
+            f" max(n) FILTER (WHERE ch = '{ch.name}') AS n_{ch.name}"
+            for ch in channels
+        )
+        s_cols = ", ".join(f"s_{ch.name}" for ch in channels)
+        return f"""
+    SELECT chunk_id, {self.fusion.score_sql(channels)} AS score, {s_cols}
+    FROM (
+      SELECT
+        chunk_id,
+{per_channel}
+      FROM (
+{union}
+      ) hits
+      GROUP BY chunk_id
+    ) comb
+    ORDER BY score DESC
+    LIMIT %(top_k)s
+  """
+
+    @staticmethod
+    def _select_cols(channels: Sequence[Channel]) -> str:
+        top_s_cols = ", ".join(f"top.s_{ch.name}" for ch in channels)
+        return f"""
+  c.id, d.id, d.title, d.uri,
+  CASE WHEN %(content_chars)s > 0 THEN left(c.chunk_text, %(content_chars)s) ELSE '' END,
+  top.score,
+  c.chunk_sha256,
+  d.source, d.doc_type, d.source_ref,
+  {top_s_cols}"""
+
+    def build_sql(self, channels: Sequence[Channel]) -> str:
+        key = tuple(ch.name for ch in channels)
+        sql = self._sql_cache.get(key)
+        if sql is not None:
+            return sql
+        ranked = self._ranked_sql(channels, {ch.name: ch.name for ch in channels})
+        sql = (
+            "WITH\n"
+            + ",\n".join(ch.cte() for ch in channels)
+            + f""",
+  top AS ({ranked})
+SELECT{self._select_cols(channels)}
+FROM top
+JOIN tac.chunks c ON c.id = top.chunk_id
+JOIN tac.documents d ON d.id = c.document_id
+ORDER BY top.score DESC
+"""
+        )
+        self._sql_cache[key] = sql
+        return sql
+
+    def build_batch_sql(self, channels: Sequence[Channel]) -> str:
+        """
+        Пакет запросов одним statement: unnest(тексты, векторы, jsonb-параметры) WITH ORDINALITY и
+        LATERAL с тем же слиянием каналов на каждый запрос. В SQL каналов %(q)s / %(qvec)b заменяются
+        на колонки qi, параметры из `Channel.batch_params` — на массивы из qi.p (jsonb запроса).
+        """
+        key = ("batch",) + tuple(ch.name for ch in channels)
+        sql = self._sql_cache.get(key)
+        if sql is not None:
+            return sql
+        has_vec = any(ch.needs_qvec for ch in channels)
+        sources = {}
+        for ch in channels:
+            body = ch.sql.replace("%(lim)s", f"%(lim_{ch.name})s").replace("%(q)s", "qi.q").replace("%(qvec)b", "qi.qvec")
+            for name in ch.batch_params:
+                body = body.replace(f"%({name})s", f"ARRAY(SELECT jsonb_array_elements_text(qi.p -> '{name}'))")
+            sources[ch.name] = f"({body}) {ch.name}"
+        if has_vec:
+            qi = "unnest(%(qs)s::text[], %(qvecs)s::vector(768)[], %(qps)s::jsonb[]) WITH ORDINALITY AS qi(q, qvec, p, ord)"
+        else:
+            qi = "unnest(%(qs)s::text[], %(qps)s::jsonb[]) WITH ORDINALITY AS qi(q, p, ord)"
+        sql = f"""
+SELECT qi.ord,{self._select_cols(channels)}
+FROM {qi}
+CROSS JOIN LATERAL ({self._ranked_sql(channels, sources)}) top
+JOIN tac.chunks c ON c.id = top.chunk_id
+JOIN tac.documents d ON d.id = c.document_id
+ORDER BY qi.ord, top.score DESC
+"""
+        self._sql_cache[key] = sql
+        return sql
+
+    def _params(
+        self,
+        q: str,
+        user_id: int,
+        top_k: int,
+        qvec: Optional[Any],
+        model: Optional[str],
+        content_chars: Optional[int],
+        channels: Sequence[Channel],
+        limit: int,
+        ch_params: dict[str, dict[str, Any]],
+    ) -> dict[str, Any]:
+        params: dict[str, Any] = {
+            "q": q,
+            "user_id": user_id,
+            "top_k": top_k,
+            "content_chars": FULL_CONTENT if content_chars is None else max(0, int(content_chars)),
+        }
+        for ch in channels:
+            params[f"lim_{ch.name}"] = limit
+            params.update(ch_params.get(ch.name, {}))
+        if qvec is not None:
+            params.update({"qvec": qvec, "model": model})
+        return params
+
+    @staticmethod
+    def _rows_to_chunks(rows, channels: Sequence[Channel]) -> list[RetrievedChunk]:
+        out: list[RetrievedChunk] = []
+        for r in rows:
+            scores = {ch.name: float(v) for ch, v in zip(channels, r[10:]) if v is not None}
+            out.append(
+                RetrievedChunk(
+                    chunk_id=int(r[0]),
+                    doc_id=int(r[1]),
+                    title=r[2],
+                    uri=r[3],
+                    content=r[4] or "",
+                    score=float(r[5] or 0.0),
+                    chunk_sha256=r[6],
+                    source=r[7],
+                    doc_type=r[8],
+                    source_ref=r[9],
+                    channel_scores=scores,
+                )
+            )
+        return out
+
+    # --- stats ---
+
+    def _record(self, timings_ms: dict[str, float], want_vec: bool, used_vec: bool, cached: bool = False) -> None:
+        with self._lock:
+            self._stats["queries"] += 1
+            if cached:
+                self._stats["cache_hits"] += 1
+            elif not want_vec:
+                self._stats["skipped_vec"] += 1
+            elif not used_vec:
+                self._stats["fallback_no_vec"] += 1
+            for k, v in timings_ms.items():
+                self._stats[f"{k}_ms_total"] = self._stats.get(f"{k}_ms_total", 0.0) + v
+                self._stats[f"{k}_ms_max"] = max(self._stats.get(f"{k}_ms_max", 0.0), v)
+
+    def _record_batch(self, timings_ms: dict[str, float], n: int) -> None:
+        with self._lock:
+            self._batch_stats["batches"] += 1
+            self._batch_stats["queries"] += n
+            for k, v in timings_ms.items():
+                self._batch_stats[f"{k}_ms_total"] = self._batch_stats.get(f"{k}_ms_total", 0.0) + v
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+            b = dict(self._batch_stats)
+        n = int(s.pop("queries"))
+        out: dict[str, Any] = {
+            "channels": [ch.name for ch in self.channels],
+            "fusion": self.fusion.name,
+            "channel_factor": self.channel_factor,
+            "channel_min": self.channel_min,
+            "channel_max": self.channel_max,
+            "queries": n,
+            "fallback_no_vec": int(s.pop("fallback_no_vec")),
+            "skipped_vec": int(s.pop("skipped_vec")),
+            "cache_hits": int(s.pop("cache_hits")),
+            "cache": self._cache.stats(),
+        }
+        for k, v in s.items():
+            if k.endswith("_ms_total"):
+                out[k.replace("_ms_total", "_ms_avg")] = round(v / n, 2) if n else 0.0
+            else:
+                out[k] = round(v, 2)
+        nb = int(b.pop("batches"))
+        out["batch"] = {"batches": nb, "queries": int(b.pop("queries"))}
+        for k, v in b.items():
+            out["batch"][k.replace("_ms_total", "_ms_avg")] = round(v / nb, 2) if nb else 0.0
+        return out
+
+    # --- retrieval ---
+
+    @staticmethod
+    def _top_k(top_k: int) -> int:
+        # We use top-N for reranker (default 50). Keep a safe upper bound to avoid abuse.
+        return max(1, min(200, int(top_k)))
+
+    def _prepare(self, query: str, top_k: int) -> tuple[str, int]:
+        return (query or "").strip(), self._top_k(top_k)
+
+    def _cache_key(self, user_id: int, q: str, top_k: int, version: int) -> tuple:
+        return (int(user_id), normalize_query(q), EMBEDDINGS_MODEL, top_k, int(version))
+
+    def _cache_get(self, key: tuple) -> Optional[RetrievalResult]:
+        hit = self._cache.get(key)
+        return None if hit is None else _copy_result(hit, cached=True)
+
+    def _cache_done(self, hit: RetrievalResult, t0: float, tv: float) -> RetrievalResult:
+        """Тайминги попадания: version — lookup версии, db — дочитка текста."""
+        t2 = time.perf_counter()
+        hit.timings_ms = {
+            "version": round((tv - t0) * 1000.0, 2),
+            "db": round((t2 - tv) * 1000.0, 2),
+            "total": round((t2 - t0) * 1000.0, 2),
+        }
+        self._record(hit.timings_ms, True, True, cached=True)
+        return hit
+
+    def retrieve(self, conn, user_id: int, query: str, top_k: int = 15, content_chars: Optional[int] = None) -> RetrievalResult:
+        """
+        `content_chars`: None = полный текст, N = первые N символов, 0 = только id/скоры
+        (текст потом догружается через `load_chunk_contents` для оставшихся после rerank).
+        """
+        q, top_k = self._prepare(query, top_k)
+        if not q:
+            return RetrievalResult([], [], {})
+        t0 = time.perf_counter()
+        key = None
+        if self._cache.enabled:
+            with conn.cursor() as cur:
+                cur.execute(_CORPUS_VERSION_SQL, (user_id,), prepare=True)
+                key = self._cache_key(user_id, q, top_k, cur.fetchone()[0])
+            hit = self._cache_get(key)
+            if hit is not None:
+                tv = time.perf_counter()
+                if content_chars != 0:
+                    load_chunk_contents(conn, hit.chunks, content_chars)
+                return self._cache_done(hit, t0, tv)
+        tv = time.perf_counter()
+        ch_params, want_vec = self._plan(q)
+        qvec, model = _embed_query(q) if want_vec else (None, None)
+        t1 = time.perf_counter()
+        channels = self._active(qvec is not None, ch_params)
+        sql = self.build_sql(channels)
+        limit = self.channel_limit(top_k)
+        params = self._params(q, user_id, top_k, qvec, model, content_chars, channels, limit, ch_params)
+        # Pipeline: set_config(ef_search) и основной запрос уходят одним round trip.
+        with conn.pipeline(), conn.cursor() as cur:
+            if qvec is not None:
+                cur.execute(*vector_settings(limit), prepare=True)
+            cur.execute(sql, params, prepare=True)
+            rows = cur.fetchall()
+        return self._finish(rows, channels, limit, want_vec, qvec is not None, key, t0, tv, t1)
+
+    async def aretrieve(self, aconn, user_id: int, query: str, top_k: int = 15, content_chars: Optional[int] = None) -> RetrievalResult:
+        """То же, что `retrieve`, но на async-соединении; эмбеддинг запроса — через батчер эмбеддера."""
+        q, top_k = self._prepare(query, top_k)
+        if not q:
+            return RetrievalResult([], [], {})
+        t0 = time.perf_counter()
+        ch_params, want_vec = self._plan(q)
+        # Эмбеддинг стартует до первого запроса к БД и идёт параллельно с проверкой версии корпуса;
+        # транзакция версии закрывается сразу, чтобы соединение не висело idle in transaction на батчере.
+        embed = asyncio.ensure_future(_aembed_query(q)) if want_vec else None
+        key = None
+        if self._cache.enabled:
+            async with aconn.cursor() as cur:
+                await cur.execute(_CORPUS_VERSION_SQL, (user_id,), prepare=True)
+                key = self._cache_key(user_id, q, top_k, (await cur.fetchone())[0])
+            await aconn.commit()
+            hit = self._cache_get(key)
+            if hit is not None:
+                if embed is not None:
+                    embed.cancel()
+                tv = time.perf_counter()
+                if content_chars != 0:
+                    await aload_chunk_contents(aconn, hit.chunks, content_chars)
+                return self._cache_done(hit, t0, tv)
+        tv = time.perf_counter()
+        qvec, model = (await embed) if embed is not None else (None, None)
+        t1 = time.perf_counter()
+        channels = self._active(qvec is not None, ch_params)
+        sql = self.build_sql(channels)
+        limit = self.channel_limit(top_k)
+        params = self._params(q, user_id, top_k, qvec, model, content_chars, channels, limit, ch_params)
+        async with aconn.pipeline(), aconn.cursor() as cur:
+            if qvec is not None:
+                await cur.execute(*vector_settings(limit), prepare=True)
+            await cur.execute(sql, params, prepare=True)
+            rows = await cur.fetchall()
+        return self._finish(rows, channels, limit, want_vec, qvec is not None, key, t0, tv, t1)
+
+    def _finish(
+        self,
+        rows,
+        channels: Sequence[Channel],
+        limit: int,
+        want_vec: bool,
+        used_vec: bool,
+        key: Optional[tuple],
+        t0: float,
+        tv: float,
+        t1: float,
+    ) -> RetrievalResult:
+        t2 = time.perf_counter()
+        timings = {
+            "version": round((tv - t0) * 1000.0, 2),
+            "embed": round((t1 - tv) * 1000.0, 2),
+            "db": round((t2 - t1) * 1000.0, 2),
+            "total": round((t2 - t0) * 1000.0, 2),
+        }
+        self._record(timings, want_vec, used_vec)
+        res = RetrievalResult(self._rows_to_chunks(rows, channels), [ch.name for ch in channels], timings, limit)
+        # Деградированный результат (эмбеддер упал/не успел -> без vec) не кэшируем.
+        if key is not None and (used_vec or not want_vec):
+            self._cache.put(key, _copy_result(res))
+        return res
+
+
+    # --- batch ---
+
+    def _batch_begin(self, queries: Sequence[str], top_k: int) -> tuple[list[str], int, list[Optional[RetrievalResult]]]:
+        qs = [(q or "").strip() for q in queries]
+        return qs, self._top_k(top_k), [None if q else RetrievalResult([], [], {}) for q in qs]
+
+    def _batch_cache(
+        self,
+        results: list[Optional[RetrievalResult]],
+        qs: list[str],
+        user_id: int,
+        top_k: int,
+        version: int,
+    ) -> tuple[dict[int, tuple], list[RetrievalResult]]:
+        """Попадания кладутся в `results` (без текста); возвращает ключи промахов и список попаданий."""
+        keys: dict[int, tuple] = {}
+        hits: list[RetrievalResult] = []
+        for i, q in enumerate(qs):
+            if results[i] is not None:
+                continue
+            key = self._cache_key(user_id, q, top_k, version)
+            hit = self._cache_get(key)
+            if hit is not None:
+                results[i] = hit
+                hits.append(hit)
+            else:
+                keys[i] = key
+        return keys, hits
+
+    def _batch_request(
+        self,
+        qs: list[str],
+        plans: list[tuple[dict[str, dict[str, Any]], bool]],
+        user_id: int,
+        top_k: int,
+        content_chars: Optional[int],
+        qvecs: Optional[list],
+        model: Optional[str],
+    ) -> tuple[list[Channel], dict[str, Any], int]:
+        wanted = {name for ch_params, _ in plans for name in ch_params}
+        channels = [
+            ch
+            for ch in self.channels
+            if (qvecs is not None or not ch.needs_qvec) and (ch.params is None or ch.name in wanted)
+        ]
+        limit = self.channel_limit(top_k)
+        params: dict[str, Any] = {
+            "qs": qs,
+            "user_id": user_id,
+            "top_k": top_k,
+            "content_chars": FULL_CONTENT if content_chars is None else max(0, int(content_chars)),
+        }
+        qps = []
+        for ch_params, _ in plans:
+            p: dict[str, Any] = {}
+            for ch in channels:
+                for k, v in ch_params.get(ch.name, {}).items():
+                    if k in ch.batch_params:
+                        p[k] = v
+                    else:
+                        params[k] = v
+            qps.append(Jsonb(p))
+        params["qps"] = qps
+        for ch in channels:
+            params[f"lim_{ch.name}"] = limit
+        if qvecs is not None:
+            params.update({"qvecs": list(qvecs), "model": model})
+        return channels, params, limit
+
+    def _batch_finish(
+        self,
+        results: list[Optional[RetrievalResult]],
+        todo: list[int],
+        rows,
+        channels: Sequence[Channel],
+        limit: int,
+        want_vec: bool,
+        used_vec: bool,
+        keys: dict[int, tuple],
+        t0: float,
+        tv: float,
+        t1: float,
+    ) -> list[RetrievalResult]:
+        t2 = time.perf_counter()
+        timings = {
+            "version": round((tv - t0) * 1000.0, 2),
+            "embed": round((t1 - tv) * 1000.0, 2),
+            "db": round((t2 - t1) * 1000.0, 2),
+            "total": round((t2 - t0) * 1000.0, 2),
+        }
+        self._record_batch(timings, len(todo))
+        by_ord: dict[int, list] = {}
+        for r in rows:
+            by_ord.setdefault(int(r[0]), []).append(r[1:])
+        names = [ch.name for ch in channels]
+        for j, i in enumerate(todo, start=1):
+            res = RetrievalResult(self._rows_to_chunks(by_ord.get(j, []), channels), list(names), dict(timings), limit)
+            if i in keys and (used_vec or not want_vec):
+                self._cache.put(keys[i], _copy_result(res))
+            results[i] = res
+        return results  # type: ignore[return-value]
+
+    def retrieve_batch(
+        self, conn, user_id: int, queries: Sequence[str], top_k: int = 15, content_chars: Optional[int] = None
+    ) -> list[RetrievalResult]:
+        """
+        Пакет запросов: один вызов эмбеддера на все тексты и один SQL statement (см. build_batch_sql).
+        Результаты в порядке `queries`; timings_ms у каждого — общие для пакета.
+        Отличия от `retrieve`: эмбеддинг считается для всех запросов пакета (skip_vec не применяется),
+        веса fusion нормируются по каналам, активным хотя бы для одного запроса.
+        """
+        qs, top_k, results = self._batch_begin(queries, top_k)
+        t0 = time.perf_counter()
+        keys: dict[int, tuple] = {}
+        if self._cache.enabled and any(r is None for r in results):
+            with conn.cursor() as cur:
+                cur.execute(_CORPUS_VERSION_SQL, (user_id,), prepare=True)
+                keys, hits = self._batch_cache(results, qs, user_id, top_k, cur.fetchone()[0])
+            if hits:
+                tv = time.perf_counter()
+                if content_chars != 0:
+                    load_chunk_contents(conn, [c for h in hits for c in h.chunks], content_chars)
+                for h in hits:
+                    self._cache_done(h, t0, tv)
+        todo = [i for i, r in enumerate(results) if r is None]
+        if not todo:
+            return results  # type: ignore[return-value]
+        tv = time.perf_counter()
+        plans = [self._plan(qs[i]) for i in todo]
+        want_vec = any(w for _, w in plans)
+        qvecs, model = _embed_queries([qs[i] for i in todo]) if want_vec else (None, None)
+        t1 = time.perf_counter()
+        channels, params, limit = self._batch_request([qs[i] for i in todo], plans, user_id, top_k, content_chars, qvecs, model)
+        with conn.pipeline(), conn.cursor() as cur:
+            if qvecs is not None:
+                cur.execute(*vector_settings(limit), prepare=True)
+            cur.execute(self.build_batch_sql(channels), params, prepare=True)
+            rows = cur.fetchall()
+        return self._batch_finish(results, todo, rows, channels, limit, want_vec, qvecs is not None, keys, t0, tv, t1)
+
+    async def aretrieve_batch(
+        self, aconn, user_id: int, queries: Sequence[str], top_k: int = 15, content_chars: Optional[int] = None
+    ) -> list[RetrievalResult]:
+        """То же, что `retrieve_batch`, на async-соединении."""
+        qs, top_k, results = self._batch_begin(queries, top_k)
+        t0 = time.perf_counter()
+        keys: dict[int, tuple] = {}
+        if self._cache.enabled and any(r is None for r in results):
+            async with aconn.cursor() as cur:
+                await cur.execute(_CORPUS_VERSION_SQL, (user_id,), prepare=True)
+                keys, hits = self._batch_cache(results, qs, user_id, top_k, (await cur.fetchone())[0])
+            if hits:
+                tv = time.perf_counter()
+                if content_chars != 0:
+                    await aload_chunk_contents(aconn, [c for h in hits for c in h.chunks], content_chars)
+                for h in hits:
+                    self._cache_done(h, t0, tv)
+            # Не держим транзакцию открытой, пока пакет ждёт эмбеддер (см. aretrieve).
+            await aconn.commit()
+        todo = [i for i, r in enumerate(results) if r is None]
+        if not todo:
+            return results  # type: ignore[return-value]
+        tv = time.perf_counter()
+        plans = [self._plan(qs[i]) for i in todo]
+        want_vec = any(w for _, w in plans)
+        qvecs, model = (await _aembed_queries([qs[i] for i in todo])) if want_vec else (None, None)
+        t1 = time.perf_counter()
+        channels, params, limit = self._batch_request([qs[i] for i in todo], plans, user_id, top_k, content_chars, qvecs, model)
+        async with aconn.pipeline(), aconn.cursor() as cur:
+            if qvecs is not None:
+                await cur.execute(*vector_settings(limit), prepare=True)
+            await cur.execute(self.build_batch_sql(channels), params, prepare=True)
+            rows = await cur.fetchall()
+        return self._batch_finish(results, todo, rows, channels, limit, want_vec, qvecs is not None, keys, t0, tv, t1)
+
+
+_ENGINE: Optional[RetrievalEngine] = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_engine() -> RetrievalEngine:
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = RetrievalEngine(
+                channels=[lexical_channel(RETRIEVAL_LEXICAL), vector_channel(RETRIEVAL_VECTOR), ENTITY_CHANNEL],
+                fusion=make_fusion(RETRIEVAL_FUSION),
+                skip_vec=is_identifier_query,
+            )
+        return _ENGINE
+
+
+def retrieval_stats() -> dict[str, Any]:
+    return get_engine().stats()
+
+
+def _embed_query(q: str) -> tuple[Optional[Any], Optional[str]]:
+    """
+    Возвращает (qvec, model) для векторного канала или (None, None) -> FTS-only.
+    qvec — numpy float32, передаётся в Postgres бинарно (pgvector адаптер регистрируется в пуле, см. db.py).
+    """
+    embedder = get_embedder()
+    if embedder is None:
+        return None, None
+    # DB schema currently fixed to vector(768). If config/model differs, fall back to FTS-only.
+    if int(getattr(embedder, "dims", 0) or 0) != 768:
+        return None, None
+    try:
+        return embedder.embed_query(q), embedder.model_name
+    except Exception:
+        # FTS-only fallback on any embedder failure.
+        return None, None
+
+
+async def _aembed_query(q: str) -> tuple[Optional[Any], Optional[str]]:
+    """
+    Async-вариант `_embed_query`: запрос уходит в батчер эмбеддера (склейка с конкурентными запросами),
+    event loop только ждёт Future. Первая загрузка модели выполняется в пуле инференса.
+    """
+    try:
+        if not embedder_loaded():
+            await run_inference(get_embedder, timeout=EMBED_QUERY_TIMEOUT_S)
+        embedder = get_embedder()
+        if embedder is None or int(getattr(embedder, "dims", 0) or 0) != 768:
+            return None, None
+        qvec = await asyncio.wait_for(asyncio.wrap_future(embedder.submit_query(q)), EMBED_QUERY_TIMEOUT_S)
+        return qvec, embedder.model_name
+    except Exception:
+        # FTS-only fallback on any embedder failure or timeout.
+        return None, None
+
+
+def _embed_queries(qs: list[str]) -> tuple[Optional[list], Optional[str]]:
+    """Пакетный `_embed_query`: все тексты одним вызовом модели; (None, None) -> без векторного канала."""
+    embedder = get_embedder()
+    if embedder is None or int(getattr(embedder, "dims", 0) or 0) != 768:
+        return None, None
+    try:
+        return embedder.submit_queries(qs).result(), embedder.model_name
+    except Exception:
+        return None, None
+
+
+async def _aembed_queries(qs: list[str]) -> tuple[Optional[list], Optional[str]]:
+    try:
+        if not embedder_loaded():
+            await run_inference(get_embedder, timeout=EMBED_QUERY_TIMEOUT_S)
+        embedder = get_embedder()
+        if embedder is None or int(getattr(embedder, "dims", 0) or 0) != 768:
+            return None, None
+        qvecs = await asyncio.wait_for(asyncio.wrap_future(embedder.submit_queries(qs)), EMBED_QUERY_TIMEOUT_S)
+        return qvecs, embedder.model_name
+    except Exception:
+        return None, None
+
+
+def hybrid_retrieve(conn, user_id: int, query: str, top_k: int = 15, content_chars: Optional[int] = None) -> list[RetrievedChunk]:
     """
     Этап 1:
     - FTS поиск по `tac.chunks.tsv`
     - Векторный поиск (pgvector) по `tac.embeddings` (локальные sentence-transformers).
+    - Точное совпадение сущностей запроса (IP/MAC/IMEI/...) по `tac.chunk_entities`.
+    Обёртка над `get_engine().retrieve(...)`, возвращает только чанки.
     """
-    q = (query or "").strip()
-    if not q:
-        return []
-    # We use top-N for reranker (default 50). Keep a safe upper bound to avoid abuse.
-    top_k = max(1, min(200, int(top_k)))
+    return get_engine().retrieve(conn, user_id, query, top_k=top_k, content_chars=content_chars).chunks
+
+
+def _contents_params(chunks, content_chars: Optional[int]) -> dict[str, Any]:
+    return {
+        "ids": [int(c.chunk_id) for c in chunks],
+        "content_chars": FULL_CONTENT if content_chars is None else max(0, int(content_chars)),
+    }
 
-    embedder = get_embedder()
-    qvec_txt: Optional[str] = None
-    model: Optional[str] = None
-    if embedder is not None:
-        # DB schema currently fixed to vector(768). If config/model differs, fall back to FTS-only.
-        if int(getattr(embedder, "dims", 0) or 0) != 768:
-            embedder = None
-        else:
-            try:
-                qvec = embedder.embed_query(q)
-                qvec_txt = pgvector_text(qvec)
-                model = embedder.model_name
-            except Exception:
-                # FTS-only fallback on any embedder failure.
-                qvec_txt = None
-                model = None
 
+def _apply_contents(chunks, rows) -> None:
+    by_id = {int(r[0]): (r[1] or "") for r in rows}
+    for c in chunks:
+        c.content = by_id.get(int(c.chunk_id), c.content)
+
+
+def load_chunk_contents(conn, chunks, content_chars: Optional[int] = None) -> None:
+    """Вторая фаза: дочитать текст (in place) для выживших чанков/кандидатов (нужен атрибут chunk_id/content)."""
+    if not chunks:
+        return
     with conn.cursor() as cur:
-        if qvec_txt and model:
-            # Hybrid:
-            # - FTS score: ts_rank
-            # - Vector score: cosine similarity = 1 - cosine_distance (pgvector <=>)
-            # Combined score is a weighted sum; weights are pragmatic defaults for MVP.
-            cur.execute(
-                """
-                WITH
-                  fts AS (
-                    SELECT
-                      c.id AS chunk_id,
-                      ts_rank(c.tsv, plainto_tsquery('simple', %(q)s)) AS s_fts
-                    FROM tac.chunks c
-                    JOIN tac.documents d ON d.id = c.document_id
-                    WHERE d.user_id = %(user_id)s
-                      AND c.tsv @@ plainto_tsquery('simple', %(q)s)
-                    ORDER BY s_fts DESC
-                    LIMIT 200
-                  ),
-                  vec AS (
-                    SELECT
-                      e.chunk_id AS chunk_id,
-                      (1.0 - (e.embedding <=> (%(qvec)s)::vector(768))) AS s_vec
-                    FROM tac.embeddings e
-                    JOIN tac.chunks c ON c.id = e.chunk_id
-                    JOIN tac.documents d ON d.id = c.document_id
-                    WHERE d.user_id = %(user_id)s
-                      AND e.model = %(model)s
-                    ORDER BY e.embedding <=> (%(qvec)s)::vector(768)
-                    LIMIT 200
-                  ),
-                  comb AS (
-                    SELECT
-                      COALESCE(fts.chunk_id, vec.chunk_id) AS chunk_id,
-                      COALESCE(fts.s_fts, 0.0) AS s_fts,
-                      COALESCE(vec.s_vec, 0.0) AS s_vec,
-                      (0.55 * COALESCE(fts.s_fts, 0.0) + 0.45 * COALESCE(vec.s_vec, 0.0)) AS score
-                    FROM fts
-                    FULL OUTER JOIN vec ON vec.chunk_id = fts.chunk_id
-                  )
-                SELECT
-                  c.id AS chunk_id,
-                  d.id AS doc_id,
-                  d.title AS title,
-                  d.uri AS uri,
-                  c.chunk_text AS content,
-                  comb.score AS score
-                FROM comb
-                JOIN tac.chunks c ON c.id = comb.chunk_id
-                JOIN tac.documents d ON d.id = c.document_id
-                WHERE d.user_id = %(user_id)s
-                ORDER BY comb.score DESC
-                LIMIT %(top_k)s
-                """,
-                {"q": q, "user_id": user_id, "top_k": top_k, "qvec": qvec_txt, "model": model},
-            )
+        cur.execute(_CONTENTS_SQL, _contents_params(chunks, content_chars), prepare=True)
+        _apply_contents(chunks, cur.fetchall())
+
+
+async def aload_chunk_contents(aconn, chunks, content_chars: Optional[int] = None) -> None:
+    if not chunks:
+        return
+    async with aconn.cursor() as cur:
+        await cur.execute(_CONTENTS_SQL, _contents_params(chunks, content_chars), prepare=True)
+        _apply_contents(chunks, await cur.fetchall())
+
+
+def vector_neighbours(
+    conn,
+    user_id: int,
+    qvec: Any,
+    model: str,
+    k: int,
+    ef_search: Optional[int] = None,
+    exact: bool = False,
+    doc_shortlist: Optional[int] = None,
+    storage: str = "float",
+    binary_rescore: Optional[int] = None,
+) -> list[tuple[int, float]]:
+    """
+    Только векторный канал: [(chunk_id, cosine_similarity)] для бенчмарков ANN vs exact,
+    flat vs hierarchical и хранения float / half / binary.
+    exact=True отключает index scan в транзакции -> точный перебор (эталон для recall).
+    doc_shortlist=N -> иерархический канал (N документов, затем чанки внутри них).
+    binary_rescore -> глубина пересчёта для storage="binary" вместо VECTOR_BINARY_RESCORE.
+    """
+    ch = hierarchical_vec_channel(doc_shortlist) if doc_shortlist else vector_channel("flat", storage=storage)
+    params = {"qvec": qvec, "user_id": user_id, "model": model, "lim": int(k)}
+    params.update(ch.params("") if ch.params is not None else {})
+    if binary_rescore is not None and "vec_rescore" in params:
+        params["vec_rescore"] = max(1, int(binary_rescore))
+    with conn.pipeline(), conn.cursor() as cur:
+        if exact:
+            cur.execute("SELECT set_config('enable_indexscan', 'off', true)")
         else:
-            cur.execute(
-                """
-                SELECT
-                  c.id AS chunk_id,
-                  d.id AS doc_id,
-                  d.title AS title,
-                  d.uri AS uri,
-                  c.chunk_text AS content,
-                  ts_rank(c.tsv, plainto_tsquery('simple', %s)) AS score
-                FROM tac.chunks c
-                JOIN tac.documents d ON d.id = c.document_id
-                WHERE d.user_id = %s
-                  AND c.tsv @@ plainto_tsquery('simple', %s)
-                ORDER BY score DESC
-                LIMIT %s
-                """,
-                (q, user_id, q, top_k),
-            )
+            cur.execute(*vector_settings(k, ef_search))
+        cur.execute(ch.sql, params)
         rows = cur.fetchall()
-
-    out: list[RetrievedChunk] = []
-    for r in rows:
-        out.append(
-            RetrievedChunk(
-                chunk_id=int(r[0]),
-                doc_id=int(r[1]),
-                title=r[2],
-                uri=r[3],
-                content=r[4] or "",
-                score=float(r[5] or 0.0),
-            )
-        )
-    return out
+    return [(int(r[0]), float(r[1])) for r in rows]
@@ -0,0 +1,17 @@
+-- KB-RING миграция 006: HNSW вместо ivfflat для tac.embeddings.
+-- ivfflat из 004 создавался на пустой таблице: списки не обучены на реальных данных, recall падает с ростом корпуса.
+-- HNSW не требует обучения и корректно дополняется при вставках.
+--
+-- На большой таблице вместо этой миграции используйте онлайн-пересборку без блокировки записи:
+--   python scripts/rebuild_vector_index.py --m 16 --ef-construction 64
+-- Поиск: `hnsw.ef_search` выставляется на запрос из hybrid_retrieve (VECTOR_EF_SEARCH).
+
+BEGIN;
+
+DROP INDEX IF EXISTS tac.idx_tac_embeddings_vec_cos;
+
+CREATE INDEX IF NOT EXISTS idx_tac_embeddings_vec_hnsw
+  ON tac.embeddings USING hnsw (embedding vector_cosine_ops)
+  WITH (m = 16, ef_construction = 64);
+
+COMMIT;
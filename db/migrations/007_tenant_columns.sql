@@ -0,0 +1,28 @@
+-- KB-RING миграция 007: user_id прямо в tac.chunks и tac.embeddings (денормализация из tac.documents).
+-- Векторный канал фильтрует по e.user_id/e.model без JOIN на chunks/documents; поддерживает воркер.
+--
+-- Для крупных пользователей можно построить отдельный частичный HNSW-индекс:
+--   python scripts/rebuild_vector_index.py --user-id <id>
+-- Остальные обслуживает общий индекс с iterative scan (pgvector >= 0.8, VECTOR_ITERATIVE_SCAN).
+
+BEGIN;
+
+ALTER TABLE tac.chunks ADD COLUMN IF NOT EXISTS user_id BIGINT;
+ALTER TABLE tac.embeddings ADD COLUMN IF NOT EXISTS user_id BIGINT;
+
+UPDATE tac.chunks c
+SET user_id = d.user_id
+FROM tac.documents d
+WHERE d.id = c.document_id
+  AND c.user_id IS DISTINCT FROM d.user_id;
+
+UPDATE tac.embeddings e
+SET user_id = c.user_id
+FROM tac.chunks c
+WHERE c.id = e.chunk_id
+  AND e.user_id IS DISTINCT FROM c.user_id;
+
+CREATE INDEX IF NOT EXISTS idx_tac_chunks_user ON tac.chunks(user_id);
+CREATE INDEX IF NOT EXISTS idx_tac_embeddings_user_model ON tac.embeddings(user_id, model);
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- KB-RING миграция 008: поиск чанков по сущности (entity-канал retrieval).
+-- PK (chunk_id, entity_id) не помогает при поиске по entity_id; индекс (entity_id, chunk_id)
+-- отдаёт последние чанки сущности index-only scan'ом.
+
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS idx_tac_chunk_entities_entity
+  ON tac.chunk_entities(entity_id, chunk_id);
+
+COMMIT;
@@ -0,0 +1,69 @@
+-- KB-RING миграция 009: лексический индекс BM25 (RETRIEVAL_LEXICAL=bm25) вместо ts_rank по всем совпадениям.
+-- Постинги хранят готовый BM25 tf-компонент (impact) и упорядочены по нему в индексе: запрос читает
+-- по каждому терму только top-N постингов (ранняя остановка), idf считается по tac.lex_terms/tac.lex_stats.
+-- Статистику инкрементально ведёт воркер (при индексации документа); impact зафиксирован со средней
+-- длиной чанка на момент индексации — пересчёт: python scripts/rebuild_lexicon.py.
+--
+-- Термы — лексемы to_tsvector('simple', chunk_text), т.е. ровно содержимое tac.chunks.tsv.
+-- BM25: k1 = 1.2, b = 0.75 (воркер: LEXICAL_BM25_K1 / LEXICAL_BM25_B).
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS tac.lex_stats (
+  user_id BIGINT PRIMARY KEY,
+  n_docs BIGINT NOT NULL DEFAULT 0,     -- чанков с непустым tsv
+  total_len BIGINT NOT NULL DEFAULT 0,  -- сумма длин чанков в лексемах (для avgdl)
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS tac.lex_terms (
+  user_id BIGINT NOT NULL,
+  term TEXT NOT NULL,
+  df INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(user_id, term)
+);
+
+CREATE TABLE IF NOT EXISTS tac.lex_postings (
+  chunk_id BIGINT NOT NULL REFERENCES tac.chunks(id) ON DELETE CASCADE,
+  term TEXT NOT NULL,
+  user_id BIGINT NOT NULL,
+  tf INTEGER NOT NULL,
+  impact REAL NOT NULL,
+  PRIMARY KEY(chunk_id, term)
+);
+
+CREATE INDEX IF NOT EXISTS idx_tac_lex_postings_impact
+  ON tac.lex_postings(user_id, term, impact DESC) INCLUDE (chunk_id);
+
+-- Backfill из существующих tsv.
+INSERT INTO tac.lex_stats (user_id, n_docs, total_len)
+SELECT c.user_id, count(*), sum(l.len)
+FROM tac.chunks c
+CROSS JOIN LATERAL (
+  SELECT sum(COALESCE(array_length(u.positions, 1), 1)) AS len FROM unnest(c.tsv) u
+) l
+WHERE c.user_id IS NOT NULL
+  AND l.len > 0
+GROUP BY c.user_id
+ON CONFLICT (user_id) DO UPDATE SET n_docs = excluded.n_docs, total_len = excluded.total_len, updated_at = now();
+
+INSERT INTO tac.lex_postings (chunk_id, term, user_id, tf, impact)
+SELECT
+  c.id, u.lexeme, c.user_id, t.tf,
+  t.tf * 2.2 / (t.tf + 1.2 * (0.25 + 0.75 * l.len / (s.total_len::float8 / s.n_docs)))
+FROM tac.chunks c
+JOIN tac.lex_stats s ON s.user_id = c.user_id
+CROSS JOIN LATERAL (
+  SELECT sum(COALESCE(array_length(u.positions, 1), 1)) AS len FROM unnest(c.tsv) u
+) l
+CROSS JOIN LATERAL unnest(c.tsv) u
+CROSS JOIN LATERAL (SELECT COALESCE(array_length(u.positions, 1), 1) AS tf) t
+ON CONFLICT (chunk_id, term) DO NOTHING;
+
+INSERT INTO tac.lex_terms (user_id, term, df)
+SELECT user_id, term, count(*)
+FROM tac.lex_postings
+GROUP BY user_id, term
+ON CONFLICT (user_id, term) DO UPDATE SET df = excluded.df;
+
+COMMIT;
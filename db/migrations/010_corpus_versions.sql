@@ -0,0 +1,13 @@
+-- KB-RING миграция 010: версия корпуса пользователя для инвалидации кэша retrieval в API.
+-- Воркер увеличивает version в той же транзакции, что пишет чанки/эмбеддинги задачи,
+-- поэтому API никогда не видит новую версию раньше новых данных (и наоборот).
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS op.corpus_versions (
+  user_id BIGINT PRIMARY KEY,
+  version BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+COMMIT;
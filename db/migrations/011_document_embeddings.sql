@@ -0,0 +1,32 @@
+-- KB-RING миграция 011: эмбеддинги документов для иерархического поиска (документ -> чанки).
+-- Вектор документа — среднее эмбеддингов его чанков (pgvector avg), ведёт воркер.
+-- RETRIEVAL_VECTOR=hierarchical: ANN по документам (таблица в разы меньше tac.embeddings),
+-- затем точный перебор чанков только внутри RETRIEVAL_DOC_SHORTLIST лучших документов.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS tac.document_embeddings (
+  document_id BIGINT NOT NULL REFERENCES tac.documents(id) ON DELETE CASCADE,
+  user_id BIGINT,
+  model TEXT NOT NULL,
+  dims INTEGER NOT NULL,
+  n_chunks INTEGER NOT NULL DEFAULT 0,
+  embedding vector(768),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (document_id, model)
+);
+
+CREATE INDEX IF NOT EXISTS idx_tac_document_embeddings_user_model ON tac.document_embeddings(user_id, model);
+CREATE INDEX IF NOT EXISTS idx_tac_document_embeddings_vec_hnsw
+  ON tac.document_embeddings USING hnsw (embedding vector_cosine_ops)
+  WITH (m = 16, ef_construction = 64);
+
+-- Backfill по уже проиндексированным документам.
+INSERT INTO tac.document_embeddings (document_id, user_id, model, dims, n_chunks, embedding)
+SELECT c.document_id, max(c.user_id), e.model, max(e.dims), count(*), avg(e.embedding)
+FROM tac.chunks c
+JOIN tac.embeddings e ON e.chunk_id = c.id
+GROUP BY c.document_id, e.model
+ON CONFLICT (document_id, model) DO NOTHING;
+
+COMMIT;
@@ -0,0 +1,14 @@
+-- KB-RING миграция 012: компактные копии эмбеддингов для VECTOR_STORAGE=half | binary.
+-- embedding_half — halfvec (2 байта на измерение), embedding_bin — binary_quantize (1 бит на измерение)
+-- для Hamming-префильтра с точным пересчётом cosine по embedding. Требуется pgvector >= 0.7.
+--
+-- Миграция только добавляет колонки (без перезаписи таблицы). Заполнение существующих строк
+-- пачками и HNSW индексы (CONCURRENTLY) — scripts/backfill_compact_vectors.py; новые строки
+-- заполняет воркер при VECTOR_STORAGE=half | binary.
+
+BEGIN;
+
+ALTER TABLE tac.embeddings ADD COLUMN IF NOT EXISTS embedding_half halfvec(768);
+ALTER TABLE tac.embeddings ADD COLUMN IF NOT EXISTS embedding_bin bit(768);
+
+COMMIT;
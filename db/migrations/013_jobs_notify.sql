@@ -0,0 +1,23 @@
+-- KB-RING миграция 013: NOTIFY op_jobs при постановке задачи в очередь.
+-- Триггер покрывает любого, кто пишет в op.jobs (API ingest, скрипты, ручной INSERT), и возврат
+-- задачи в 'queued'. Уведомление доставляется при COMMIT, т.е. когда задача уже видна воркеру.
+-- Воркер ждёт на LISTEN op_jobs, опрос раз в WORKER_POLL_S остаётся страховкой.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION op.notify_job_queued() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+  PERFORM pg_notify('op_jobs', NEW.kind);
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_op_jobs_notify ON op.jobs;
+CREATE TRIGGER trg_op_jobs_notify
+  AFTER INSERT OR UPDATE OF status ON op.jobs
+  FOR EACH ROW
+  WHEN (NEW.status = 'queued')
+  EXECUTE FUNCTION op.notify_job_queued();
+
+COMMIT;
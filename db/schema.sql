@@ -37,6 +37,7 @@ CREATE INDEX IF NOT EXISTS idx_tac_documents_uri ON tac.documents(uri);
 CREATE TABLE IF NOT EXISTS tac.chunks (
   id BIGSERIAL PRIMARY KEY,
   document_id BIGINT NOT NULL REFERENCES tac.documents(id) ON DELETE CASCADE,
+  user_id BIGINT,                       -- денормализовано из tac.documents (миграция 007)
   chunk_index INTEGER NOT NULL,
   chunk_text TEXT NOT NULL,
   chunk_sha256 TEXT,
@@ -47,6 +48,7 @@ CREATE TABLE IF NOT EXISTS tac.chunks (
 );
 
 CREATE INDEX IF NOT EXISTS idx_tac_chunks_doc ON tac.chunks(document_id);
+CREATE INDEX IF NOT EXISTS idx_tac_chunks_user ON tac.chunks(user_id);
 CREATE INDEX IF NOT EXISTS idx_tac_chunks_tsv ON tac.chunks USING GIN (tsv);
 
 -- -----------------------------------------------------------------------------
@@ -55,17 +57,68 @@ CREATE INDEX IF NOT EXISTS idx_tac_chunks_tsv ON tac.chunks USING GIN (tsv);
 CREATE TABLE IF NOT EXISTS tac.embeddings (
   id BIGSERIAL PRIMARY KEY,
   chunk_id BIGINT NOT NULL REFERENCES tac.chunks(id) ON DELETE CASCADE,
+  user_id BIGINT,                       -- денормализовано из tac.chunks (миграция 007)
   model TEXT NOT NULL,
   dims INTEGER NOT NULL,
   chunk_sha256 TEXT,
   embedding vector(768),               -- локальные sentence-transformers (multilingual-e5-base)
+  embedding_half halfvec(768),         -- VECTOR_STORAGE=half (миграция 012)
+  embedding_bin bit(768),              -- VECTOR_STORAGE=binary: binary_quantize(embedding) (миграция 012)
   created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
   UNIQUE(chunk_id, model)
 );
 
 CREATE INDEX IF NOT EXISTS idx_tac_embeddings_chunk ON tac.embeddings(chunk_id);
--- Индекс для cosine similarity (опционально; при больших объёмах включить ivfflat/hnsw тюнингом).
-CREATE INDEX IF NOT EXISTS idx_tac_embeddings_vec_cos ON tac.embeddings USING ivfflat (embedding vector_cosine_ops);
+CREATE INDEX IF NOT EXISTS idx_tac_embeddings_user_model ON tac.embeddings(user_id, model);
+-- Индекс для cosine similarity: HNSW (миграция 006). Параметры пересборки: scripts/rebuild_vector_index.py.
+CREATE INDEX IF NOT EXISTS idx_tac_embeddings_vec_hnsw ON tac.embeddings USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+-- Индексы компактных колонок строит scripts/backfill_compact_vectors.py (--index half | binary):
+--   idx_tac_embeddings_half_hnsw (halfvec_cosine_ops), idx_tac_embeddings_bin_hnsw (bit_hamming_ops).
+
+-- -----------------------------------------------------------------------------
+-- tac.document_embeddings (среднее эмбеддингов чанков документа, миграция 011; ведёт воркер)
+-- -----------------------------------------------------------------------------
+CREATE TABLE IF NOT EXISTS tac.document_embeddings (
+  document_id BIGINT NOT NULL REFERENCES tac.documents(id) ON DELETE CASCADE,
+  user_id BIGINT,
+  model TEXT NOT NULL,
+  dims INTEGER NOT NULL,
+  n_chunks INTEGER NOT NULL DEFAULT 0,
+  embedding vector(768),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (document_id, model)
+);
+
+CREATE INDEX IF NOT EXISTS idx_tac_document_embeddings_user_model ON tac.document_embeddings(user_id, model);
+CREATE INDEX IF NOT EXISTS idx_tac_document_embeddings_vec_hnsw ON tac.document_embeddings USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- -----------------------------------------------------------------------------
+-- tac.lex_* (лексический индекс BM25, миграция 009; ведёт воркер)
+-- -----------------------------------------------------------------------------
+CREATE TABLE IF NOT EXISTS tac.lex_stats (
+  user_id BIGINT PRIMARY KEY,
+  n_docs BIGINT NOT NULL DEFAULT 0,     -- чанков с непустым tsv
+  total_len BIGINT NOT NULL DEFAULT 0,  -- сумма длин чанков в лексемах (для avgdl)
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS tac.lex_terms (
+  user_id BIGINT NOT NULL,
+  term TEXT NOT NULL,
+  df INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(user_id, term)
+);
+
+CREATE TABLE IF NOT EXISTS tac.lex_postings (
+  chunk_id BIGINT NOT NULL REFERENCES tac.chunks(id) ON DELETE CASCADE,
+  term TEXT NOT NULL,
+  user_id BIGINT NOT NULL,
+  tf INTEGER NOT NULL,
+  impact REAL NOT NULL,                 -- BM25 tf-компонент: tf*(k1+1) / (tf + k1*(1 - b + b*len/avgdl))
+  PRIMARY KEY(chunk_id, term)
+);
+
+CREATE INDEX IF NOT EXISTS idx_tac_lex_postings_impact ON tac.lex_postings(user_id, term, impact DESC) INCLUDE (chunk_id);
 
 -- -----------------------------------------------------------------------------
 -- tac.entities + tac.chunk_entities (NER)
@@ -84,6 +137,7 @@ CREATE TABLE IF NOT EXISTS tac.chunk_entities (
   created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
   PRIMARY KEY(chunk_id, entity_id)
 );
+CREATE INDEX IF NOT EXISTS idx_tac_chunk_entities_entity ON tac.chunk_entities(entity_id, chunk_id);
 
 -- -----------------------------------------------------------------------------
 -- op.jobs: асинхронная обработка (ingest/index/enrich)
@@ -103,6 +157,30 @@ CREATE TABLE IF NOT EXISTS op.jobs (
 
 CREATE INDEX IF NOT EXISTS idx_op_jobs_status ON op.jobs(status, created_at);
 
+-- NOTIFY op_jobs при постановке в очередь (миграция 013): воркер ждёт на LISTEN вместо опроса.
+CREATE OR REPLACE FUNCTION op.notify_job_queued() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+  PERFORM pg_notify('op_jobs', NEW.kind);
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_op_jobs_notify ON op.jobs;
+CREATE TRIGGER trg_op_jobs_notify
+  AFTER INSERT OR UPDATE OF status ON op.jobs
+  FOR EACH ROW
+  WHEN (NEW.status = 'queued')
+  EXECUTE FUNCTION op.notify_job_queued();
+
+-- Версия корпуса пользователя (миграция 010): поднимает воркер по завершении индексации, API
+-- включает её в ключ кэша retrieval.
+CREATE TABLE IF NOT EXISTS op.corpus_versions (
+  user_id BIGINT PRIMARY KEY,
+  version BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
 -- -----------------------------------------------------------------------------
 -- chat.* (из "запросы по kb.txt"; стартовый каркас)
 -- -----------------------------------------------------------------------------
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Backfill of the compact vector columns on tac.embeddings (migration 012) and their HNSW indexes.
+
+embedding_half = embedding::halfvec(768), embedding_bin = binary_quantize(embedding)::bit(768).
+Rows are updated in id ranges of --batch-size, one transaction each, so the table is never locked
+as a whole and the run can be interrupted and resumed (only rows with NULL columns are touched).
+
+--index half | binary | both then builds the HNSW index(es) CONCURRENTLY, like rebuild_vector_index.py.
+Switch the API with VECTOR_STORAGE=half | binary after the index is ready; set the same variable for
+the worker so new chunks get the compact columns too.
+"""
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+import sys
+
+
+def _import_api():
+    root = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(root / "api"))
+    from kb_ring.config import DATABASE_URL  # type: ignore
+
+    return DATABASE_URL
+
+
+# --index -> (index, column, opclass)
+INDEXES = {
+    "half": ("idx_tac_embeddings_half_hnsw", "embedding_half", "halfvec_cosine_ops"),
+    "binary": ("idx_tac_embeddings_bin_hnsw", "embedding_bin", "bit_hamming_ops"),
+}
+
+_BACKFILL_SQL = """
+UPDATE tac.embeddings
+SET embedding_half = embedding::halfvec(768),
+    embedding_bin = binary_quantize(embedding)::bit(768)
+WHERE id >= %(lo)s AND id < %(hi)s
+  AND embedding IS NOT NULL
+  AND (embedding_half IS NULL OR embedding_bin IS NULL)
+"""
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--batch-size", type=int, default=5000, help="id range per transaction")
+    ap.add_argument("--skip-backfill", action="store_true", help="only build indexes")
+    ap.add_argument("--index", default="", choices=["", "half", "binary", "both"], help="build HNSW index(es) after backfill")
+    ap.add_argument("--m", type=int, default=16)
+    ap.add_argument("--ef-construction", type=int, default=64)
+    ap.add_argument("--maintenance-work-mem", default="1GB")
+    args = ap.parse_args()
+
+    import psycopg
+    from psycopg import sql
+
+    database_url = _import_api()
+    t0 = time.time()
+    if not args.skip_backfill:
+        with psycopg.connect(database_url) as conn:
+            lo, hi = conn.execute("SELECT COALESCE(min(id), 0), COALESCE(max(id), -1) FROM tac.embeddings").fetchone()
+            conn.commit()
+            step = max(1, int(args.batch_size))
+            done = 0
+            for start in range(int(lo), int(hi) + 1, step):
+                with conn.cursor() as cur:
+                    cur.execute(_BACKFILL_SQL, {"lo": start, "hi": start + step})
+                    done += cur.rowcount
+                conn.commit()
+                print(f"[backfill] ids<{start + step} updated={done} dt={time.time() - t0:.1f}s")
+        print(f"[backfill] done rows={done} dt={time.time() - t0:.1f}s")
+
+    names = list(INDEXES) if args.index == "both" else ([args.index] if args.index else [])
+    if not names:
+        return 0
+    # CREATE/DROP INDEX CONCURRENTLY нельзя выполнять внутри транзакции.
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        conn.execute("SELECT set_config('maintenance_work_mem', %s, false)", (args.maintenance_work_mem,))
+        for name in names:
+            index_name, column, opclass = INDEXES[name]
+            t1 = time.time()
+            conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS tac.{index_name}")
+            print(f"[index] building tac.{index_name} ({column} {opclass}) ...")
+            conn.execute(
+                sql.SQL("CREATE INDEX CONCURRENTLY {} ON tac.embeddings USING hnsw ({} {}) WITH (m = {}, ef_construction = {})").format(
+                    sql.Identifier(index_name),
+                    sql.Identifier(column),
+                    sql.SQL(opclass),
+                    sql.Literal(int(args.m)),
+                    sql.Literal(int(args.ef_construction)),
+                )
+            )
+            size = conn.execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass))", (f"tac.{index_name}",)).fetchone()[0]
+            print(f"[index] tac.{index_name} ready size={size} dt={time.time() - t1:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -2,20 +2,25 @@
 from __future__ import annotations
 
 import argparse
+import os
 import statistics
 import time
 from pathlib import Path
 import sys
 
 
-def _import_api():
+def _import_api(score_cache: bool):
+    if not score_cache:
+        # Кэш скоров читается при импорте rerank_bge: без этого повторные прогоны меряют попадания в кэш.
+        os.environ["RERANK_CACHE_SIZE"] = "0"
     root = Path(__file__).resolve().parents[1]
     sys.path.insert(0, str(root / "api"))
     from kb_ring.db import db_conn  # type: ignore
-    from kb_ring.retrieval import hybrid_retrieve  # type: ignore
+    from kb_ring.config import RERANK_MAX_PASSAGE_CHARS  # type: ignore
+    from kb_ring.retrieval import get_engine  # type: ignore
     from kb_ring.rerank_bge import Candidate, rerank  # type: ignore
 
-    return db_conn, hybrid_retrieve, Candidate, rerank
+    return db_conn, get_engine, Candidate, rerank, RERANK_MAX_PASSAGE_CHARS
 
 
 def main() -> int:
@@ -24,9 +29,11 @@ def main() -> int:
     ap.add_argument("--user-id", type=int, default=1)
     ap.add_argument("--top-n", type=int, default=50)
     ap.add_argument("--top-m", type=int, default=15)
+    ap.add_argument("--score-cache", action="store_true", help="keep RERANK_CACHE_SIZE (default: cache off, every pair is predicted)")
     args = ap.parse_args()
 
-    db_conn, hybrid_retrieve, Candidate, rerank = _import_api()
+    db_conn, get_engine, Candidate, rerank, max_chars = _import_api(args.score_cache)
+    engine = get_engine()
 
     qs = [ln.strip() for ln in Path(args.questions).read_text(encoding="utf-8").splitlines() if ln.strip()]
     if not qs:
@@ -36,7 +43,8 @@ def main() -> int:
     times = []
     with db_conn() as conn:
         for q in qs:
-            base = hybrid_retrieve(conn, args.user_id, q, top_k=args.top_n)
+            # Как в чате: reranker читает только первые RERANK_MAX_PASSAGE_CHARS символов.
+            base = engine.retrieve(conn, args.user_id, q, top_k=args.top_n, content_chars=max_chars).chunks
             cand = [
                 Candidate(
                     chunk_id=r.chunk_id,
@@ -45,6 +53,7 @@ def main() -> int:
                     uri=r.uri,
                     content=r.content or "",
                     base_score=float(r.score or 0.0),
+                    chunk_sha256=r.chunk_sha256,
                 )
                 for r in base
             ]
@@ -52,7 +61,7 @@ def main() -> int:
             _ = rerank(q, cand, top_m=args.top_m)
             times.append(time.time() - t0)
 
-    print(f"questions={len(qs)} top_n={args.top_n} top_m={args.top_m}")
+    print(f"questions={len(qs)} top_n={args.top_n} top_m={args.top_m} score_cache={'on' if args.score_cache else 'off'}")
     print(f"avg_s={statistics.mean(times):.3f} p50_s={statistics.median(times):.3f} max_s={max(times):.3f}")
     return 0
 
@@ -12,9 +12,231 @@ def _import_api():
     root = Path(__file__).resolve().parents[1]
     sys.path.insert(0, str(root / "api"))
     from kb_ring.db import db_conn  # type: ignore
-    from kb_ring.retrieval import hybrid_retrieve  # type: ignore
+    from kb_ring.embeddings import get_embedder  # type: ignore
+    from kb_ring.retrieval import RetrievalEngine, get_engine, lexical_channel, make_fusion, vector_neighbours  # type: ignore
 
-    return db_conn, hybrid_retrieve
+    def engine_for(args):
+        """
+        Движок из конфигурации; --lexical подменяет лексический канал (fts | bm25).
+        Кэш результатов выключен, пока не передан --cache (иначе повторы меряют кэш, а не SQL).
+        """
+        base = get_engine()
+        channels = base.channels
+        if args.lexical:
+            lex = lexical_channel(args.lexical)
+            channels = [lex if ch.name in ("fts", "bm25") else ch for ch in base.channels]
+        return RetrievalEngine(
+            channels,
+            base.fusion,
+            base.channel_factor,
+            base.channel_min,
+            base.channel_max,
+            base.skip_vec,
+            cache_size=base._cache.max_items if args.cache else 0,
+        )
+
+    return db_conn, engine_for, get_embedder, vector_neighbours, RetrievalEngine, make_fusion
+
+
+def _stats(times: list[float]) -> str:
+    return f"avg_s={statistics.mean(times):.4f} p50_s={statistics.median(times):.4f} max_s={max(times):.4f}"
+
+
+def bench_hybrid(args, qs, db_conn, engine_for) -> int:
+    engine = engine_for(args)
+    times = []
+    counts = []
+    stages: dict[str, list[float]] = {}
+    with db_conn() as conn:
+        for _ in range(max(1, args.repeat)):
+            for q in qs:
+                t0 = time.time()
+                res = engine.retrieve(conn, args.user_id, q, top_k=args.top_n, content_chars=args.content_chars)
+                dt = time.time() - t0
+                times.append(dt)
+                counts.append(len(res.chunks))
+                for k, v in res.timings_ms.items():
+                    stages.setdefault(k, []).append(v)
+
+    print(f"questions={len(qs)} top_n={args.top_n} channels={','.join(ch.name for ch in engine.channels)} fusion={engine.fusion.name}")
+    print(_stats(times))
+    print("stages_ms_avg: " + " ".join(f"{k}={statistics.mean(v):.2f}" for k, v in stages.items()))
+    print(f"avg_hits={statistics.mean(counts):.1f}")
+    if args.cache:
+        print(f"cache: {engine.stats()['cache']}")
+    return 0
+
+
+def bench_batch(args, qs, db_conn, engine_for) -> int:
+    """Последовательные retrieve против retrieve_batch пачками по --batch-size: latency и qps."""
+    engine = engine_for(args)
+    size = max(1, args.batch_size)
+    batches = [qs[i : i + size] for i in range(0, len(qs), size)]
+    with db_conn() as conn:
+        # прогрев: модель, prepared statements
+        engine.retrieve(conn, args.user_id, qs[0], top_k=args.top_n, content_chars=args.content_chars)
+        engine.retrieve_batch(conn, args.user_id, batches[0], top_k=args.top_n, content_chars=args.content_chars)
+
+        seq_times = []
+        same = 0
+        seq_ids = []
+        t_seq = time.time()
+        for q in qs:
+            t0 = time.time()
+            res = engine.retrieve(conn, args.user_id, q, top_k=args.top_n, content_chars=args.content_chars)
+            seq_times.append(time.time() - t0)
+            seq_ids.append([c.chunk_id for c in res.chunks])
+        t_seq = time.time() - t_seq
+
+        batch_times = []
+        batch_ids = []
+        t_batch = time.time()
+        for b in batches:
+            t0 = time.time()
+            for res in engine.retrieve_batch(conn, args.user_id, b, top_k=args.top_n, content_chars=args.content_chars):
+                batch_ids.append([c.chunk_id for c in res.chunks])
+            batch_times.append(time.time() - t0)
+        t_batch = time.time() - t_batch
+
+    for a, b in zip(seq_ids, batch_ids):
+        same += int(a == b)
+    print(f"questions={len(qs)} top_n={args.top_n} batch_size={size} batches={len(batches)}")
+    print(f"sequential: {_stats(seq_times)} qps={len(qs) / max(t_seq, 1e-9):.1f}")
+    print(f"batch:      {_stats(batch_times)} (per batch) qps={len(qs) / max(t_batch, 1e-9):.1f}")
+    print(f"identical_rankings={same}/{len(qs)}")
+    return 0
+
+
+def bench_fusion(args, qs, db_conn, engine_for, RetrievalEngine, make_fusion) -> int:
+    """
+    Стратегии слияния с лимитами каналов от top_k против эталона: --reference fusion с полными
+    лимитами (RETRIEVAL_CHANNEL_MAX на канал). overlap@k — доля эталонного top_k в top_k стратегии.
+    """
+    base = engine_for(args)
+    ref_engine = RetrievalEngine(
+        base.channels,
+        make_fusion(args.reference),
+        channel_min=base.channel_max,
+        channel_max=base.channel_max,
+        skip_vec=base.skip_vec,
+        cache_size=0,
+    )
+    names = [x.strip() for x in args.fusion.split(",") if x.strip()]
+
+    with db_conn() as conn:
+        ref: list[list[int]] = []
+        ref_times = []
+        for q in qs:
+            t0 = time.time()
+            ref.append([r.chunk_id for r in ref_engine.retrieve(conn, args.user_id, q, top_k=args.top_n, content_chars=0).chunks])
+            ref_times.append(time.time() - t0)
+            conn.commit()
+
+        print(f"questions={len(qs)} top_n={args.top_n} channels={','.join(ch.name for ch in base.channels)}")
+        print(f"reference {args.reference} channel_limit={ref_engine.channel_limit(args.top_n)}: {_stats(ref_times)}")
+        for name in names:
+            engine = RetrievalEngine(
+                base.channels, make_fusion(name), base.channel_factor, base.channel_min, base.channel_max, base.skip_vec, cache_size=0
+            )
+            times = []
+            overlaps = []
+            for q, ref_ids in zip(qs, ref):
+                t0 = time.time()
+                got = [r.chunk_id for r in engine.retrieve(conn, args.user_id, q, top_k=args.top_n, content_chars=0).chunks]
+                times.append(time.time() - t0)
+                conn.commit()
+                overlaps.append(len(set(got) & set(ref_ids)) / len(ref_ids) if ref_ids else 1.0)
+            print(
+                f"{name} channel_limit={engine.channel_limit(args.top_n)}: "
+                f"overlap@k_avg={statistics.mean(overlaps):.4f} overlap@k_min={min(overlaps):.4f} {_stats(times)}"
+            )
+    return 0
+
+
+def bench_ann(args, qs, db_conn, get_embedder, vector_neighbours) -> int:
+    """
+    Векторный канал против точного перебора — recall@k и латентность: HNSW по чанкам (по каждому ef_search)
+    и иерархический поиск документ -> чанки (по каждому --doc-shortlist), компактное хранение
+    (по каждому --storage) с размерами индексов и колонок.
+    """
+    embedder = get_embedder()
+    if embedder is None:
+        print("embedder is not available")
+        return 2
+    qvecs = [embedder.embed_query(q) for q in qs]
+    ef_values = [int(x) for x in args.ef_search.split(",") if x.strip()]
+    shortlists = [int(x) for x in args.doc_shortlist.split(",") if x.strip()]
+    storages = [x.strip() for x in args.storage.split(",") if x.strip()]
+
+    exact_times = []
+    exact: list[set[int]] = []
+    with db_conn() as conn:
+        for qv in qvecs:
+            t0 = time.time()
+            exact.append({cid for cid, _ in vector_neighbours(conn, args.user_id, qv, embedder.model_name, args.top_n, exact=True)})
+            exact_times.append(time.time() - t0)
+            conn.commit()
+
+        print(f"questions={len(qs)} k={args.top_n}")
+        print(f"exact: {_stats(exact_times)}")
+        for ef in ef_values:
+            times = []
+            recalls = []
+            for qv, ref in zip(qvecs, exact):
+                t0 = time.time()
+                got = {cid for cid, _ in vector_neighbours(conn, args.user_id, qv, embedder.model_name, args.top_n, ef_search=ef)}
+                times.append(time.time() - t0)
+                conn.commit()
+                recalls.append(len(got & ref) / len(ref) if ref else 1.0)
+            print(f"hnsw ef_search={ef}: recall@k_avg={statistics.mean(recalls):.4f} recall@k_min={min(recalls):.4f} {_stats(times)}")
+        for n in shortlists:
+            times = []
+            recalls = []
+            for qv, ref in zip(qvecs, exact):
+                t0 = time.time()
+                got = {cid for cid, _ in vector_neighbours(conn, args.user_id, qv, embedder.model_name, args.top_n, doc_shortlist=n)}
+                times.append(time.time() - t0)
+                conn.commit()
+                recalls.append(len(got & ref) / len(ref) if ref else 1.0)
+            print(f"hierarchical docs={n}: recall@k_avg={statistics.mean(recalls):.4f} recall@k_min={min(recalls):.4f} {_stats(times)}")
+        for storage in storages:
+            # binary: ef_search покрывает весь список кандидатов на пересчёт (как _ef_search в API).
+            ef = min(1000, max(200, args.top_n * args.binary_rescore)) if storage == "binary" else None
+            times = []
+            recalls = []
+            for qv, ref in zip(qvecs, exact):
+                t0 = time.time()
+                got = {cid for cid, _ in vector_neighbours(conn, args.user_id, qv, embedder.model_name, args.top_n, ef_search=ef, storage=storage, binary_rescore=args.binary_rescore)}
+                times.append(time.time() - t0)
+                conn.commit()
+                recalls.append(len(got & ref) / len(ref) if ref else 1.0)
+            rescore = f" rescore={args.binary_rescore}" if storage == "binary" else ""
+            print(f"storage={storage} ef_search={ef}{rescore}: recall@k_avg={statistics.mean(recalls):.4f} recall@k_min={min(recalls):.4f} {_stats(times)}")
+        if storages:
+            _print_vector_sizes(conn)
+    return 0
+
+
+def _print_vector_sizes(conn) -> None:
+    """Размеры векторных индексов tac.embeddings и средний размер значения каждой колонки."""
+    rows = conn.execute(
+        """
+        SELECT i.relname, pg_size_pretty(pg_relation_size(i.oid))
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_am a ON a.oid = i.relam
+        WHERE x.indrelid = 'tac.embeddings'::regclass
+          AND a.amname IN ('hnsw', 'ivfflat')
+        ORDER BY 1
+        """
+    ).fetchall()
+    for name, size in rows:
+        print(f"index {name}: {size}")
+    avg = conn.execute(
+        "SELECT avg(pg_column_size(embedding)), avg(pg_column_size(embedding_half)), avg(pg_column_size(embedding_bin)) FROM tac.embeddings"
+    ).fetchone()
+    print("avg_bytes: " + " ".join(f"{k}={float(v or 0):.0f}" for k, v in zip(("float", "half", "binary"), avg)))
+    conn.commit()
 
 
 def main() -> int:
@@ -22,31 +244,35 @@ def main() -> int:
     ap.add_argument("--questions", required=True, help="Path to txt file with one question per line")
     ap.add_argument("--user-id", type=int, default=1)
     ap.add_argument("--top-n", type=int, default=50)
+    ap.add_argument("--mode", default="hybrid", choices=["hybrid", "fusion", "ann-vs-exact", "batch"])
+    ap.add_argument("--content-chars", type=int, default=None, help="hybrid: chars of chunk text to fetch (default: full, 0 = ids only)")
+    ap.add_argument("--lexical", default="", help="hybrid/fusion: override lexical channel (fts | bm25)")
+    ap.add_argument("--cache", action="store_true", help="hybrid: enable the retrieval result cache (RETRIEVAL_CACHE_SIZE)")
+    ap.add_argument("--repeat", type=int, default=1, help="hybrid: run the question list N times (with --cache: repeat cost)")
+    ap.add_argument("--fusion", default="weighted,rrf,minmax", help="fusion: comma-separated strategies to compare")
+    ap.add_argument("--reference", default="weighted", help="fusion: reference strategy (run with full channel limits)")
+    ap.add_argument("--batch-size", type=int, default=16, help="batch: queries per retrieve_batch call")
+    ap.add_argument("--ef-search", default="40,100,200,400", help="ann-vs-exact: comma-separated hnsw.ef_search values")
+    ap.add_argument("--storage", default="", help="ann-vs-exact: comma-separated compact storages to compare (half,binary; migration 012)")
+    ap.add_argument("--binary-rescore", type=int, default=4, help="ann-vs-exact: rescore depth (candidates per result) and ef_search for --storage binary")
+    ap.add_argument("--doc-shortlist", default="", help="ann-vs-exact: comma-separated document shortlist sizes for hierarchical search (migration 011)")
     args = ap.parse_args()
 
-    db_conn, hybrid_retrieve = _import_api()
+    db_conn, engine_for, get_embedder, vector_neighbours, RetrievalEngine, make_fusion = _import_api()
 
     qs = [ln.strip() for ln in Path(args.questions).read_text(encoding="utf-8").splitlines() if ln.strip()]
     if not qs:
         print("no questions")
         return 2
 
-    times = []
-    counts = []
-    with db_conn() as conn:
-        for q in qs:
-            t0 = time.time()
-            items = hybrid_retrieve(conn, args.user_id, q, top_k=args.top_n)
-            dt = time.time() - t0
-            times.append(dt)
-            counts.append(len(items))
-
-    print(f"questions={len(qs)} top_n={args.top_n}")
-    print(f"avg_s={statistics.mean(times):.3f} p50_s={statistics.median(times):.3f} max_s={max(times):.3f}")
-    print(f"avg_hits={statistics.mean(counts):.1f}")
-    return 0
+    if args.mode == "ann-vs-exact":
+        return bench_ann(args, qs, db_conn, get_embedder, vector_neighbours)
+    if args.mode == "batch":
+        return bench_batch(args, qs, db_conn, engine_for)
+    if args.mode == "fusion":
+        return bench_fusion(args, qs, db_conn, engine_for, RetrievalEngine, make_fusion)
+    return bench_hybrid(args, qs, db_conn, engine_for)
 
 
 if __name__ == "__main__":
     raise SystemExit(main())
-
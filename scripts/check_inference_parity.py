@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Parity check: torch vs ONNX/int8 backend for the E5 embedder and the BGE cross-encoder.
+
+For each question we take hybrid retrieval candidates from the DB and compare:
+- embeddings: cosine(torch_vec, backend_vec) for queries/passages and overlap@M of the cosine ranking;
+- reranker: max |score diff|, Spearman correlation and overlap@M of the rerank ordering.
+Overlap@M is the share of torch top-M that the backend keeps in its top-M (retrieval-quality impact).
+"""
+from __future__ import annotations
+
+import argparse
+import statistics
+from pathlib import Path
+import sys
+
+
+def _import_api():
+    root = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(root / "api"))
+    from kb_ring.config import EMBEDDINGS_MODEL, RERANK_MAX_PASSAGE_CHARS, RERANK_MODEL  # type: ignore
+    from kb_ring.db import db_conn  # type: ignore
+    from kb_ring.model_backend import BACKENDS, load_model  # type: ignore
+    from kb_ring.retrieval import hybrid_retrieve  # type: ignore
+
+    return db_conn, hybrid_retrieve, load_model, BACKENDS, EMBEDDINGS_MODEL, RERANK_MODEL, RERANK_MAX_PASSAGE_CHARS
+
+
+def _rank(xs) -> list[int]:
+    return sorted(range(len(xs)), key=lambda i: float(xs[i]), reverse=True)
+
+
+def _spearman(a, b) -> float:
+    n = len(a)
+    if n < 2:
+        return 1.0
+    ra = [0] * n
+    rb = [0] * n
+    for pos, i in enumerate(_rank(a)):
+        ra[i] = pos
+    for pos, i in enumerate(_rank(b)):
+        rb[i] = pos
+    d2 = sum((x - y) ** 2 for x, y in zip(ra, rb))
+    return 1.0 - (6.0 * d2) / (n * (n * n - 1))
+
+
+def _overlap(a, b, m: int) -> float:
+    ta = set(_rank(a)[:m])
+    tb = set(_rank(b)[:m])
+    return len(ta & tb) / max(1, len(ta))
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--questions", required=True, help="Path to txt file with one question per line")
+    ap.add_argument("--user-id", type=int, default=1)
+    ap.add_argument("--top-n", type=int, default=50)
+    ap.add_argument("--top-m", type=int, default=15)
+    ap.add_argument("--backend", default="onnx-int8", help="backend to compare against torch")
+    args = ap.parse_args()
+
+    db_conn, hybrid_retrieve, load_model, backends, emb_model, rr_model, max_chars = _import_api()
+    if args.backend not in backends or args.backend == "torch":
+        print(f"--backend must be one of {[b for b in backends if b != 'torch']}")
+        return 2
+
+    import numpy as np  # type: ignore
+    from sentence_transformers import CrossEncoder, SentenceTransformer  # type: ignore
+
+    qs = [ln.strip() for ln in Path(args.questions).read_text(encoding="utf-8").splitlines() if ln.strip()]
+    if not qs:
+        print("no questions")
+        return 2
+
+    with db_conn() as conn:
+        cands = {q: [r.content or "" for r in hybrid_retrieve(conn, args.user_id, q, top_k=args.top_n)] for q in qs}
+
+    st_ref = load_model(SentenceTransformer, emb_model, "torch")
+    st_alt = load_model(SentenceTransformer, emb_model, args.backend)
+    ce_ref = load_model(CrossEncoder, rr_model, "torch")
+    ce_alt = load_model(CrossEncoder, rr_model, args.backend)
+
+    emb_cos, emb_overlap, rr_diff, rr_rho, rr_overlap = [], [], [], [], []
+    for q in qs:
+        passages = [p.strip()[:max_chars] for p in cands[q] if p.strip()]
+        if not passages:
+            continue
+        texts = ["query: " + q] + ["passage: " + p for p in passages]
+        ref = np.asarray(st_ref.encode(texts, normalize_embeddings=True), dtype=np.float32)
+        alt = np.asarray(st_alt.encode(texts, normalize_embeddings=True), dtype=np.float32)
+        emb_cos.extend(float(x) for x in (ref * alt).sum(axis=1))
+        emb_overlap.append(_overlap(ref[1:] @ ref[0], alt[1:] @ alt[0], args.top_m))
+
+        pairs = [(q, p) for p in passages]
+        s_ref = [float(x) for x in ce_ref.predict(pairs)]
+        s_alt = [float(x) for x in ce_alt.predict(pairs)]
+        rr_diff.append(max(abs(a - b) for a, b in zip(s_ref, s_alt)))
+        rr_rho.append(_spearman(s_ref, s_alt))
+        rr_overlap.append(_overlap(s_ref, s_alt, args.top_m))
+
+    if not emb_cos:
+        print("no candidates retrieved")
+        return 2
+
+    print(f"questions={len(qs)} backend={args.backend} top_n={args.top_n} top_m={args.top_m}")
+    print(f"embed: cos_min={min(emb_cos):.5f} cos_avg={statistics.mean(emb_cos):.5f} overlap@m_avg={statistics.mean(emb_overlap):.3f} overlap@m_min={min(emb_overlap):.3f}")
+    print(f"rerank: max_abs_diff={max(rr_diff):.4f} spearman_avg={statistics.mean(rr_rho):.4f} overlap@m_avg={statistics.mean(rr_overlap):.3f} overlap@m_min={min(rr_overlap):.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
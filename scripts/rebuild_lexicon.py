@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Full rebuild of the BM25 lexicon (tac.lex_stats / tac.lex_terms / tac.lex_postings) from tac.chunks.tsv.
+
+The worker maintains the lexicon incrementally, but posting impacts are frozen with the average chunk
+length at indexing time, and chunks deleted through ON DELETE CASCADE are not subtracted from
+df / n_docs. Run this periodically, or after bulk deletes, to make the statistics exact again.
+
+Each user is rebuilt in its own transaction under the same advisory lock as the worker.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import time
+from pathlib import Path
+import sys
+
+
+def _import_api():
+    root = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(root / "api"))
+    from kb_ring.config import DATABASE_URL  # type: ignore
+
+    return DATABASE_URL
+
+
+_STATS_SQL = """
+INSERT INTO tac.lex_stats (user_id, n_docs, total_len)
+SELECT c.user_id, count(*), sum(l.len)
+FROM tac.chunks c
+CROSS JOIN LATERAL (
+  SELECT sum(COALESCE(array_length(u.positions, 1), 1)) AS len FROM unnest(c.tsv) u
+) l
+WHERE c.user_id = %(user_id)s
+  AND l.len > 0
+GROUP BY c.user_id
+"""
+
+_POSTINGS_SQL = """
+INSERT INTO tac.lex_postings (chunk_id, term, user_id, tf, impact)
+SELECT
+  c.id, u.lexeme, c.user_id, t.tf,
+  t.tf * (%(k1)s + 1.0) / (t.tf + %(k1)s * (1.0 - %(b)s + %(b)s * l.len / (s.total_len::float8 / greatest(s.n_docs, 1))))
+FROM tac.chunks c
+JOIN tac.lex_stats s ON s.user_id = c.user_id
+CROSS JOIN LATERAL (
+  SELECT sum(COALESCE(array_length(u.positions, 1), 1)) AS len FROM unnest(c.tsv) u
+) l
+CROSS JOIN LATERAL unnest(c.tsv) u
+CROSS JOIN LATERAL (SELECT COALESCE(array_length(u.positions, 1), 1) AS tf) t
+WHERE c.user_id = %(user_id)s
+"""
+
+_TERMS_SQL = """
+INSERT INTO tac.lex_terms (user_id, term, df)
+SELECT user_id, term, count(*)
+FROM tac.lex_postings
+WHERE user_id = %(user_id)s
+GROUP BY user_id, term
+"""
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--user-id", type=int, default=0, help="rebuild only this user (default: all users with chunks)")
+    ap.add_argument("--k1", type=float, default=float(os.environ.get("LEXICAL_BM25_K1", "1.2") or "1.2"))
+    ap.add_argument("--b", type=float, default=float(os.environ.get("LEXICAL_BM25_B", "0.75") or "0.75"))
+    args = ap.parse_args()
+
+    import psycopg
+
+    database_url = _import_api()
+    with psycopg.connect(database_url) as conn:
+        if args.user_id > 0:
+            users = [int(args.user_id)]
+        else:
+            users = [int(r[0]) for r in conn.execute("SELECT DISTINCT user_id FROM tac.chunks WHERE user_id IS NOT NULL ORDER BY 1").fetchall()]
+        conn.commit()
+
+        for uid in users:
+            t0 = time.time()
+            params = {"user_id": uid, "k1": args.k1, "b": args.b}
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(hashtextextended('tac.lex_stats:' || %s::text, 0))", (uid,))
+                cur.execute("DELETE FROM tac.lex_postings WHERE user_id = %(user_id)s", params)
+                cur.execute("DELETE FROM tac.lex_terms WHERE user_id = %(user_id)s", params)
+                cur.execute("DELETE FROM tac.lex_stats WHERE user_id = %(user_id)s", params)
+                cur.execute(_STATS_SQL, params)
+                cur.execute(_POSTINGS_SQL, params)
+                postings = cur.rowcount
+                cur.execute(_TERMS_SQL, params)
+                terms = cur.rowcount
+            conn.commit()
+            print(f"[lexicon] user={uid} terms={terms} postings={postings} dt={time.time() - t0:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
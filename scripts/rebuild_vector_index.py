@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Online (CONCURRENTLY) rebuild of the HNSW index on tac.embeddings with new m / ef_construction.
+
+Steps: build `<name>_new` concurrently -> drop the old index(es) concurrently -> rename.
+Writes from the worker are not blocked; a failed run leaves only an INVALID `<name>_new`, which
+the next run drops first.
+
+With --user-id a partial per-tenant index (WHERE user_id = ... AND model = ...) is built instead:
+the vector channel of that user then scans only its own graph.
+"""
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+import sys
+
+
+def _import_api():
+    root = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(root / "api"))
+    from kb_ring.config import DATABASE_URL, EMBEDDINGS_MODEL  # type: ignore
+
+    return DATABASE_URL, EMBEDDINGS_MODEL
+
+
+INDEX_NAME = "idx_tac_embeddings_vec_hnsw"
+# Старые имена векторных индексов (ivfflat из 004), которые заменяются HNSW.
+LEGACY_INDEXES = ("idx_tac_embeddings_vec_cos",)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--m", type=int, default=16, help="HNSW max connections per layer")
+    ap.add_argument("--ef-construction", type=int, default=64, help="HNSW candidate list size at build time")
+    ap.add_argument("--maintenance-work-mem", default="1GB", help="graph should fit in memory for a fast build")
+    ap.add_argument("--parallel-workers", type=int, default=0, help="max_parallel_maintenance_workers (0 = server default)")
+    ap.add_argument("--user-id", type=int, default=0, help="build a partial per-tenant index for this user")
+    ap.add_argument("--model", default="", help="--user-id: embeddings model (default EMBEDDINGS_MODEL)")
+    ap.add_argument("--drop", action="store_true", help="--user-id: drop the per-tenant index instead of building it")
+    args = ap.parse_args()
+
+    import psycopg
+    from psycopg import sql
+
+    database_url, default_model = _import_api()
+    index_name = INDEX_NAME
+    legacy = LEGACY_INDEXES
+    where = sql.SQL("")
+    if args.user_id > 0:
+        index_name = f"{INDEX_NAME}_u{int(args.user_id)}"
+        legacy = ()
+        where = sql.SQL(" WHERE user_id = {} AND model = {}").format(sql.Literal(int(args.user_id)), sql.Literal(args.model or default_model))
+    new_name = index_name + "_new"
+    t0 = time.time()
+    # CREATE/DROP INDEX CONCURRENTLY нельзя выполнять внутри транзакции.
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        conn.execute("SELECT set_config('maintenance_work_mem', %s, false)", (args.maintenance_work_mem,))
+        if args.parallel_workers > 0:
+            conn.execute("SELECT set_config('max_parallel_maintenance_workers', %s, false)", (str(args.parallel_workers),))
+        conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS tac.{new_name}")
+        if args.drop:
+            if args.user_id <= 0:
+                print("--drop requires --user-id")
+                return 2
+            conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS tac.{index_name}")
+            print(f"[index] tac.{index_name} dropped")
+            return 0
+        print(f"[index] building tac.{new_name} m={args.m} ef_construction={args.ef_construction} ...")
+        conn.execute(
+            sql.SQL(
+                "CREATE INDEX CONCURRENTLY {} ON tac.embeddings USING hnsw (embedding vector_cosine_ops)"
+                " WITH (m = {}, ef_construction = {}){}"
+            ).format(sql.Identifier(new_name), sql.Literal(int(args.m)), sql.Literal(int(args.ef_construction)), where)
+        )
+        for old in (index_name,) + legacy:
+            conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS tac.{old}")
+        conn.execute(f"ALTER INDEX tac.{new_name} RENAME TO {index_name}")
+        size = conn.execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass))", (f"tac.{index_name}",)).fetchone()[0]
+    print(f"[index] tac.{index_name} ready size={size} dt={time.time() - t0:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -5,6 +5,8 @@ from typing import Optional
 
 import os
 
+from .model_backend import load_model
+
 
 def _env_bool(name: str, default: str = "0") -> bool:
     return (os.environ.get(name, default) or default).lower() in ("1", "true", "yes")
@@ -19,6 +21,9 @@ EMBEDDINGS_ENABLED = _env_bool("EMBEDDINGS_ENABLED", "1")
 EMBEDDINGS_MODEL = os.environ.get("EMBEDDINGS_MODEL", "intfloat/multilingual-e5-base")
 EMBEDDINGS_DIMS = _env_int("EMBEDDINGS_DIMS", "768")
 EMBEDDINGS_BATCH_SIZE = _env_int("EMBEDDINGS_BATCH_SIZE", "32")
+# torch | onnx | onnx-int8 (см. model_backend.py). Вектора пишутся под тем же `model`, поэтому
+# перед переключением проверьте расхождение с torch: scripts/check_inference_parity.py.
+EMBEDDINGS_BACKEND = (os.environ.get("EMBEDDINGS_BACKEND") or os.environ.get("INFERENCE_BACKEND") or "torch").strip().lower()
 
 
 @dataclass(frozen=True)
@@ -26,7 +31,8 @@ class Embedder:
     model_name: str
     dims: int
 
-    def embed_many(self, texts: list[str]) -> list[list[float]]:
+    def embed_many(self, texts: list[str]) -> list:
+        """Вектора float32 (numpy), пишутся в pgvector бинарно."""
         raise NotImplementedError
 
 
@@ -42,22 +48,27 @@ def get_embedder() -> Optional[Embedder]:
         return _EMBEDDER
 
     try:
+        import numpy as np  # type: ignore
         from sentence_transformers import SentenceTransformer  # type: ignore
     except Exception as e:  # pragma: no cover
         _EMBEDDER_ERR = f"sentence-transformers import failed: {e}"
         return None
 
-    st = SentenceTransformer(EMBEDDINGS_MODEL)
+    try:
+        st = load_model(SentenceTransformer, EMBEDDINGS_MODEL, EMBEDDINGS_BACKEND)
+    except Exception as e:  # pragma: no cover
+        _EMBEDDER_ERR = f"sentence-transformers init failed ({EMBEDDINGS_BACKEND}): {e}"
+        return None
 
     class _StEmbedder(Embedder):
         def __init__(self):
             super().__init__(model_name=EMBEDDINGS_MODEL, dims=EMBEDDINGS_DIMS)
 
-        def embed_many(self, texts: list[str]) -> list[list[float]]:
+        def embed_many(self, texts: list[str]) -> list:
             # E5 passage embeddings: prefix "passage: ".
             batch = ["passage: " + (t or "") for t in texts]
             vecs = st.encode(batch, normalize_embeddings=True, batch_size=EMBEDDINGS_BATCH_SIZE)
-            return [[float(x) for x in v.tolist()] for v in vecs]
+            return list(np.asarray(vecs, dtype=np.float32))
 
     emb = _StEmbedder()
     try:
@@ -70,7 +81,3 @@ def get_embedder() -> Optional[Embedder]:
 
     _EMBEDDER = emb
     return _EMBEDDER
-
-
-def pgvector_text(v: list[float]) -> str:
-    return "[" + ",".join(f"{float(x):.8f}" for x in v) + "]"
@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import os
+import shutil
+
+ONNX_CACHE_DIR = os.environ.get("ONNX_CACHE_DIR", os.path.expanduser("~/.cache/kb_ring/onnx"))
+ONNX_QUANT_CONFIG = os.environ.get("ONNX_QUANT_CONFIG", "avx512_vnni")
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+def load_model(cls, model_name: str, backend: str):
+    """
+    Загрузка SentenceTransformer/CrossEncoder с выбранным бэкендом инференса:
+    - `torch`: как раньше (PyTorch fp32);
+    - `onnx`: ONNX Runtime (экспорт из HF выполняет sentence-transformers при первой загрузке);
+    - `onnx-int8`: ONNX + динамическая int8-квантизация (`ONNX_QUANT_CONFIG`: avx512_vnni|avx512|avx2|arm64).
+      Квантованная модель один раз сохраняется в `ONNX_CACHE_DIR/<model>__qint8_<config>` и дальше грузится оттуда.
+    Требует `sentence-transformers[onnx]` (optimum + onnxruntime) для onnx-режимов.
+    """
+    backend = (backend or "torch").strip().lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown inference backend: {backend!r} (expected one of {', '.join(BACKENDS)})")
+    if backend == "torch":
+        return cls(model_name)
+    if backend == "onnx":
+        return cls(model_name, backend="onnx")
+
+    file_name = f"onnx/model_qint8_{ONNX_QUANT_CONFIG}.onnx"
+    # Конфиг квантизации входит в имя каталога: после смены ONNX_QUANT_CONFIG экспорт идёт в новый каталог.
+    local_dir = os.path.join(ONNX_CACHE_DIR, f"{model_name.replace('/', '__')}__qint8_{ONNX_QUANT_CONFIG}")
+    if not os.path.exists(os.path.join(local_dir, file_name)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model  # type: ignore
+
+        # Экспорт во временный каталог + rename: параллельно стартующие процессы не видят полузаписанную модель.
+        tmp_dir = f"{local_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        model = cls(model_name, backend="onnx")
+        model.save_pretrained(tmp_dir)
+        export_dynamic_quantized_onnx_model(model, ONNX_QUANT_CONFIG, tmp_dir)
+        try:
+            os.replace(tmp_dir, local_dir)
+        except OSError:
+            # Каталог уже есть: другой процесс успел раньше или в нём нет нашего файла (кэш неполный).
+            # Во втором случае переносим свой экспорт внутрь, а не выбрасываем его.
+            target = os.path.join(local_dir, file_name)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(os.path.join(tmp_dir, file_name), target)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(os.path.join(local_dir, file_name)):
+            raise RuntimeError(f"quantized ONNX export not found: {os.path.join(local_dir, file_name)}")
+    return cls(local_dir, backend="onnx", model_kwargs={"file_name": file_name})
@@ -1,17 +1,47 @@
 import hashlib
+import multiprocessing
+from multiprocessing.connection import wait as mp_wait
 import os
+import signal
+import threading
 import time
+from typing import Optional
 
 from dotenv import load_dotenv
+from pgvector.psycopg import register_vector
 import psycopg
 from psycopg.types.json import Jsonb
 
-from .embeddings import get_embedder, pgvector_text
+from .embeddings import EMBEDDINGS_BATCH_SIZE, get_embedder
 from .ner import extract_entities_regex
 
 load_dotenv(override=False)
 
 DATABASE_URL = os.environ.get("DATABASE_URL", "")
+# BM25 для лексического индекса tac.lex_* (миграция 009): impact постинга считается при индексации.
+LEXICAL_BM25_K1 = float(os.environ.get("LEXICAL_BM25_K1", "1.2") or "1.2")
+LEXICAL_BM25_B = float(os.environ.get("LEXICAL_BM25_B", "0.75") or "0.75")
+# half | binary: заполнять компактные колонки tac.embeddings (миграция 012) вместе с float-вектором.
+VECTOR_STORAGE = (os.environ.get("VECTOR_STORAGE", "float") or "float").strip().lower()
+# Пул процессов: WORKER_PROCESSES процессов (1 = без супервизора), у каждого WORKER_TORCH_THREADS
+# потоков torch (0 = cpu_count / WORKER_PROCESSES).
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "1") or "1")
+WORKER_TORCH_THREADS = int(os.environ.get("WORKER_TORCH_THREADS", "0") or "0")
+# Эмбеддинги чанков всех взятых задач общими батчами (см. _embed_jobs).
+WORKER_CROSS_BATCH = (os.environ.get("WORKER_CROSS_BATCH", "0") or "0").lower() in ("1", "true", "yes")
+# Задач за один захват. Больше одной — только с WORKER_CROSS_BATCH: иначе взятые задачи ждут за одним
+# процессом, пока остальные простаивают.
+WORKER_CLAIM_BATCH = (
+    max(1, int(os.environ.get("WORKER_CLAIM_BATCH", "8") or "8")) if WORKER_CROSS_BATCH else 1
+)
+# Аренда задачи: 'running' дольше WORKER_JOB_LEASE_S (процесс упал / убит OOM) возвращается в очередь
+# при следующем захвате любым воркером. Должна быть больше времени индексации самого длинного документа.
+WORKER_JOB_LEASE_S = float(os.environ.get("WORKER_JOB_LEASE_S", "3600") or "3600")
+# Новые задачи будят воркер через LISTEN op_jobs (миграция 013); опрос — страховка (пропущенный NOTIFY,
+# триггер не установлен), поэтому редкий. WORKER_LISTEN=0 — только опрос.
+WORKER_LISTEN = (os.environ.get("WORKER_LISTEN", "1") or "1").lower() in ("1", "true", "yes")
+WORKER_POLL_S = float(os.environ.get("WORKER_POLL_S", "30" if WORKER_LISTEN else "2") or "2")
+WORKER_STATS_INTERVAL_S = float(os.environ.get("WORKER_STATS_INTERVAL_S", "60") or "60")
 
 
 def _chunk_text(text: str, max_chars: int = 1500) -> list[str]:
@@ -31,156 +61,639 @@ def _sha(text: str) -> str:
     return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
-def main():
-    if not DATABASE_URL:
-        raise SystemExit("DATABASE_URL не задан")
+# Снять вклад прежней версии чанков: постинги, df термов, n_docs/total_len пользователя.
+_LEX_REMOVE_SQL = """
+WITH
+  old AS (
+    DELETE FROM tac.lex_postings WHERE chunk_id = ANY(%(ids)s)
+    RETURNING chunk_id, term, user_id, tf
+  ),
+  dfs AS (
+    UPDATE tac.lex_terms t
+    SET df = t.df - d.n
+    FROM (SELECT user_id, term, count(*) AS n FROM old GROUP BY user_id, term) d
+    WHERE t.user_id = d.user_id AND t.term = d.term
+  )
+UPDATE tac.lex_stats s
+SET n_docs = s.n_docs - o.n, total_len = s.total_len - o.len, updated_at = now()
+FROM (SELECT user_id, count(DISTINCT chunk_id) AS n, sum(tf) AS len FROM old GROUP BY user_id) o
+WHERE s.user_id = o.user_id
+"""
+
+# Добавить новую версию из tac.chunks.tsv (те же лексемы, что видит FTS).
+_LEX_ADD_SQL = """
+WITH
+  new AS (
+    SELECT c.id AS chunk_id, c.user_id, u.lexeme AS term, COALESCE(array_length(u.positions, 1), 1) AS tf
+    FROM tac.chunks c
+    CROSS JOIN LATERAL unnest(c.tsv) u
+    WHERE c.id = ANY(%(ids)s)
+      AND c.user_id IS NOT NULL
+  ),
+  lens AS (
+    SELECT chunk_id, user_id, sum(tf) AS len FROM new GROUP BY chunk_id, user_id
+  ),
+  st AS (
+    INSERT INTO tac.lex_stats (user_id, n_docs, total_len)
+    SELECT user_id, count(*), sum(len) FROM lens GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE
+      SET n_docs = tac.lex_stats.n_docs + excluded.n_docs,
+          total_len = tac.lex_stats.total_len + excluded.total_len,
+          updated_at = now()
+    RETURNING user_id, n_docs, total_len
+  ),
+  terms AS (
+    INSERT INTO tac.lex_terms (user_id, term, df)
+    SELECT user_id, term, count(*) FROM new GROUP BY user_id, term ORDER BY user_id, term
+    ON CONFLICT (user_id, term) DO UPDATE SET df = tac.lex_terms.df + excluded.df
+  )
+INSERT INTO tac.lex_postings (chunk_id, term, user_id, tf, impact)
+SELECT
+  n.chunk_id, n.term, n.user_id, n.tf,
+  n.tf * (%(k1)s + 1.0) / (n.tf + %(k1)s * (1.0 - %(b)s + %(b)s * l.len / (st.total_len::float8 / greatest(st.n_docs, 1))))
+FROM new n
+JOIN lens l ON l.chunk_id = n.chunk_id
+JOIN st ON st.user_id = n.user_id
+"""
+
+
+# Все чанки документа одним statement: tsv считается на сервере из того же текста (текст передаётся один раз).
+_CHUNKS_UPSERT_SQL = """
+INSERT INTO tac.chunks (document_id, user_id, chunk_index, chunk_text, chunk_sha256, tsv)
+SELECT %(doc_id)s, %(user_id)s, u.idx, u.txt, u.sha, to_tsvector('simple', u.txt)
+FROM unnest(%(idx)s::int[], %(txt)s::text[], %(sha)s::text[]) AS u(idx, txt, sha)
+ON CONFLICT (document_id, chunk_index)
+DO UPDATE SET chunk_text=excluded.chunk_text,
+              chunk_sha256=excluded.chunk_sha256,
+              tsv=excluded.tsv,
+              user_id=excluded.user_id
+RETURNING id, chunk_index
+"""
+
+
+def _upsert_chunks(cur, doc_id: int, user_id, chunks: list[str]) -> list[tuple[int, str, str]]:
+    """Upsert чанков документа за один round trip. Возвращает [(chunk_id, chunk_sha256, chunk_text)] в порядке chunk_index."""
+    if not chunks:
+        return []
+    shas = [_sha(c) for c in chunks]
+    cur.execute(
+        _CHUNKS_UPSERT_SQL,
+        {"doc_id": doc_id, "user_id": user_id, "idx": list(range(len(chunks))), "txt": chunks, "sha": shas},
+    )
+    # RETURNING не гарантирует порядок строк — сопоставляем по chunk_index.
+    ids = {int(idx): int(cid) for cid, idx in cur.fetchall()}
+    return [(ids[i], shas[i], c) for i, c in enumerate(chunks)]
+
+
+# Эмбеддинги изменённых чанков задачи одним statement (vector[] передаётся бинарно, см. register_vector).
+# Компактные колонки старого вектора обнуляются: иначе после VECTOR_STORAGE=half/binary они дают чужих соседей
+# (backfill_compact_vectors.py дозаполнит их по NULL).
+_EMBEDDINGS_UPSERT_SQL = """
+INSERT INTO tac.embeddings (chunk_id, user_id, model, dims, chunk_sha256, embedding)
+SELECT u.chunk_id, %(user_id)s, %(model)s, %(dims)s, u.sha, u.v
+FROM unnest(%(ids)s::bigint[], %(shas)s::text[], %(vecs)s::vector(768)[]) AS u(chunk_id, sha, v)
+ON CONFLICT (chunk_id, model)
+DO UPDATE SET dims=excluded.dims,
+              chunk_sha256=excluded.chunk_sha256,
+              embedding=excluded.embedding,
+              embedding_half=NULL,
+              embedding_bin=NULL,
+              user_id=excluded.user_id,
+              created_at=now()
+"""
+
+# То же + halfvec / bit(768) колонки (миграция 012); квантизация на стороне Postgres.
+_EMBEDDINGS_UPSERT_COMPACT_SQL = """
+INSERT INTO tac.embeddings (chunk_id, user_id, model, dims, chunk_sha256, embedding, embedding_half, embedding_bin)
+SELECT u.chunk_id, %(user_id)s, %(model)s, %(dims)s, u.sha, u.v, u.v::halfvec(768), binary_quantize(u.v)::bit(768)
+FROM unnest(%(ids)s::bigint[], %(shas)s::text[], %(vecs)s::vector(768)[]) AS u(chunk_id, sha, v)
+ON CONFLICT (chunk_id, model)
+DO UPDATE SET dims=excluded.dims,
+              chunk_sha256=excluded.chunk_sha256,
+              embedding=excluded.embedding,
+              embedding_half=excluded.embedding_half,
+              embedding_bin=excluded.embedding_bin,
+              user_id=excluded.user_id,
+              created_at=now()
+"""
+
+
+def _upsert_embeddings(cur, user_id, model: str, dims: int, rows: list[tuple[int, str, object]]) -> None:
+    """rows: [(chunk_id, chunk_sha256, vector)], chunk_id уникальны (ON CONFLICT не может тронуть строку дважды)."""
+    if not rows:
+        return
+    cur.execute(
+        _EMBEDDINGS_UPSERT_COMPACT_SQL if VECTOR_STORAGE in ("half", "binary") else _EMBEDDINGS_UPSERT_SQL,
+        {
+            "user_id": user_id,
+            "model": model,
+            "dims": dims,
+            "ids": [r[0] for r in rows],
+            "shas": [r[1] for r in rows],
+            "vecs": [r[2] for r in rows],
+        },
+    )
+
+
+# Словарь сущностей и связи с чанками одним statement. Сущности уникальны и отсортированы
+# (одинаковый порядок блокировок у параллельных воркеров); DO UPDATE — чтобы RETURNING вернул и
+# уже существующие id.
+_ENTITIES_UPSERT_SQL = """
+WITH ents AS (
+  INSERT INTO tac.entities (entity_type, name)
+  SELECT u.t, u.n FROM unnest(%(types)s::text[], %(names)s::text[]) AS u(t, n)
+  ON CONFLICT (entity_type, name) DO UPDATE SET entity_type=excluded.entity_type
+  RETURNING id, entity_type, name
+)
+INSERT INTO tac.chunk_entities (chunk_id, entity_id)
+SELECT l.chunk_id, e.id
+FROM unnest(%(link_chunks)s::bigint[], %(link_types)s::text[], %(link_names)s::text[]) AS l(chunk_id, t, n)
+JOIN ents e ON e.entity_type = l.t AND e.name = l.n
+ON CONFLICT DO NOTHING
+"""
+
+
+def _link_entities(cur, chunk_rows: list[tuple[int, str, str]]) -> int:
+    """NER по чанкам и запись tac.entities + tac.chunk_entities за один round trip. Возвращает число связей."""
+    links: set[tuple[int, str, str]] = set()
+    for chunk_id, _csha, ctext in chunk_rows:
+        for entity_type, name in extract_entities_regex(ctext or ""):
+            links.add((chunk_id, entity_type, name))
+    if not links:
+        return 0
+    ents = sorted({(t, n) for _cid, t, n in links})
+    ordered = sorted(links)
+    cur.execute(
+        _ENTITIES_UPSERT_SQL,
+        {
+            "types": [t for t, _n in ents],
+            "names": [n for _t, n in ents],
+            "link_chunks": [cid for cid, _t, _n in ordered],
+            "link_types": [t for _cid, t, _n in ordered],
+            "link_names": [n for _cid, _t, n in ordered],
+        },
+    )
+    return len(ordered)
+
+
+# Пересчитать tac.document_embeddings (миграция 011) по всем эмбеддингам чанков документа.
+# Косинусная близость не зависит от нормы, поэтому среднее не нормируем.
+_DOC_EMBEDDING_SQL = """
+INSERT INTO tac.document_embeddings (document_id, user_id, model, dims, n_chunks, embedding)
+SELECT c.document_id, %(user_id)s, e.model, max(e.dims), count(*), avg(e.embedding)
+FROM tac.chunks c
+JOIN tac.embeddings e ON e.chunk_id = c.id
+WHERE c.document_id = %(doc_id)s
+  AND e.model = %(model)s
+GROUP BY c.document_id, e.model
+ON CONFLICT (document_id, model)
+DO UPDATE SET user_id = excluded.user_id,
+              dims = excluded.dims,
+              n_chunks = excluded.n_chunks,
+              embedding = excluded.embedding,
+              updated_at = now()
+"""
+
+
+def _update_lexicon(cur, user_id: int, chunk_ids: list[int]) -> None:
+    """
+    Инкрементально обновить BM25-статистику пользователя для переиндексированных чанков.
+    Advisory lock на пользователя: df/total_len — горячие строки, параллельные воркеры
+    иначе ловят взаимные блокировки; держится только до commit задачи (шаг последний).
+    """
+    if not chunk_ids:
+        return
+    cur.execute("SELECT pg_advisory_xact_lock(hashtextextended('tac.lex_stats:' || %s::text, 0))", (user_id,))
+    cur.execute(_LEX_REMOVE_SQL, {"ids": chunk_ids})
+    cur.execute(_LEX_ADD_SQL, {"ids": chunk_ids, "k1": LEXICAL_BM25_K1, "b": LEXICAL_BM25_B})
+
+
+def _connect(autocommit: bool = False) -> psycopg.Connection:
+    conn = psycopg.connect(DATABASE_URL, autocommit=autocommit)
+    # Бинарная адаптация pgvector: numpy float32 -> vector без текстового форматирования.
+    register_vector(conn)
+    if not autocommit:
+        conn.commit()
+    return conn
+
 
-    while True:
-        did_work = False
-        with psycopg.connect(DATABASE_URL, autocommit=False) as conn:
-            with conn.cursor() as cur:
+def _load_job(cur, job_id: int) -> tuple[int, object, list[str]]:
+    """
+    (doc_id, user_id документа, чанки) задачи индексации.
+    Владелец чанков — только tac.documents.user_id (как в backfill миграции 007 и в retrieval), без подстановки из задачи.
+    """
+    cur.execute("SELECT payload FROM op.jobs WHERE id=%s", (job_id,))
+    payload = cur.fetchone()[0]
+    doc_id = int((payload or {}).get("document_id") or 0)
+    if doc_id <= 0:
+        raise RuntimeError("в payload задачи нет document_id")
+
+    cur.execute(
+        "SELECT user_id, body_text FROM tac.documents WHERE id=%s",
+        (doc_id,),
+    )
+    drow = cur.fetchone()
+    if not drow:
+        raise RuntimeError(f"документ не найден: {doc_id}")
+    doc_user_id, body_text = drow
+    return doc_id, doc_user_id, _chunk_text(body_text)
+
+
+def _process_job(job_id: int, user_id, vectors: Optional[dict] = None) -> tuple[int, int, float]:
+    """
+    Индексация документа задачи в одной транзакции. Возвращает (doc_id, chunks, chunk_write_s).
+    `vectors` — эмбеддинги, уже посчитанные по chunk_sha256 (WORKER_CROSS_BATCH); недостающие считаются здесь.
+    """
+    with _connect() as conn:
+        with conn.cursor() as cur:
+            doc_id, doc_user_id, chunks = _load_job(cur, job_id)
+            t_chunks = time.time()
+            chunk_rows = _upsert_chunks(cur, doc_id, doc_user_id, chunks)
+            t_chunks = max(1e-6, time.time() - t_chunks)
+
+            # Local embeddings (sentence-transformers, E5): compute only for changed/missing chunks.
+            embedder = get_embedder()
+            # DB schema currently fixed to vector(768). If config/model differs, skip embeddings.
+            if embedder is not None and int(getattr(embedder, "dims", 0) or 0) == 768 and chunk_rows:
+                chunk_ids = [r[0] for r in chunk_rows]
+                cur.execute(
+                    "SELECT chunk_id, chunk_sha256 FROM tac.embeddings WHERE model=%s AND chunk_id = ANY(%s)",
+                    (embedder.model_name, chunk_ids),
+                )
+                existing = {int(r[0]): (r[1] or "") for r in cur.fetchall()}
+
+                to_embed: list[tuple[int, str, str]] = []
+                for chunk_id, csha, ctext in chunk_rows:
+                    if existing.get(chunk_id) != csha:
+                        to_embed.append((chunk_id, csha, ctext))
+
+                if to_embed:
+                    # Cache within job by chunk_sha256 (avoid recompute for duplicates).
+                    cache: dict = {csha: vectors[csha] for _cid, csha, _t in to_embed if vectors and csha in vectors}
+                    uniq: dict[str, str] = {}
+                    for _chunk_id, csha, ctext in to_embed:
+                        if csha not in cache:
+                            uniq.setdefault(csha, ctext)
+                    if uniq:
+                        vecs = embedder.embed_many(list(uniq.values()))
+                        for csha, v in zip(uniq.keys(), vecs):
+                            cache[csha] = v
+                    _upsert_embeddings(
+                        cur,
+                        doc_user_id,
+                        embedder.model_name,
+                        embedder.dims,
+                        [(chunk_id, csha, cache[csha]) for chunk_id, csha, _ctext in to_embed if cache.get(csha) is not None],
+                    )
+
+                # Эмбеддинг документа (среднее векторов чанков) — первая ступень иерархического поиска в API.
+                cur.execute(_DOC_EMBEDDING_SQL, {"doc_id": doc_id, "user_id": doc_user_id, "model": embedder.model_name})
+
+            # NER (regex, minimal): store extracted entities + links per chunk.
+            _link_entities(cur, chunk_rows)
+
+            # BM25 (tac.lex_*): последним шагом, чтобы lock статистики держался минимально.
+            if doc_user_id is not None:
+                _update_lexicon(cur, int(doc_user_id), [r[0] for r in chunk_rows])
+                # Кэш retrieval в API привязан к версии корпуса: новая версия видна вместе с чанками.
                 cur.execute(
                     """
-                    SELECT id, user_id, payload
-                    FROM op.jobs
-                    WHERE status = 'queued'
-                    ORDER BY created_at
-                    LIMIT 1
-                    FOR UPDATE SKIP LOCKED
-                    """
+                    INSERT INTO op.corpus_versions (user_id, version) VALUES (%s, 1)
+                    ON CONFLICT (user_id) DO UPDATE SET version = op.corpus_versions.version + 1, updated_at = now()
+                    """,
+                    (doc_user_id,),
                 )
-                row = cur.fetchone()
-                if not row:
-                    conn.commit()
-                else:
-                    did_work = True
-                    job_id, user_id, payload = row
-                    cur.execute("UPDATE op.jobs SET status='running', started_at=now() WHERE id=%s", (job_id,))
-                    conn.commit()
-
-        if not did_work:
-            time.sleep(2.0)
-            continue
 
-        # Обрабатываем задачу уже вне транзакции блокировки.
+            cur.execute(
+                "UPDATE op.jobs SET status='done', finished_at=now(), result=%s WHERE id=%s",
+                (Jsonb({"chunks": len(chunks)}), job_id),
+            )
+        conn.commit()
+    return doc_id, len(chunks), t_chunks
+
+
+# chunk_index -> chunk_sha256 уже посчитанных эмбеддингов документа (до upsert чанков задачи).
+_EXISTING_EMBEDDINGS_SQL = """
+SELECT c.chunk_index, e.chunk_sha256
+FROM tac.chunks c
+JOIN tac.embeddings e ON e.chunk_id = c.id AND e.model = %s
+WHERE c.document_id = %s
+"""
+
+
+def _embed_jobs(jobs: list[tuple[int, object]]) -> tuple[dict, int, int]:
+    """
+    WORKER_CROSS_BATCH: изменённые чанки всех взятых задач одним потоком в embedder — уникальные по
+    sha256, отсортированные по длине, полными батчами EMBEDDINGS_BATCH_SIZE (короткие документы иначе
+    дают батчи из 1-3 текстов). Только чтение из БД; запись — в _process_job, commit на задачу.
+    Возвращает ({chunk_sha256: vector}, текстов, батчей).
+    """
+    embedder = get_embedder()
+    if embedder is None or int(getattr(embedder, "dims", 0) or 0) != 768:
+        return {}, 0, 0
+    texts: dict[str, str] = {}
+    with _connect() as conn:
+        with conn.cursor() as cur:
+            for job_id, _user_id in jobs:
+                try:
+                    doc_id, _doc_user_id, chunks = _load_job(cur, job_id)
+                except Exception:
+                    continue  # ошибку задачи запишет _process_job
+                cur.execute(_EXISTING_EMBEDDINGS_SQL, (embedder.model_name, doc_id))
+                existing = {int(r[0]): (r[1] or "") for r in cur.fetchall()}
+                for idx, c in enumerate(chunks):
+                    csha = _sha(c)
+                    if existing.get(idx) != csha:
+                        texts.setdefault(csha, c)
+        conn.commit()
+
+    order = sorted(texts, key=lambda k: len(texts[k]))
+    size = max(1, EMBEDDINGS_BATCH_SIZE)
+    vectors: dict = {}
+    batches = 0
+    for i in range(0, len(order), size):
+        part = order[i : i + size]
+        vectors.update(zip(part, embedder.embed_many([texts[k] for k in part])))
+        batches += 1
+    return vectors, len(order), batches
+
+
+def _fail_job(job_id: int, err: Exception) -> None:
+    with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE op.jobs SET status='error', finished_at=now(), error=%s WHERE id=%s",
+                (str(err), job_id),
+            )
+
+
+# До K задач за один round trip; порядок — по created_at (RETURNING его не гарантирует).
+_CLAIM_SQL = """
+UPDATE op.jobs j
+SET status='running', started_at=now()
+FROM (
+  SELECT id
+  FROM op.jobs
+  WHERE status = 'queued'
+  ORDER BY created_at
+  LIMIT %s
+  FOR UPDATE SKIP LOCKED
+) q
+WHERE j.id = q.id
+RETURNING j.id, j.user_id, j.created_at
+"""
+
+
+# Задачи с истёкшей арендой (их процесс не дожил до commit/requeue) — снова в очередь.
+_REQUEUE_STALE_SQL = """
+UPDATE op.jobs
+SET status='queued', started_at=NULL
+WHERE status = 'running'
+  AND started_at < now() - make_interval(secs => %s)
+"""
+
+
+def _claim_jobs(limit: int) -> list[tuple[int, object]]:
+    with _connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(_REQUEUE_STALE_SQL, (WORKER_JOB_LEASE_S,))
+            if cur.rowcount:
+                print(f"[worker] requeued {cur.rowcount} stale running job(s) (lease {WORKER_JOB_LEASE_S:.0f}s)", flush=True)
+            cur.execute(_CLAIM_SQL, (max(1, int(limit)),))
+            rows = sorted(cur.fetchall(), key=lambda r: (r[2], r[0]))
+        conn.commit()
+    return [(int(r[0]), r[1]) for r in rows]
+
+
+def _requeue_jobs(job_ids: list[int]) -> None:
+    """Вернуть в очередь взятые, но не начатые задачи (остановка процесса)."""
+    if not job_ids:
+        return
+    with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+        conn.execute(
+            "UPDATE op.jobs SET status='queued', started_at=NULL WHERE id = ANY(%s) AND status='running'",
+            (job_ids,),
+        )
+
+
+def _touch_job(job_id: int) -> None:
+    with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+        conn.execute("UPDATE op.jobs SET started_at=now() WHERE id=%s AND status='running'", (job_id,))
+
+
+JOBS_CHANNEL = "op_jobs"
+
+
+class _JobWaiter:
+    """
+    Ожидание новых задач: LISTEN op_jobs на отдельном autocommit-соединении, без запросов к БД в простое.
+    Ждём срезами по 1 с, чтобы SIGTERM не ждал конца таймаута. Соединение упало -> переподключение,
+    до тех пор — обычный sleep.
+    """
+
+    def __init__(self):
+        self.conn: Optional[psycopg.Connection] = None
+
+    def listen(self) -> None:
+        if not WORKER_LISTEN or (self.conn is not None and not self.conn.closed):
+            return
         try:
+            self.conn = psycopg.connect(DATABASE_URL, autocommit=True)
+            self.conn.execute(f"LISTEN {JOBS_CHANNEL}")
+        except psycopg.Error as e:
+            print(f"[worker] LISTEN {JOBS_CHANNEL} failed, polling every {WORKER_POLL_S:.0f}s: {e}", flush=True)
+            self.close()
+
+    def close(self) -> None:
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
+
+    def wait(self, timeout: float, stop: threading.Event) -> bool:
+        """True — пришло уведомление; False — таймаут (пора опросить очередь) или остановка."""
+        deadline = time.time() + timeout
+        while not stop.is_set():
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            self.listen()
+            if self.conn is None:
+                stop.wait(min(1.0, left))
+                continue
+            try:
+                for _n in self.conn.notifies(timeout=min(1.0, left), stop_after=1):
+                    return True
+            except psycopg.Error:
+                self.close()
+        return False
+
+
+class _Throughput:
+    """Счётчики процесса воркера; сводка в лог раз в WORKER_STATS_INTERVAL_S и при остановке."""
+
+    def __init__(self, proc: int):
+        self.proc = proc
+        self.t_start = time.time()
+        self.t_report = self.t_start
+        self.jobs = 0
+        self.errors = 0
+        self.chunks = 0
+        self.busy_s = 0.0
+
+    def add(self, chunks: int, dt: float, ok: bool = True) -> None:
+        self.jobs += 1
+        self.errors += 0 if ok else 1
+        self.chunks += chunks
+        self.busy_s += dt
+
+    def report(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self.t_report < WORKER_STATS_INTERVAL_S:
+            return
+        self.t_report = now
+        up = max(0.001, now - self.t_start)
+        print(
+            f"[worker] proc={self.proc} pid={os.getpid()} jobs={self.jobs} errors={self.errors} chunks={self.chunks}"
+            f" uptime_s={up:.0f} busy={self.busy_s / up:.0%} chunks_per_min={(self.chunks / up) * 60.0:.1f}",
+            flush=True,
+        )
+
+
+def _set_threads(n: int) -> None:
+    """Потоки torch/BLAS на процесс: N процессов по cpu/N потоков вместо одного на все ядра."""
+    if n <= 0:
+        return
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[var] = str(n)
+    try:
+        import torch  # type: ignore
+
+        torch.set_num_threads(n)
+    except Exception:
+        pass
+
+
+def run_worker(proc: int = 0) -> None:
+    """
+    Цикл одного процесса: взять задачу (с WORKER_CROSS_BATCH — до WORKER_CLAIM_BATCH), обработать
+    по одной (commit на задачу).
+    SIGTERM/SIGINT: текущая задача дорабатывается, остальные взятые возвращаются в очередь.
+    """
+    stop = threading.Event()
+
+    def _on_signal(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+
+    stats = _Throughput(proc)
+    waiter = _JobWaiter()
+    # LISTEN до первого захвата: задача, поставленная между пустым захватом и ожиданием, не теряется.
+    waiter.listen()
+    while not stop.is_set():
+        jobs = _claim_jobs(WORKER_CLAIM_BATCH)
+        if not jobs:
+            stats.report()
+            waiter.wait(WORKER_POLL_S, stop)
+            continue
+
+        vectors: Optional[dict] = None
+        if WORKER_CROSS_BATCH and len(jobs) > 1:
             t0 = time.time()
-            with psycopg.connect(DATABASE_URL, autocommit=False) as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT payload FROM op.jobs WHERE id=%s", (job_id,))
-                    payload = cur.fetchone()[0]
-                    doc_id = int((payload or {}).get("document_id") or 0)
-                    if doc_id <= 0:
-                        raise RuntimeError("в payload задачи нет document_id")
-
-                    cur.execute(
-                        "SELECT user_id, body_text FROM tac.documents WHERE id=%s",
-                        (doc_id,),
-                    )
-                    drow = cur.fetchone()
-                    if not drow:
-                        raise RuntimeError(f"документ не найден: {doc_id}")
-                    doc_user_id, body_text = drow
-                    if doc_user_id is None:
-                        doc_user_id = user_id
-
-                    chunks = _chunk_text(body_text)
-                    chunk_rows: list[tuple[int, str, str]] = []  # (chunk_id, chunk_sha256, chunk_text)
-                    for idx, c in enumerate(chunks):
-                        csha = _sha(c)
-                        cur.execute(
-                            """
-                            INSERT INTO tac.chunks (document_id, chunk_index, chunk_text, chunk_sha256, tsv)
-                            VALUES (%s, %s, %s, %s, to_tsvector('simple', %s))
-                            ON CONFLICT (document_id, chunk_index)
-                            DO UPDATE SET chunk_text=excluded.chunk_text,
-                                          chunk_sha256=excluded.chunk_sha256,
-                                          tsv=excluded.tsv
-                            RETURNING id
-                            """,
-                            (doc_id, idx, c, csha, c),
-                        )
-                        chunk_id = int(cur.fetchone()[0])
-                        chunk_rows.append((chunk_id, csha, c))
-
-                    # Local embeddings (sentence-transformers, E5): compute only for changed/missing chunks.
-                    embedder = get_embedder()
-                    # DB schema currently fixed to vector(768). If config/model differs, skip embeddings.
-                    if embedder is not None and int(getattr(embedder, "dims", 0) or 0) == 768 and chunk_rows:
-                        chunk_ids = [r[0] for r in chunk_rows]
-                        cur.execute(
-                            "SELECT chunk_id, chunk_sha256 FROM tac.embeddings WHERE model=%s AND chunk_id = ANY(%s)",
-                            (embedder.model_name, chunk_ids),
-                        )
-                        existing = {int(r[0]): (r[1] or "") for r in cur.fetchall()}
-
-                        to_embed: list[tuple[int, str, str]] = []
-                        for chunk_id, csha, ctext in chunk_rows:
-                            if existing.get(chunk_id) != csha:
-                                to_embed.append((chunk_id, csha, ctext))
-
-                        if to_embed:
-                            # Cache within job by chunk_sha256 (avoid recompute for duplicates).
-                            cache: dict[str, list[float]] = {}
-                            uniq: dict[str, str] = {}
-                            for _chunk_id, csha, ctext in to_embed:
-                                uniq.setdefault(csha, ctext)
-                            if uniq:
-                                vecs = embedder.embed_many(list(uniq.values()))
-                                for csha, v in zip(uniq.keys(), vecs):
-                                    cache[csha] = v
-                            for (chunk_id, csha, _ctext) in to_embed:
-                                v = cache.get(csha)
-                                if v is None:
-                                    continue
-                                cur.execute(
-                                    """
-                                    INSERT INTO tac.embeddings (chunk_id, model, dims, chunk_sha256, embedding)
-                                    VALUES (%s, %s, %s, %s, (%s)::vector(768))
-                                    ON CONFLICT (chunk_id, model)
-                                    DO UPDATE SET dims=excluded.dims,
-                                                  chunk_sha256=excluded.chunk_sha256,
-                                                  embedding=excluded.embedding,
-                                                  created_at=now()
-                                    """,
-                                    (chunk_id, embedder.model_name, embedder.dims, csha, pgvector_text(v)),
-                                )
-
-                    # NER (regex, minimal): store extracted entities + links per chunk.
-                    for chunk_id, _csha, ctext in chunk_rows:
-                        ents = extract_entities_regex(ctext or "")
-                        if not ents:
-                            continue
-                        for entity_type, name in ents:
-                            cur.execute(
-                                """
-                                INSERT INTO tac.entities (entity_type, name)
-                                VALUES (%s, %s)
-                                ON CONFLICT (entity_type, name) DO UPDATE SET entity_type=excluded.entity_type
-                                RETURNING id
-                                """,
-                                (entity_type, name),
-                            )
-                            entity_id = int(cur.fetchone()[0])
-                            cur.execute(
-                                "INSERT INTO tac.chunk_entities (chunk_id, entity_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                                (chunk_id, entity_id),
-                            )
-
-                    cur.execute(
-                        "UPDATE op.jobs SET status='done', finished_at=now(), result=%s WHERE id=%s",
-                        (Jsonb({"chunks": len(chunks)}), job_id),
-                    )
-                conn.commit()
+            try:
+                vectors, texts, batches = _embed_jobs(jobs)
+            except Exception as e:
+                # Не удалось общим батчем — каждая задача посчитает свои эмбеддинги сама.
+                print(f"[worker] proc={proc} cross_batch failed, per-job embeddings: {e}", flush=True)
+                vectors, texts, batches = None, 0, 0
+            dt = time.time() - t0
+            stats.busy_s += dt
+            print(f"[worker] proc={proc} cross_batch jobs={len(jobs)} texts={texts} batches={batches} embed_s={dt:.2f}", flush=True)
+
+        for n, (job_id, user_id) in enumerate(jobs):
+            if stop.is_set():
+                _requeue_jobs([j for j, _u in jobs[n:]])
+                break
+            if n > 0:
+                # Аренда отсчитывается от начала обработки, а не от захвата пачки.
+                _touch_job(job_id)
+            t0 = time.time()
+            try:
+                doc_id, chunks, t_chunks = _process_job(job_id, user_id, vectors)
+            except Exception as e:
+                _fail_job(job_id, e)
+                stats.add(0, time.time() - t0, ok=False)
+                continue
             dt = max(0.001, time.time() - t0)
-            print(f"[worker] job={job_id} doc={doc_id} chunks={len(chunks)} dt={dt:.2f}s chunks_per_min={(len(chunks) / dt) * 60.0:.1f}")
-        except Exception as e:
-            with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE op.jobs SET status='error', finished_at=now(), error=%s WHERE id=%s",
-                        (str(e), job_id),
-                    )
+            stats.add(chunks, dt)
+            print(
+                f"[worker] proc={proc} job={job_id} doc={doc_id} chunks={chunks} dt={dt:.2f}s chunks_per_min={(chunks / dt) * 60.0:.1f}"
+                f" chunk_write_s={t_chunks:.3f} chunk_rows_per_s={chunks / t_chunks:.0f}",
+                flush=True,
+            )
+        stats.report()
+    waiter.close()
+    stats.report(force=True)
+
+
+def _worker_process(proc: int, threads: int) -> None:
+    _set_threads(threads)
+    run_worker(proc)
+
+
+def _supervise(processes: int) -> None:
+    """
+    N процессов воркера (spawn: у каждого своя модель и свои потоки torch). Упавший процесс
+    перезапускается; SIGTERM/SIGINT пересылается детям, супервизор ждёт их завершения.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    threads = WORKER_TORCH_THREADS or max(1, (os.cpu_count() or 1) // processes)
+    procs: dict[int, multiprocessing.process.BaseProcess] = {}
+    stopping = threading.Event()
+
+    def _start(n: int) -> None:
+        p = ctx.Process(target=_worker_process, args=(n, threads), name=f"kb-worker-{n}")
+        p.start()
+        procs[n] = p
+
+    def _on_signal(signum, frame):
+        stopping.set()
+        for p in procs.values():
+            if p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+
+    print(f"[worker] supervisor pid={os.getpid()} processes={processes} threads_per_process={threads} claim_batch={WORKER_CLAIM_BATCH}", flush=True)
+    for n in range(processes):
+        _start(n)
+    while procs:
+        mp_wait([p.sentinel for p in procs.values()], timeout=1.0)
+        for n, p in list(procs.items()):
+            if p.is_alive():
+                continue
+            p.join()
+            del procs[n]
+            if not stopping.is_set():
+                print(f"[worker] proc={n} exited code={p.exitcode}, restarting", flush=True)
+                time.sleep(1.0)
+                _start(n)
+
+
+def main():
+    if not DATABASE_URL:
+        raise SystemExit("DATABASE_URL не задан")
+
+    if WORKER_PROCESSES <= 1:
+        _set_threads(WORKER_TORCH_THREADS)
+        run_worker(0)
+    else:
+        _supervise(WORKER_PROCESSES)
 
 
 if __name__ == "__main__":